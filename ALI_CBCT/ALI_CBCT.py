@@ -10,7 +10,6 @@ import shutil
 from pathlib import Path
 
 import numpy as np
-import torch
 
 # --- LOGGING CONFIGURATION ---
 logger = logging.getLogger("ALI_CBCT")
@@ -34,8 +33,8 @@ try:
     sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
     
     from ALI_CBCT_utils import (
-        Agent, GetAgentLst, Brain, DNet, Environment, GenEnvironmentLst,
-        GetBrain, CorrectHisto, SetSpacing, convertdicom2nifti,
+        Agent, GetAgentLst, BrainPool, DNet, Environment,
+        GetBrain, BatchedSearch, PatientPipeline, PreprocessPatient, convertdicom2nifti,
         MOVEMENTS, DEVICE
     )
 except ImportError as e:
@@ -102,58 +101,27 @@ def main(args):
         logger.error("No valid medical imaging files found. Use these formats: .nrrd,.nrrd.gz,.nii,.nii.gz,.gipl,.gipl.gz")
         sys.exit(1)
 
-    # 4. PRE-PROCESSING (HISTOGRAM & SPACING)
+    # 4. PATIENT PIPELINE (HISTOGRAM, SPACING & ENVIRONMENT)
     update_slicer_progress(5)
-    for p_name, data in patients.items():
-        try:
-            scan_path = data["scan"]
-            # Correct Histogram
-            temp_patient_path = temp_fold / p_name
-            if not temp_patient_path.exists():
-                logger.info(f"Correcting histogram for {p_name}")
-                try:
-                    CorrectHisto(scan_path, str(temp_patient_path), 0.01, 0.99)
-                except Exception as e:
-                    logger.error(f"Histogram correction failed for {p_name}: {e}")
-                    continue
-
-            # Resample for each scale
-            for sp in scale_spacing:
-                try:
-                    spac_key = str(sp).replace(".", "-")
-                    # Construct new filename: name_scan_sp1-0.nii.gz
-                    resampled_name = f"{temp_patient_path.stem}_sp{spac_key}{''.join(temp_patient_path.suffixes)}"
-                    out_resampled = temp_fold / resampled_name
-                    
-                    if not out_resampled.exists():
-                        logger.debug(f"Setting spacing {sp} for {p_name}")
-                        SetSpacing(str(temp_patient_path), [sp, sp, sp], str(out_resampled))
-                    
-                    patients[p_name]["scans"][spac_key] = str(out_resampled)
-                except Exception as e:
-                    logger.error(f"Spacing resampling failed for {p_name} at scale {sp}: {e}")
-                    continue
-        except Exception as e:
-            logger.error(f"Pre-processing failed for patient {p_name}: {e}")
-            continue
-
-    update_slicer_progress(20)
-
-    # 5. ENVIRONMENT & AGENT INIT
     scale_keys = [str(s).replace('.', '-') for s in scale_spacing]
-    
-    try:
-        environment_lst = GenEnvironmentLst(
-            patient_dic=patients,
-            env_type=Environment,
-            padding=np.array(agent_fov) / 2 + 1,
+
+    def prepare_patient(p_name, data):
+        # Runs in the prefetch thread, one patient ahead of the search
+        data["scans"] = PreprocessPatient(p_name, data["scan"], temp_fold, scale_spacing)
+        environment = Environment(
+            patient_id=p_name,
             device=DEVICE,
-            scale_keys=scale_keys
+            padding=np.array(agent_fov) / 2 + 1,
+            scale_keys=scale_keys,
+            verbose=False,
+            cache_dir=str(temp_fold),
         )
-    except Exception as e:
-        logger.error(f"Failed to generate environments: {e}")
-        sys.exit(1)
+        environment.LoadImages(data["scans"])
+        return environment
 
+    patient_pipeline = PatientPipeline(patients, prepare_patient)
+
+    # 5. AGENT INIT
     try:
         agent_params = {
             "type": Agent,
@@ -179,66 +147,77 @@ def main(args):
     
     transition_layer_size = 1024
 
+    # Each landmark's networks are loaded once and reused for every patient
+    brain_pool = BrainPool(
+        brain_weights,
+        brain_params={
+            "network_type": DNet,
+            "network_scales": scale_keys,
+            "device": DEVICE,
+            "in_channels": transition_layer_size,
+            "out_channels": len(MOVEMENTS["id"]),
+            "batch_size": 1,
+            "generate_tensorboard": False,
+            "verbose": False,
+        },
+        max_brains=len(agent_lst),
+    )
+
     # 6. INFERENCE LOOP
-    logger.info(f"Starting prediction on {len(environment_lst)} patients")
+    logger.info(f"Starting prediction on {len(patient_pipeline)} patients")
     start_time = time.time()
     tot_step = 0
     fails = {}
 
-    for env_idx, environment in enumerate(environment_lst):
+    for env_idx, (p_name, environment) in enumerate(patient_pipeline):
+        if environment is None:
+            continue
         logger.info(f"Processing patient: {environment.patient_id}")
         
+        # Borrow every landmark's brain from the pool
+        searching_agents = []
         for agent in agent_lst:
+            if agent.target not in brain_pool:
+                logger.error(f"No model found for landmark: {agent.target}")
+                continue
             try:
-                # Initialize Brain for the specific landmark
-                brain = Brain(
-                    network_type=DNet,
-                    network_scales=scale_keys,
-                    device=DEVICE,
-                    in_channels=transition_layer_size,
-                    out_channels=len(MOVEMENTS["id"]),
-                    batch_size=1,
-                    generate_tensorboard=False,
-                    verbose=False
-                )
-                
-                # Load weights
-                if agent.target in brain_weights:
-                    try:
-                        brain.LoadModels(brain_weights[agent.target])
-                        agent.SetBrain(brain)
-                        agent.SetEnvironment(environment)
-                        
-                        # Execute Deep RL Search
-                        search_result = agent.Search()
-                        
-                        if search_result == -1:
-                            fails[agent.target] = fails.get(agent.target, 0) + 1
-                            logger.warning(f"Agent failed to find {agent.target}")
-                        else:
-                            tot_step += search_result
-                    except Exception as e:
-                        logger.error(f"Error loading model weights for {agent.target}: {e}")
-                        fails[agent.target] = fails.get(agent.target, 0) + 1
-                else:
-                    logger.error(f"No model found for landmark: {agent.target}")
-
+                agent.SetBrain(brain_pool.Get(agent.target))
+                searching_agents.append(agent)
             except Exception as e:
-                logger.error(f"Error during agent search for {agent.target}: {e}")
-            finally:
-                # Cleanup to free GPU memory
-                agent.SetBrain(None)
-                if 'brain' in locals(): del brain
-                if torch.cuda.is_available(): torch.cuda.empty_cache()
+                logger.error(f"Error loading model weights for {agent.target}: {e}")
+                fails[agent.target] = fails.get(agent.target, 0) + 1
+
+        # Execute Deep RL Search, all the agents of the patient in lockstep
+        try:
+            search_results = BatchedSearch(searching_agents, environment).Run()
+        except Exception as e:
+            logger.error(f"Error during agent search for {environment.patient_id}: {e}")
+            search_results = {agent.target: -1 for agent in searching_agents}
+
+        for agent in searching_agents:
+            search_result = search_results.get(agent.target, -1)
+            if search_result == -1:
+                fails[agent.target] = fails.get(agent.target, 0) + 1
+                logger.warning(f"Agent failed to find {agent.target}")
+            else:
+                tot_step += search_result
+            # The pool keeps the brain, the agent only borrows it
+            agent.SetBrain(None)
 
         # Save results for this patient
         try:
             environment.SavePredictedLandmarks(scale_keys[-1], args.output_dir)
         except Exception as e:
             logger.error(f"Failed to save predictions for patient {environment.patient_id}: {e}")
-        
+
+        # Free the patient's scales before the next one is handed over: the agents
+        # hold the last references to the environment and its positions
+        for agent in agent_lst:
+            agent.ClearEnvironment()
+        environment = None
+
         # Update Slicer Progress
-        progress = 20 + int((env_idx + 1) / len(environment_lst) * 80)
+        progress = 5 + int((env_idx + 1) / len(patient_pipeline) * 95)
         update_slicer_progress(progress)
 
     # 7. FINAL LOGS
@@ -246,9 +225,12 @@ def main(args):
     logger.info("--- Execution Summary ---")
     logger.info(f"Total steps taken: {tot_step}")
     logger.info(f"Execution time: {end_time - start_time:.2f}s")
+    logger.info(f"Patient pipeline: {patient_pipeline}")
+    logger.info(f"Brain pool: {brain_pool}")
+    brain_pool.Clear()
     
     for lm, count in fails.items():
-        logger.warning(f"Landmark '{lm}': {count}/{len(environment_lst)} failures")
+        logger.warning(f"Landmark '{lm}': {count}/{len(patient_pipeline)} failures")
 
 if __name__ == "__main__":
     try:
@@ -1,6 +1,8 @@
 from .agent import Agent, GetAgentLst
-from .brain import Brain, DNet, DN
+from .brain import Brain, BrainPool, DNet, DN
 from .environment import Environment, GenEnvironmentLst
 from .io import WriteJson, GenControlPoint, GetBrain, search
 from .preprocess import CorrectHisto, SetSpacing, ResampleImage, convertdicom2nifti
 from .constants import LABELS, LABEL_GROUPS, GROUP_LABELS, MOVEMENTS, DEVICE, SCALE_KEYS, bcolors
+from .search import BatchedSearch, SearchMaxTime
+from .pipeline import PatientPipeline, PreprocessPatient, PrefetchDepth
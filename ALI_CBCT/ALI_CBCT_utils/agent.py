@@ -1,12 +1,12 @@
 import numpy as np
-import time
 import logging
 from collections import deque
 import sys
 
-import os
+import copy
 
-from ALI_CBCT_utils.constants import bcolors, DEVICE
+from ALI_CBCT_utils.constants import bcolors
+from ALI_CBCT_utils.search import BatchedSearch
 
 # --- LOGGING CONFIGURATION ---
 logger = logging.getLogger("ALI_CBCT_Agent")
@@ -67,6 +67,45 @@ def GetAgentLst(agents_param):
 
     return agent_lst
     
+def PositionKey(position):
+    """Pack a position in a single int, 20 bits per axis.
+
+    Agent positions are whole or half voxels, which this packs exactly; anything
+    else falls back to a tuple key.
+    """
+    doubled = np.asarray(position, dtype=np.float64)*2
+    if np.all(doubled == np.round(doubled)) and np.all(np.abs(doubled) < 2**19):
+        x, y, z = (doubled.astype(np.int64) + 2**19).tolist()
+        return (x << 40) | (y << 20) | z
+    return tuple(np.asarray(position).tolist())
+
+class VisitedMemory:
+    """Window of the last positions of an agent with constant time membership test."""
+
+    def __init__(self, size):
+        self.window = deque(maxlen=size)
+        self.counts = {}
+
+    def append(self, position):
+        if len(self.window) == self.window.maxlen:
+            old = self.window[0]
+            self.counts[old] -= 1
+            if self.counts[old] == 0:
+                del self.counts[old]
+        key = PositionKey(position)
+        self.window.append(key)
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def clear(self):
+        self.window.clear()
+        self.counts.clear()
+
+    def __contains__(self, position):
+        return PositionKey(position) in self.counts
+
+    def __len__(self):
+        return len(self.window)
+
 def OUT_WARNING():
     logger.warning("WARNING: Agent trying to move to a non-existing space")
     
@@ -83,6 +122,7 @@ class Agent :
         FOV = [32,32,32],
         start_pos_radius = 20,
         shortmem_size = 10,
+        trajectory_size = 1000,
         speed_per_scale = [2,1],
         verbose = False
     ) -> None:
@@ -101,6 +141,7 @@ class Agent :
 
             self.brain = brain
             self.shortmem_size = shortmem_size
+            self.trajectory_size = trajectory_size
 
             self.verbose = verbose
 
@@ -125,8 +166,8 @@ class Agent :
             position_mem = []
             position_shortmem = []
             for i in range(environement.scale_nbr):
-                position_mem.append([])
-                position_shortmem.append(deque(maxlen=self.shortmem_size))
+                position_mem.append(deque(maxlen=self.trajectory_size))
+                position_shortmem.append(VisitedMemory(self.shortmem_size))
             self.position_mem = position_mem
             self.position_shortmem = position_shortmem
             logger.debug(f"Environment set for agent {self.target}")
@@ -134,6 +175,12 @@ class Agent :
             logger.error(f"Error setting environment for agent {self.target}: {e}")
             raise
 
+    def ClearEnvironment(self):
+        """Drop the references to the environment and the position memories of the last patient."""
+        self.environement = None
+        self.position_mem = []
+        self.position_shortmem = []
+
     def SetBrain(self, brain):
         """Set brain with error handling."""
         try:
@@ -212,38 +259,72 @@ class Agent :
         self.position_mem[self.scale_state].append(self.position)
         self.position_shortmem[self.scale_state].append(self.position)
 
+    FOCUS_DIRECTIONS = np.array(
+        [
+            [1,0,0],
+            [-1,0,0],
+            [0,1,0],
+            [0,-1,0],
+            [0,0,1],
+            [0,0,-1]
+        ],
+        dtype=np.int16
+    )
+    FOCUS_RADIUS = 4
+
+    def StartSearch(self):
+        self.GoToScale()
+        self.SetPosAtCenter()
+        self.SavePos()
+        self.tot_step = 0
+
+    def Step(self, action):
+        """Apply one predicted action, return True once the landmark is found at the last scale."""
+        self.tot_step += 1
+        self.Move(action)
+        found = self.Visited()
+        self.SavePos()
+        if found:
+            logger.debug(f"Landmark {self.target} found at scale: {self.scale_state}")
+            logger.debug(f"Agent position: {self.position}")
+            scale_changed = self.UpScale()
+            found = not scale_changed
+        return found
+
+    def MakeProbes(self, start_pos):
+        """Focus probes: copies of the agent starting around start_pos, each with its own short memory."""
+        probes = []
+        for direction in self.FOCUS_DIRECTIONS:
+            probe = copy.copy(self)
+            probe.position = start_pos + self.FOCUS_RADIUS*direction
+            probe.position_shortmem = [VisitedMemory(self.shortmem_size) for _ in self.position_shortmem]
+            probes.append(probe)
+        return probes
+
+    def ProbeStep(self, action):
+        """Apply one predicted action to a Focus probe, return True once it is back on a visited position."""
+        self.Move(action)
+        found = self.Visited()
+        self.SavePos()
+        return found
+
     def Focus(self,start_pos):
-        explore_pos = np.array(
-            [
-                [1,0,0],
-                [-1,0,0],
-                [0,1,0],
-                [0,-1,0],
-                [0,0,1],
-                [0,0,-1]
-            ],
-            dtype=np.int16
-        )
-        radius = 4
+        probes = self.MakeProbes(start_pos)
         final_pos = np.array([0,0,0], dtype=np.float64)
-        for pos in explore_pos:
-            found = False
-            self.position_shortmem[self.scale_state].clear()
-            self.position = start_pos + radius*pos
-            while  not found:
-                action = self.PredictAction()
-                self.Move(action)
-                if self.Visited():
-                    found = True
-                self.SavePos()
-            final_pos += self.position
-        return final_pos/len(explore_pos)
+        # the probes share the agent's network: one forward pass per step for all of them
+        while probes:
+            actions = self.brain.PredictBatch(self.scale_state, [probe.GetState() for probe in probes])
+            remaining = []
+            for probe, action in zip(probes, actions):
+                if probe.ProbeStep(action):
+                    final_pos += probe.position
+                else:
+                    remaining.append(probe)
+            probes = remaining
+        return final_pos/len(self.FOCUS_DIRECTIONS)
 
     def Search(self):
         """Search for landmark with comprehensive error handling."""
-        tic = time.time()
-        logger.info(f"Starting search for landmark: {self.target}")
-        
         try:
             if self.brain is None:
                 logger.error(f"Brain not set for agent {self.target}")
@@ -252,69 +333,18 @@ class Agent :
             if self.environement is None:
                 logger.error(f"Environment not set for agent {self.target}")
                 raise RuntimeError("Environment is not initialized")
-            
-            self.GoToScale()
-            self.SetPosAtCenter()
-            self.SavePos()
-            
-            found = False
-            tot_step = 0
-            # Each search step does a CPU/GPU forward pass; CPU-only inference
-            # needs much longer than a GPU to converge, so give it a bigger
-            # default budget. Override with the ALI_SEARCH_MAX_TIME env var
-            # if either default still doesn't fit your hardware.
-            default_max_time = 15 if DEVICE.type == "cuda" else 60
-            max_time = float(os.environ.get("ALI_SEARCH_MAX_TIME", default_max_time))  # seconds
-            
-            while not found and time.time() - tic < max_time:
-                tot_step += 1
-                
-                try:
-                    action = self.PredictAction()
-                    self.Move(action)
-                    
-                    if self.Visited():
-                        found = True
-                    
-                    self.SavePos()
-                    
-                    if found:
-                        logger.debug(f"Landmark {self.target} found at scale: {self.scale_state}")
-                        logger.debug(f"Agent position: {self.position}")
-                        
-                        scale_changed = self.UpScale()
-                        found = not scale_changed
-                    
-                    if self.search_atempt > 2:
-                        logger.warning(f"Landmark {self.target} not found after {self.search_atempt} attempts")
-                        self.search_atempt = 0
-                        return -1
-                        
-                except Exception as e:
-                    logger.error(f"Error during search step for {self.target}: {e}")
-                    continue
-
-            if not found:  # Took too much time
-                logger.warning(f"Landmark {self.target} search timed out after {max_time} seconds")
-                self.search_atempt = 0
-                return -1
-
-            try:
-                final_pos = self.Focus(self.position)
-                logger.info(f"Final position for {self.target}: {final_pos}")
-                self.environement.AddPredictedLandmark(self.target, final_pos)
-                return tot_step
-            except Exception as e:
-                logger.error(f"Error in focus phase for {self.target}: {e}")
-                return -1
-                
+
+            return BatchedSearch([self], self.environement).Run()[self.target]
         except Exception as e:
             logger.error(f"Fatal error during search for {self.target}: {e}")
             return -1
 
     def Visited(self):
-        visited = False
-        for previous_pos in self.position_shortmem[self.scale_state]:
-            if np.array_equal(self.position,previous_pos):
-                visited = True
-        return visited
\ No newline at end of file
+        return self.position in self.position_shortmem[self.scale_state]
+
+    def ExportTrajectory(self, out_path):
+        """Save the last trajectory_size positions of each scale in a .npz file."""
+        np.savez(
+            out_path,
+            **{scale: np.array(list(mem)) for scale, mem in zip(self.scale_keys, self.position_mem)}
+        )
@@ -1,4 +1,6 @@
 import os
+from collections import OrderedDict
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -171,7 +173,139 @@ class Brain:
             x = network(input)
         return torch.argmax(x)
 
+    def PredictBatch(self,dim,states):
+        """Actions of several states with a single forward pass of the scale network.
+
+        Crops clipped by the image border have a smaller shape, states are stacked by shape.
+        """
+        network = self.networks[dim]
+        network.eval()
+        by_shape = {}
+        for i,state in enumerate(states):
+            by_shape.setdefault(tuple(state.shape), []).append(i)
+
+        actions = [0]*len(states)
+        with torch.no_grad():
+            for idx in by_shape.values():
+                input = torch.stack([states[i] for i in idx]).type(torch.float32).to(self.device)
+                x = network(input)
+                for i,action in zip(idx, torch.argmax(x, dim=1).tolist()):
+                    actions[i] = action
+        return actions
+
     def LoadModels(self,model_lst):
         for n,net in enumerate(self.networks):
             logger.info(f"Loading model {model_lst[self.network_scales[n]]}")
-            net.load_state_dict(torch.load(model_lst[self.network_scales[n]],map_location=self.device))
\ No newline at end of file
+            net.load_state_dict(torch.load(model_lst[self.network_scales[n]],map_location=self.device))
+
+    def Nbytes(self):
+        """Memory held by the parameters and buffers of all the scale networks."""
+        total = 0
+        for net in self.networks:
+            for tensor in list(net.parameters()) + list(net.buffers()):
+                total += tensor.numel() * tensor.element_size()
+        return total
+
+class BrainPool:
+    """Bounded LRU pool of loaded Brains keyed by landmark.
+
+    A landmark's networks are built and their weights read once, then reused for
+    every patient while they stay in the pool. The least recently used Brain is
+    evicted when the pool holds more than max_brains, when the pooled weights go
+    over max_bytes, or, on CUDA, when less than min_free_bytes is left on the device.
+    """
+
+    def __init__(
+        self,
+        brain_weights,
+        brain_params,
+        max_brains = None,
+        max_bytes = None,
+        min_free_bytes = 512 * 1024**2,
+    ) -> None:
+        """
+        Args:
+            brain_weights : {landmark: {scale: weight path}} as returned by GetBrain
+            brain_params : keyword arguments of the Brain constructor
+            max_brains : maximum number of Brains kept loaded (no limit by default)
+            max_bytes : maximum memory of the pooled weights (no limit by default)
+            min_free_bytes : CUDA memory to keep free before loading another Brain
+        """
+        self.brain_weights = brain_weights
+        self.brain_params = brain_params
+        self.max_brains = max_brains
+        self.max_bytes = max_bytes
+        self.min_free_bytes = min_free_bytes
+        self.device = torch.device(brain_params["device"])
+
+        self.brains = OrderedDict()
+        self.nbytes = {}
+
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+
+    def __contains__(self, landmark):
+        return landmark in self.brain_weights
+
+    def Get(self, landmark):
+        """Return the loaded Brain of the landmark, or None if there are no weights for it."""
+        if landmark in self.brains:
+            self.hits += 1
+            self.brains.move_to_end(landmark)
+            return self.brains[landmark]
+
+        if landmark not in self.brain_weights:
+            return None
+
+        self._MakeRoom()
+        brain = Brain(**self.brain_params)
+        brain.LoadModels(self.brain_weights[landmark])
+        for net in brain.networks:
+            net.eval()
+
+        self.brains[landmark] = brain
+        self.nbytes[landmark] = brain.Nbytes()
+        self.loads += 1
+        self._Shrink()
+        return brain
+
+    def _FreeDeviceBytes(self):
+        if self.device.type != "cuda" or not hasattr(torch.cuda, "mem_get_info"):
+            return None
+        free, _ = torch.cuda.mem_get_info(self.device)
+        return free
+
+    def _EvictOldest(self):
+        landmark, _ = self.brains.popitem(last=False)
+        self.nbytes.pop(landmark, None)
+        self.evictions += 1
+        logger.debug(f"Evicted brain of {landmark}")
+        if self.device.type == "cuda":
+            torch.cuda.empty_cache()
+
+    def _MakeRoom(self):
+        """Evict before loading when the device is already short on memory."""
+        while self.brains:
+            free = self._FreeDeviceBytes()
+            if free is None or free >= self.min_free_bytes:
+                break
+            self._EvictOldest()
+
+    def _Shrink(self):
+        # the Brain just loaded is the most recent one and is never evicted here
+        while len(self.brains) > 1:
+            over_count = self.max_brains is not None and len(self.brains) > self.max_brains
+            over_bytes = self.max_bytes is not None and sum(self.nbytes.values()) > self.max_bytes
+            if not (over_count or over_bytes):
+                break
+            self._EvictOldest()
+
+    def Clear(self):
+        self.brains.clear()
+        self.nbytes.clear()
+        if self.device.type == "cuda":
+            torch.cuda.empty_cache()
+
+    def __str__(self):
+        return f"{self.loads} brain load(s), {self.hits} reuse(s), {self.evictions} eviction(s)"
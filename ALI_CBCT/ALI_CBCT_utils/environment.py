@@ -4,7 +4,6 @@ import json
 import numpy as np
 import torch
 import SimpleITK as sitk
-from monai.transforms import Compose, BorderPad, ScaleIntensity, SpatialCrop
 
 from ALI_CBCT_utils.constants import LABELS, LABEL_GROUPS, SCALE_KEYS, DEVICE, bcolors
 from ALI_CBCT_utils.io import WriteJson, GenControlPoint
@@ -32,22 +31,25 @@ class Environment :
         scale_keys = None,
         correct_contrast = False,
         verbose = False,
+        cache_dir = None,
+        cache_dtype = np.float32,
 
     ) -> None:
         """
         Args:
             images_path : path of the image with all the different scale,
             landmark_fiducial : path of the fiducial list linked with the image,
+            cache_dir : folder where the padded scales are memory-mapped and reused
+                across runs (kept in memory when None)
+            cache_dtype : np.float32, or np.float16 to halve the cache size
         """
         self.patient_id = patient_id
         self.padding = padding.astype(np.int16)
         self.device = device
         self.scale_keys = scale_keys if scale_keys is not None else SCALE_KEYS
         self.verbose = verbose
-        self.transform = Compose([
-            self.get_channel_transform(),
-            BorderPad(spatial_border=self.padding.tolist())
-        ])
+        self.cache_dir = cache_dir
+        self.cache_dtype = np.dtype(cache_dtype)
         self.scale_nbr = 0
 
         self.available_lm = []
@@ -56,13 +58,30 @@ class Environment :
 
         self.predicted_landmarks = {}
 
-    def get_channel_transform(self):
-        if sys.version_info >= (3, 10):
-            from monai.transforms import EnsureChannelFirst
-            return EnsureChannelFirst(channel_dim="no_channel")
-        else:
-            from monai.transforms import AddChannel
-            return AddChannel()
+    def CachePath(self, scale_id):
+        """One cache file per patient and scale, for the current padding and dtype."""
+        pad = "-".join(str(p) for p in self.padding.tolist())
+        return os.path.join(self.cache_dir, f"{self.patient_id}_{scale_id}_pad{pad}_{self.cache_dtype.name}.npy")
+
+    def PadScale(self, path, scale_id, img_ar):
+        """Zero padded copy of the scale in cache_dtype, memory-mapped from cache_dir when set.
+
+        The cache is rebuilt whenever the resampled scan at path is newer than it, so it
+        is only reused across runs that keep the resampled scans of the same temp folder.
+        """
+        if self.cache_dir is None:
+            return np.pad(img_ar, [(p, p) for p in self.padding.tolist()]).astype(self.cache_dtype)
+
+        cache_path = self.CachePath(scale_id)
+        if not os.path.exists(cache_path) or os.path.getmtime(cache_path) < os.path.getmtime(path):
+            os.makedirs(self.cache_dir, exist_ok=True)
+            padded = np.pad(img_ar, [(p, p) for p in self.padding.tolist()]).astype(self.cache_dtype)
+            tmp_path = cache_path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, padded)
+            os.replace(tmp_path, cache_path)
+            del padded
+        return np.load(cache_path, mmap_mode="r")
 
     def LoadImages(self,images_path):
 
@@ -72,10 +91,7 @@ class Environment :
             data = {"path":path}
             img = sitk.ReadImage(path)
             img_ar = sitk.GetArrayFromImage(img)
-            if sys.version_info >= (3, 10):
-                data["image"] = self.transform(img_ar).to(dtype=torch.int16)
-            else:
-                data["image"] = torch.from_numpy(self.transform(img_ar)).type(torch.int16)
+            data["image"] = self.PadScale(path, scale_id, img_ar)
 
             data["spacing"] = np.array(img.GetSpacing())
             origin = img.GetOrigin()
@@ -157,11 +173,24 @@ class Environment :
         return np.linalg.norm(position-label_pos)**2
 
     def GetZone(self,scale,center,crop_size):
-        cropTransform = SpatialCrop(center.tolist() + self.padding,crop_size)
-        rescale = ScaleIntensity(minv = -1.0, maxv = 1.0, factor = None)
-        crop = cropTransform(self.data[scale]["image"])
-        crop = rescale(crop).type(torch.float32)
-        return crop
+        """Crop of crop_size centered on center, rescaled to [-1, 1].
+
+        Same result as MONAI's SpatialCrop + ScaleIntensity(minv=-1, maxv=1), but taken
+        as a slice view of the padded scale without building transforms at each step.
+        """
+        roi_center = (np.asarray(center) + self.padding).astype(np.int16)
+        roi_size = np.asarray(crop_size, dtype=np.int16)
+        roi_start = np.maximum(roi_center - roi_size//2, 0)
+        roi_end = roi_start + roi_size
+        view = self.data[scale]["image"][roi_start[0]:roi_end[0], roi_start[1]:roi_end[1], roi_start[2]:roi_end[2]]
+
+        crop = torch.from_numpy(np.array(view, dtype=np.float32))
+        mina, maxa = crop.min(), crop.max()
+        if mina == maxa:
+            crop = crop * -1.0
+        else:
+            crop = (crop - mina) / (maxa - mina) * 2.0 - 1.0
+        return crop.unsqueeze(0)
 
     def GetRewardLst(self,scale,position,target,mvt_matrix):
         agent_dist = self.GetL2DistFromLandmark(scale,position,target)
@@ -229,7 +258,7 @@ class Environment :
             logger.debug(self.data[scale]["landmarks"])
         return ""
     
-def GenEnvironmentLst(patient_dic ,env_type, padding = 1, device = DEVICE, scale_keys = None):
+def GenEnvironmentLst(patient_dic ,env_type, padding = 1, device = DEVICE, scale_keys = None, cache_dir = None):
     environement_lst = []
     for patient,data in patient_dic.items():
         logger.info(f"{bcolors.OKCYAN}Generating Environement for the patient: {bcolors.OKBLUE}{patient}{bcolors.ENDC}")
@@ -239,6 +268,7 @@ def GenEnvironmentLst(patient_dic ,env_type, padding = 1, device = DEVICE, scale
             padding = padding,
             scale_keys = scale_keys,
             verbose = False,
+            cache_dir = cache_dir,
         )
         env.LoadImages(data["scans"])
         environement_lst.append(env)
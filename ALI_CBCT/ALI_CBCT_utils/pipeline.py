@@ -0,0 +1,141 @@
+import os
+import sys
+import time
+import queue
+import logging
+import threading
+from pathlib import Path
+
+from ALI_CBCT_utils.preprocess import CorrectHisto, SetSpacing
+
+# --- LOGGING CONFIGURATION ---
+logger = logging.getLogger("ALI_CBCT_pipeline")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+if logger.handlers:
+    logger.handlers.clear()
+console_handler = logging.StreamHandler(sys.stdout)
+console_handler.setLevel(logging.INFO)
+formatter = logging.Formatter('%(name)s - %(levelname)s - (%(filename)s:%(lineno)d) - %(message)s')
+console_handler.setFormatter(formatter)
+logger.addHandler(console_handler)
+
+
+def PrefetchDepth():
+    """Number of patients prepared ahead of the search, ALI_PREFETCH_DEPTH env var (default 1)."""
+    return max(int(os.environ.get("ALI_PREFETCH_DEPTH", 1)), 1)
+
+
+def PreprocessPatient(p_name, scan_path, temp_fold, scale_spacing):
+    """Correct the histogram and resample the scan at each scale.
+
+    Returns:
+        {scale_key: path of the resampled scan}
+    """
+    temp_fold = Path(temp_fold)
+    temp_patient_path = temp_fold / p_name
+    if not temp_patient_path.exists():
+        logger.info(f"Correcting histogram for {p_name}")
+        CorrectHisto(scan_path, str(temp_patient_path), 0.01, 0.99)
+
+    scans = {}
+    for sp in scale_spacing:
+        try:
+            spac_key = str(sp).replace(".", "-")
+            # Construct new filename: name_scan_sp1-0.nii.gz
+            resampled_name = f"{temp_patient_path.stem}_sp{spac_key}{''.join(temp_patient_path.suffixes)}"
+            out_resampled = temp_fold / resampled_name
+
+            if not out_resampled.exists():
+                logger.debug(f"Setting spacing {sp} for {p_name}")
+                SetSpacing(str(temp_patient_path), [sp, sp, sp], str(out_resampled))
+
+            scans[spac_key] = str(out_resampled)
+        except Exception as e:
+            logger.error(f"Spacing resampling failed for {p_name} at scale {sp}: {e}")
+            continue
+    return scans
+
+
+class PatientPipeline:
+    """Producer/consumer pipeline over the patients.
+
+    A background thread corrects, resamples and loads the Environment of the next
+    patients while the caller searches the current one. At most prefetch_depth
+    prepared Environments wait in the queue, while the thread prepares one more and
+    the caller searches another, so about prefetch_depth + 2 patients are loaded at
+    once whatever the cohort size; this only holds if the caller drops every reference
+    to an Environment (agents included) once it is saved.
+    """
+
+    _DONE = object()
+
+    def __init__(self, patients, prepare, prefetch_depth=None) -> None:
+        """
+        Args:
+            patients : {patient name: {"scan": path}}
+            prepare : callable(p_name, data) returning the loaded Environment of a patient
+            prefetch_depth : number of prepared patients waiting for the search
+        """
+        self.patients = patients
+        self.prepare = prepare
+        self.prefetch_depth = prefetch_depth if prefetch_depth is not None else PrefetchDepth()
+
+        self.queue = queue.Queue(maxsize=self.prefetch_depth)
+        self.stop = threading.Event()
+        self.start_time = None
+        self.processed = 0
+        self.prepare_time = 0.0
+
+    def _Produce(self):
+        try:
+            for p_name, data in self.patients.items():
+                if self.stop.is_set():
+                    break
+                tic = time.time()
+                try:
+                    environment = self.prepare(p_name, data)
+                except Exception as e:
+                    logger.error(f"Pre-processing failed for patient {p_name}: {e}")
+                    environment = None
+                self.prepare_time += time.time() - tic
+                self.queue.put((p_name, environment))
+        finally:
+            self.queue.put(self._DONE)
+
+    def __len__(self):
+        return len(self.patients)
+
+    def __iter__(self):
+        """Yield (patient name, Environment or None if its preparation failed)."""
+        self.start_time = time.time()
+        worker = threading.Thread(target=self._Produce, name="ALI_CBCT_prefetch", daemon=True)
+        worker.start()
+        try:
+            while True:
+                item = self.queue.get()
+                if item is self._DONE:
+                    break
+                yield item
+                # drop the reference while waiting for the next patient
+                item = None
+                self.processed += 1
+        finally:
+            self.stop.set()
+            # unblock the producer if the consumer stopped early
+            while worker.is_alive():
+                try:
+                    self.queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            worker.join()
+
+    def PatientsPerHour(self):
+        elapsed = time.time() - self.start_time if self.start_time is not None else 0
+        return self.processed / elapsed * 3600 if elapsed > 0 else 0.0
+
+    def __str__(self):
+        return (
+            f"{self.processed}/{len(self.patients)} patient(s), {self.PatientsPerHour():.1f} patients/hour "
+            f"(prefetch depth {self.prefetch_depth}, {self.prepare_time:.2f}s of background preparation)"
+        )
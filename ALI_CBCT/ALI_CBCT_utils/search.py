@@ -0,0 +1,176 @@
+import os
+import sys
+import time
+import logging
+from collections import defaultdict
+
+import numpy as np
+
+from ALI_CBCT_utils.constants import DEVICE
+
+# --- LOGGING CONFIGURATION ---
+logger = logging.getLogger("ALI_CBCT_search")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+if logger.handlers:
+    logger.handlers.clear()
+console_handler = logging.StreamHandler(sys.stdout)
+console_handler.setLevel(logging.INFO)
+formatter = logging.Formatter('%(name)s - %(levelname)s - (%(filename)s:%(lineno)d) - %(message)s')
+console_handler.setFormatter(formatter)
+logger.addHandler(console_handler)
+
+
+def SearchMaxTime():
+    """Search budget of one agent in seconds.
+
+    Each search step does a CPU/GPU forward pass; CPU-only inference needs much
+    longer than a GPU to converge, so give it a bigger default budget. Override
+    with the ALI_SEARCH_MAX_TIME env var if either default still doesn't fit
+    your hardware.
+    """
+    default_max_time = 15 if DEVICE.type == "cuda" else 60
+    return float(os.environ.get("ALI_SEARCH_MAX_TIME", default_max_time))
+
+
+class BatchedSearch:
+    """Lockstep landmark search of several agents on one environment.
+
+    At every iteration the still active walkers (searching agents and the Focus
+    probes of the agents that converged) are grouped by network and scale, their
+    crops are stacked and each group is evaluated with a single forward pass.
+    Walkers drop out of the batch as soon as they converge, fail or run out of time.
+    Each agent is charged its share of the iteration time, so the ALI_SEARCH_MAX_TIME
+    budget keeps the same meaning as with one agent at a time. An agent whose state,
+    forward pass or step raises is reported as not found without stopping the others.
+    """
+
+    def __init__(self, agents, environment, max_time=None) -> None:
+        self.agents = agents
+        self.environment = environment
+        self.max_time = max_time if max_time is not None else SearchMaxTime()
+
+    def Run(self):
+        """
+        Returns:
+            {landmark: number of search steps, or -1 if the landmark was not found}
+        """
+        results = {}
+        searching = []
+        for agent in self.agents:
+            if agent.brain is None:
+                logger.error(f"Brain not set for agent {agent.target}")
+                results[agent.target] = -1
+                continue
+            agent.SetEnvironment(self.environment)
+            agent.StartSearch()
+            searching.append(agent)
+            logger.info(f"Starting search for landmark: {agent.target}")
+
+        spent = defaultdict(float)
+        probes = {}
+        focus_pos = {}
+
+        while searching or probes:
+            tic = time.time()
+            # agents whose state, forward pass or step raised this iteration
+            failed = set()
+            walkers = [(agent, agent) for agent in searching]
+            walkers += [(agent, probe) for agent, lst in probes.items() for probe in lst]
+
+            groups = defaultdict(list)
+            for owner, walker in walkers:
+                groups[(id(walker.brain), walker.scale_state)].append((owner, walker))
+
+            actions = {}
+            for members in groups.values():
+                states, ready = [], []
+                for owner, walker in members:
+                    try:
+                        states.append(walker.GetState())
+                        ready.append((owner, walker))
+                    except Exception as e:
+                        logger.error(f"Error during search step for {owner.target}: {e}")
+                        failed.add(owner)
+                if ready:
+                    walker = ready[0][1]
+                    try:
+                        predicted = walker.brain.PredictBatch(walker.scale_state, states)
+                    except Exception as e:
+                        logger.error(f"Error during batched prediction for {', '.join(sorted({owner.target for owner, _ in ready}))}: {e}")
+                        failed.update(owner for owner, _ in ready)
+                        continue
+                    for (owner, walker), action in zip(ready, predicted):
+                        actions[id(walker)] = action
+
+            step_time = (time.time() - tic) / len(walkers)
+            for owner, walker in walkers:
+                spent[owner.target] += step_time
+
+            for agent in list(searching):
+                found = False
+                if agent not in failed and id(agent) in actions:
+                    try:
+                        found = agent.Step(actions[id(agent)])
+                    except Exception as e:
+                        logger.error(f"Error during search step for {agent.target}: {e}")
+                        failed.add(agent)
+
+                if agent in failed:
+                    agent.search_atempt = 0
+                    results[agent.target] = -1
+                    searching.remove(agent)
+                elif agent.search_atempt > 2:
+                    logger.warning(f"Landmark {agent.target} not found after {agent.search_atempt} attempts")
+                    agent.search_atempt = 0
+                    results[agent.target] = -1
+                    searching.remove(agent)
+                elif found:
+                    searching.remove(agent)
+                    # the Focus phase gets its own time budget
+                    spent[agent.target] = 0.0
+                    probes[agent] = agent.MakeProbes(agent.position)
+                    focus_pos[agent] = np.zeros(3, dtype=np.float64)
+                elif spent[agent.target] > self.max_time:
+                    logger.warning(f"Landmark {agent.target} search timed out after {self.max_time} seconds")
+                    agent.search_atempt = 0
+                    results[agent.target] = -1
+                    searching.remove(agent)
+
+            for agent in list(probes):
+                remaining = []
+                for probe in probes[agent]:
+                    if agent in failed:
+                        break
+                    try:
+                        if id(probe) in actions and probe.ProbeStep(actions[id(probe)]):
+                            focus_pos[agent] += probe.position
+                        else:
+                            remaining.append(probe)
+                    except Exception as e:
+                        logger.error(f"Error during focus step for {agent.target}: {e}")
+                        failed.add(agent)
+
+                if agent in failed:
+                    del probes[agent]
+                    focus_pos.pop(agent)
+                    results[agent.target] = -1
+                    continue
+
+                if remaining and spent[agent.target] > self.max_time:
+                    logger.warning(f"Focus of {agent.target} stopped after {self.max_time} seconds")
+                    for probe in remaining:
+                        focus_pos[agent] += probe.position
+                    remaining = []
+
+                if remaining:
+                    probes[agent] = remaining
+                    continue
+
+                del probes[agent]
+                final_pos = focus_pos.pop(agent) / len(agent.FOCUS_DIRECTIONS)
+                logger.info(f"Final position for {agent.target}: {final_pos}")
+                self.environment.AddPredictedLandmark(agent.target, final_pos)
+                results[agent.target] = agent.tot_step
+
+        return results
@@ -14,7 +14,6 @@ import time
 import os
 import glob
 import sys
-import vtk
 import platform
 import argparse
 import torch
@@ -36,10 +35,6 @@ formatter = logging.Formatter('%(name)s - %(levelname)s - (%(filename)s:%(lineno
 console_handler.setFormatter(formatter)
 logger.addHandler(console_handler)
 
-from monai.networks.nets import UNet
-from monai.transforms import AsDiscrete
-from pytorch3d.structures import Meshes
-from pytorch3d.renderer import TexturesVertex
 
 fpath = os.path.join(os.path.dirname(__file__), "..")
 sys.path.append(fpath)
@@ -57,18 +52,16 @@ def check_platform():
 
 # Import from utils
 if check_platform()=="WSL":
-    from ALI_IOS_utils.render import GenPhongRenderer
-    from ALI_IOS_utils.surface import ReadSurf, ScaleSurf, GetSurfProp, RemoveExtraFaces, Upscale
-    from ALI_IOS_utils.model import dic_cam, dic_label, MODELS_DICT
+    from ALI_IOS_utils.surface import LandmarkCentroids, Upscale
+    from ALI_IOS_utils.model import dic_label, MODELS_DICT
     from ALI_IOS_utils.io import GenControlPoint, WriteJson, TradLabel
-    from ALI_IOS_utils.agent import Agent
+    from ALI_IOS_utils.session import Session
     
 else :
     from ALI_IOS_utils import (
-        GenPhongRenderer, ReadSurf, ScaleSurf,
-        GetSurfProp, RemoveExtraFaces, Upscale,
-        dic_cam, dic_label, MODELS_DICT,
-        GenControlPoint, WriteJson, TradLabel, Agent
+        LandmarkCentroids, Upscale,
+        dic_label, MODELS_DICT,
+        GenControlPoint, WriteJson, TradLabel, Session
     )
 
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -195,13 +188,27 @@ def main(args):
     total_landmarks *= len(dic_patients)
 
 
+    # Renderers and networks are shared by every patient and every tooth
+    try:
+        session = Session(models_to_use, args.image_size, args.blur_radius, args.faces_per_pixel, DEVICE, batch_size=args.batch_size)
+    except Exception as e:
+        logger.error(f"Failed to initialize the rendering session: {e}")
+        sys.exit(1)
+
     for idx, (patient_id, patient_path) in enumerate(dic_patients.items()):
         logger.info(f"Processing patient {idx + 1}/{len(dic_patients)}: {patient_id}")
-        
+
+        try:
+            surface = session.LoadPatient(patient_path)
+        except Exception as e:
+            logger.error(f"Error loading surface of patient {patient_id}: {e}")
+            continue
+
+        V, F, RI = surface.V, surface.F, surface.RI
+
         for models_type in models_to_use.keys():
             try:
                 LABEL = dic_label[models_type]
-                sphere_radius = 0.2 if models_type == "O" else 0.3
 
                 logger.debug(f"Processing model type: {models_type}")
                 
@@ -209,116 +216,59 @@ def main(args):
                     group_data = {}
 
                     try:
-                        path_vtk = patient_path
-                        model = models_to_use[models_type]['Lower'] if jaw == 'Lower' else models_to_use[models_type]['Upper']
-                        camera_position = dic_cam[models_type]['L'] if jaw == 'Lower' else dic_cam[models_type]['U']
-                        
+                        labels = []
                         for label in lst_teeth:
+                            if surface.HasLabel(label):
+                                labels.append(label)
+                            else:
+                                logger.debug(f"Label {label} not found in surface")
+
+                        pred_all = None
+                        if labels:
                             try:
-                                logger.debug(f"Loading model for patient {patient_id}, label {label}, jaw {jaw}")
-                                
-                                phong_renderer, mask_renderer = GenPhongRenderer(
-                                    int(args.image_size), int(args.blur_radius), int(args.faces_per_pixel), DEVICE
-                                )
+                                # every tooth x every camera point at once, session.batch_size views per forward pass
+                                pred_all, pix_to_face_all = session.PredictTeeth(models_type, jaw, labels)
+                            except Exception as e:
+                                logger.warning(f"Batched prediction of jaw {jaw} failed ({e}), predicting tooth by tooth")
+                                if DEVICE.type == "cuda":
+                                    torch.cuda.empty_cache()
 
-                                agent = Agent(
-                                    renderer=phong_renderer,
-                                    renderer2=mask_renderer,
-                                    radius=sphere_radius,
-                                    camera_position=camera_position
-                                )
+                        for t, label in enumerate(labels):
+                            try:
+                                logger.debug(f"Processing patient {patient_id}, label {label}, jaw {jaw}")
 
-                                SURF = ReadSurf(path_vtk)
-                                surf_unit, mean_arr, scale_factor = ScaleSurf(SURF)
-                                (V, F, CN, RI) = GetSurfProp(surf_unit, mean_arr, scale_factor)
+                                if pred_all is not None:
+                                    pred, pix_to_face = pred_all[t], pix_to_face_all[t]
+                                else:
+                                    pred, pix_to_face = (x[0] for x in session.PredictTeeth(models_type, jaw, [label]))
 
-                                if int(label) in RI.squeeze(0):
-                                    agent.position_agent(RI, V, label)
-                                    textures = TexturesVertex(verts_features=CN)
-                                    meshe = Meshes(verts=V, faces=F, textures=textures).to(DEVICE)
+                                centroids = LandmarkCentroids(
+                                    pred, pix_to_face, F, V, RI, int(label), n_classes=4
+                                )
 
-                                    try:
-                                        images_model, tens_pix_to_face_model = agent.get_view_rasterize(meshe)
-                                        tens_pix_to_face_model = tens_pix_to_face_model.permute(1, 0, 4, 2, 3)
-
-                                        net = UNet(
-                                            spatial_dims=2,
-                                            in_channels=4,
-                                            out_channels=4,
-                                            channels=(16, 32, 64, 128, 256, 512),
-                                            strides=(2, 2, 2, 2, 2),
-                                            num_res_units=4
-                                        ).to(DEVICE)
-
-                                        inputs = torch.cat([batch.to(DEVICE) for batch in images_model], dim=0).float()
-                                        net.load_state_dict(torch.load(model, map_location=DEVICE))
-                                        images_pred = net(inputs)
-
-                                        post_pred = AsDiscrete(argmax=True, to_onehot=4)
-
-                                        val_pred = torch.empty((0)).to(DEVICE)
-                                        for image in images_pred:
-                                            val_pred = torch.cat((val_pred, post_pred(image).unsqueeze(0).to(DEVICE)), dim=0)
-
-                                        pred_data = images_pred.detach().cpu().unsqueeze(0).type(torch.int16)
-                                        pred_data = torch.argmax(pred_data, dim=2).unsqueeze(2)
-
-                                        # recover where there is the landmark in the image
-                                        index_label_land_r = (pred_data == 1.).nonzero(as_tuple=False)
-                                        index_label_land_g = (pred_data == 2.).nonzero(as_tuple=False)
-                                        index_label_land_b = (pred_data == 3.).nonzero(as_tuple=False)
-
-                                        def collect_faces(index_list):
-                                            return [tens_pix_to_face_model[idx[0], idx[1], idx[2], idx[3], idx[4]] for idx in index_list]
-
-                                        # recover the face in my mesh
-                                        num_faces_r = collect_faces(index_label_land_r)
-                                        num_faces_g = collect_faces(index_label_land_g)
-                                        num_faces_b = collect_faces(index_label_land_b)
-
-                                        last_num_faces_r = RemoveExtraFaces(F, num_faces_r, RI, int(label))
-                                        last_num_faces_g = RemoveExtraFaces(F, num_faces_g, RI, int(label))
-                                        last_num_faces_b = RemoveExtraFaces(F, num_faces_b, RI, int(label))
-
-                                        dico_rgb = {}
-                                        if models_type == "O":
-                                            logger.debug(f"Processing Occlusal model, label: {LABEL[str(label)]}")
-                                            dico_rgb[LABEL[str(label)][MODELS_DICT['O']['O']]] = last_num_faces_r
-                                            dico_rgb[LABEL[str(label)][MODELS_DICT['O']['MB']]] = last_num_faces_g
-                                            dico_rgb[LABEL[str(label)][MODELS_DICT['O']['DB']]] = last_num_faces_b
+                                # class 1, 2, 3 of the prediction is the landmark 0, 1, 2 of the model
+                                dico_rgb = {
+                                    LABEL[str(label)][lm_idx]: lm_idx + 1
+                                    for lm_idx in MODELS_DICT[models_type].values()
+                                }
 
+                                for land_name, cls in dico_rgb.items():
+                                    logger.debug(f'Processing landmark: {land_name}')
+                                    try:
+                                        if cls in centroids:
+                                            landmark_pos = centroids[cls]
+                                            pid = surface.locator.FindClosestPoint(landmark_pos.cpu().numpy())
+                                            closest_pos = torch.tensor(surface.surf_unit.GetPoint(pid))
+                                            upscale_pos = Upscale(closest_pos, surface.mean_arr, surface.scale_factor)
+                                            final = upscale_pos.detach().cpu().numpy()
+                                            
+                                            group_data[land_name] = {"x": final[0], "y": final[1], "z": final[2]}
                                         else:
-                                            dico_rgb[LABEL[str(label)][MODELS_DICT['C']['CL']]] = last_num_faces_r
-                                            dico_rgb[LABEL[str(label)][MODELS_DICT['C']['CB']]] = last_num_faces_g
-
-                                        locator = vtk.vtkOctreePointLocator()
-                                        locator.SetDataSet(surf_unit)
-                                        locator.BuildLocator()
-
-                                        for land_name, face_ids in dico_rgb.items():
-                                            logger.debug(f'Processing landmark: {land_name}')
-                                            try:
-                                                all_verts = [int(F[0][int(face.item())][i].item()) for face in face_ids for i in range(3)]
-                                                if all_verts:
-                                                    vert_coord = sum(V[0][v] for v in all_verts)
-                                                    landmark_pos = vert_coord / len(all_verts)
-                                                    pid = locator.FindClosestPoint(landmark_pos.cpu().numpy())
-                                                    closest_pos = torch.tensor(surf_unit.GetPoint(pid))
-                                                    upscale_pos = Upscale(closest_pos, mean_arr, scale_factor)
-                                                    final = upscale_pos.detach().cpu().numpy()
-                                                    
-                                                    group_data[land_name] = {"x": final[0], "y": final[1], "z": final[2]}
-                                                else:
-                                                    logger.warning(f"No vertices found for landmark {land_name}")
-                                            except Exception as e:
-                                                logger.error(f"Error processing landmark {land_name}: {e}")
-                                                continue
+                                            logger.warning(f"No vertices found for landmark {land_name}")
                                     except Exception as e:
-                                        logger.error(f"Error during neural network inference for label {label}: {e}")
+                                        logger.error(f"Error processing landmark {land_name}: {e}")
                                         continue
-                                else:
-                                    logger.debug(f"Label {label} not found in surface")
-                                    
+
                             except Exception as e:
                                 logger.error(f"Error processing label {label} for patient {patient_id}: {e}")
                                 continue
@@ -363,6 +313,7 @@ if __name__ == "__main__":
         parser.add_argument("blur_radius", default="0", type=str, help="Blur radius for rendering")
         parser.add_argument("faces_per_pixel", default="1", type=str, help="Faces per pixel in rasterization")
         parser.add_argument("log_path", type=str, help="Path to log file")
+        parser.add_argument("--batch_size", default=0, type=int, help="Views per forward pass (0: from the free device memory)")
 
         args = parser.parse_args()
         
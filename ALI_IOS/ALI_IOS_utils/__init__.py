@@ -1,7 +1,7 @@
 from .render import GenPhongRenderer
 from .surface import (
     ReadSurf, ScaleSurf, ComputeNormals, GetColorArray,
-    GetSurfProp, RemoveExtraFaces, Upscale
+    GetSurfProp, RemoveExtraFaces, LandmarkCentroids, Upscale
 )
 from .model import (
     dic_cam, dic_label, LANDMARKS, LOWER_DENTAL,
@@ -9,4 +9,5 @@ from .model import (
 )
 from .io import GenControlPoint, WriteJson, TradLabel
 from .agent import Agent
-from .mask_renderer import MaskRenderer
\ No newline at end of file
+from .mask_renderer import MaskRenderer
+from .session import Session, PatientSurface
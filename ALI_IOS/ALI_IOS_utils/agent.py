@@ -129,40 +129,77 @@ class Agent:
             logger.error(f"Error in GetView: {e}")
             raise
 
-    def get_view_rasterize(self, meshes):
-        """Get rasterized view with error handling."""
-        try:
-            spc = self.positions
-            img_lst = torch.empty((0)).to(DEVICE)
-            tens_pix_to_face = torch.empty((0)).to(DEVICE)
+    def PositionAgents(self, text, vert, labels):
+        """Place one agent position on the centroid of each label of a single mesh.
 
-            for sp in self.camera_points:
-                try:
-                    sp_i = sp * self.radius
-                    current_cam_pos = spc + sp_i
-                    R = look_at_rotation(current_cam_pos, at=spc, device=DEVICE)
-                    T = -torch.bmm(R.transpose(1, 2), current_cam_pos[:, :, None])[:, :, 0]
+        Returns:
+            (len(labels), 3) positions, zeros for the labels absent from the mesh
+        """
+        try:
+            labels = torch.as_tensor([int(label) for label in labels], device=text.device)
+            onehot = (text[0].unsqueeze(0) == labels.unsqueeze(1)).to(vert.dtype)
+            counts = onehot.sum(dim=1, keepdim=True)
+            positions = (onehot.to(vert.device) @ vert[0]) / counts.to(vert.device).clamp(min=1)
+            self.positions = positions.to(DEVICE)
+            logger.debug(f"Agent positioned with shape: {self.positions.shape}")
+            return self.positions
+        except Exception as e:
+            logger.error(f"Error in PositionAgents: {e}")
+            raise
 
-                    renderer = self.renderer
-                    images = renderer(meshes_world=meshes.clone(), R=R, T=T.to(DEVICE))
-                    images = images.permute(0, 3, 1, 2)
-                    images = images[:, :-1, :, :]
-                    
-                    temp = renderer.rasterizer(meshes.clone())
-                    pix_to_face, zbuf = temp.pix_to_face, temp.zbuf
+    def GetViewBatch(self, meshes):
+        """Render every camera point around every agent position.
 
-                    zbuf = zbuf.permute(0, 3, 1, 2)
-                    y = torch.cat([images, zbuf], dim=1)
+        Each view is rasterized once: the renderer fragments give both the image
+        and pix_to_face. The mesh is extended once to the number of positions, so
+        all the teeth are rendered together for each camera point.
 
-                    img_lst = torch.cat((img_lst, y.unsqueeze(0)), dim=0)
-                    tens_pix_to_face = torch.cat((tens_pix_to_face, pix_to_face.unsqueeze(0)), dim=0)
-                except Exception as e:
-                    logger.error(f"Error in rasterization step: {e}")
-                    raise
-            
-            img_batch = img_lst.permute(1, 0, 2, 3, 4)
-            logger.debug(f"Rasterized view generated with shape: {img_batch.shape}")
+        Returns:
+            images (N positions, C cameras, 3 + faces_per_pixel, H, W)
+            pix_to_face (N positions, C cameras, H, W, faces_per_pixel), indices
+            of the faces of meshes, -1 on the background
+        """
+        try:
+            spc = self.positions
+            n_pos = spc.shape[0]
+            batch = meshes.extend(n_pos) if n_pos > 1 else meshes
+            # pix_to_face indexes the packed faces of the extended batch
+            face_offset = batch.mesh_to_faces_packed_first_idx().view(-1, 1, 1, 1)
+
+            renderer = self.renderer
+            img_batch = None
+            tens_pix_to_face = None
+
+            for c, sp in enumerate(self.camera_points):
+                sp_i = sp * self.radius
+                current_cam_pos = spc + sp_i
+                R = look_at_rotation(current_cam_pos, at=spc, device=DEVICE)
+                T = -torch.bmm(R.transpose(1, 2), current_cam_pos[:, :, None])[:, :, 0]
+
+                fragments = renderer.rasterizer(batch, R=R, T=T)
+                images = renderer.shader(fragments, batch, R=R, T=T)
+
+                if img_batch is None:
+                    _, H, W, K = fragments.pix_to_face.shape
+                    img_batch = torch.empty((n_pos, len(self.camera_points), 3 + K, H, W), dtype=torch.float32, device=DEVICE)
+                    tens_pix_to_face = torch.empty((n_pos, len(self.camera_points), H, W, K), dtype=torch.int64, device=DEVICE)
+
+                img_batch[:, c, :3] = images[..., :3].permute(0, 3, 1, 2)
+                img_batch[:, c, 3:] = fragments.zbuf.permute(0, 3, 1, 2)
+                pix_to_face = fragments.pix_to_face
+                tens_pix_to_face[:, c] = torch.where(pix_to_face >= 0, pix_to_face - face_offset, pix_to_face)
+
+            logger.debug(f"Rasterized views generated with shape: {img_batch.shape}")
             return img_batch, tens_pix_to_face
+        except Exception as e:
+            logger.error(f"Error in GetViewBatch: {e}")
+            raise
+
+    def get_view_rasterize(self, meshes):
+        """Get rasterized view with error handling."""
+        try:
+            img_batch, tens_pix_to_face = self.GetViewBatch(meshes)
+            return img_batch, tens_pix_to_face.permute(1, 0, 2, 3, 4)
         except Exception as e:
             logger.error(f"Error in get_view_rasterize: {e}")
-            raise
\ No newline at end of file
+            raise
@@ -0,0 +1,154 @@
+# Per-run cache of the networks, renderers and agents, and per-patient cache of the surface
+import logging
+import sys
+
+import torch
+import vtk
+from monai.networks.nets import UNet
+from pytorch3d.structures import Meshes
+from pytorch3d.renderer import TexturesVertex
+
+from ALI_IOS_utils.render import GenPhongRenderer
+from ALI_IOS_utils.surface import ReadSurf, ScaleSurf, GetSurfProp
+from ALI_IOS_utils.model import dic_cam
+from ALI_IOS_utils.agent import Agent
+
+# --- LOGGING CONFIGURATION ---
+logger = logging.getLogger("ALI_IOS_session")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+if logger.handlers:
+    logger.handlers.clear()
+console_handler = logging.StreamHandler(sys.stdout)
+console_handler.setLevel(logging.INFO)
+formatter = logging.Formatter('%(name)s - %(levelname)s - (%(filename)s:%(lineno)d) - %(message)s')
+console_handler.setFormatter(formatter)
+logger.addHandler(console_handler)
+
+
+# bytes of activations per pixel of a view in the UNet forward pass (no gradient), with margin
+VIEW_BYTES_PER_PIXEL = 1024
+# views per forward pass on CPU, or when the free GPU memory is unknown
+DEFAULT_CPU_BATCH_SIZE = 32
+
+
+def DefaultBatchSize(device, image_size, share=0.5):
+    """Number of views per forward pass fitting in share of the free memory of the device."""
+    if device.type != "cuda":
+        return DEFAULT_CPU_BATCH_SIZE
+    try:
+        free, _ = torch.cuda.mem_get_info(device)
+    except Exception:
+        return DEFAULT_CPU_BATCH_SIZE
+    return max(int(free * share // (int(image_size) ** 2 * VIEW_BYTES_PER_PIXEL)), 1)
+
+
+def JawKey(jaw):
+    return 'L' if jaw == 'Lower' else 'U'
+
+
+class PatientSurface:
+    """Surface of one patient, read, scaled and moved on the device once."""
+
+    def __init__(self, path, device) -> None:
+        self.path = path
+        surf = ReadSurf(path)
+        self.surf_unit, self.mean_arr, self.scale_factor = ScaleSurf(surf)
+        self.V, self.F, self.CN, self.RI = GetSurfProp(self.surf_unit, self.mean_arr, self.scale_factor)
+
+        textures = TexturesVertex(verts_features=self.CN)
+        self.meshe = Meshes(verts=self.V, faces=self.F, textures=textures).to(device)
+        self.labels = set(torch.unique(self.RI).tolist())
+
+        self.locator = vtk.vtkOctreePointLocator()
+        self.locator.SetDataSet(self.surf_unit)
+        self.locator.BuildLocator()
+
+    def HasLabel(self, label):
+        return int(label) in self.labels
+
+
+class Session:
+    """Everything that does not depend on the tooth, built once and reused for every label.
+
+    The renderers are created once per run, each (model type, jaw) UNet is loaded
+    once per run and the surface is parsed once per patient.
+    """
+
+    def __init__(self, models_to_use, image_size, blur_radius, faces_per_pixel, device, batch_size=None) -> None:
+        """
+        Args:
+            models_to_use : {model type: {'Lower': checkpoint path, 'Upper': checkpoint path}}
+            batch_size : maximum number of views per forward pass, derived from the free
+                device memory when None or 0 (see DefaultBatchSize)
+        """
+        self.models_to_use = models_to_use
+        self.device = device
+        self.batch_size = batch_size if batch_size else DefaultBatchSize(device, image_size)
+        logger.info(f"Up to {self.batch_size} views per forward pass on {device}")
+        self.phong_renderer, self.mask_renderer = GenPhongRenderer(
+            int(image_size), int(blur_radius), int(faces_per_pixel), device
+        )
+        self.nets = {}
+        self.agents = {}
+        self.surface = None
+
+    def GetNet(self, models_type, jaw):
+        """UNet of (models_type, jaw), loaded on the first call."""
+        key = (models_type, jaw)
+        if key not in self.nets:
+            model_path = self.models_to_use[models_type][jaw]
+            logger.info(f"Loading model {models_type} {jaw}: {model_path}")
+            net = UNet(
+                spatial_dims=2,
+                in_channels=4,
+                out_channels=4,
+                channels=(16, 32, 64, 128, 256, 512),
+                strides=(2, 2, 2, 2, 2),
+                num_res_units=4
+            ).to(self.device)
+            net.load_state_dict(torch.load(model_path, map_location=self.device))
+            net.eval()
+            self.nets[key] = net
+        return self.nets[key]
+
+    def GetAgent(self, models_type, jaw):
+        """Agent of (models_type, jaw), sharing the session renderers."""
+        key = (models_type, jaw)
+        if key not in self.agents:
+            self.agents[key] = Agent(
+                renderer=self.phong_renderer,
+                renderer2=self.mask_renderer,
+                radius=0.2 if models_type == "O" else 0.3,
+                camera_position=dic_cam[models_type][JawKey(jaw)]
+            )
+        return self.agents[key]
+
+    def LoadPatient(self, path):
+        """Parse the surface of a patient, replacing the previous one."""
+        self.surface = None
+        self.surface = PatientSurface(path, self.device)
+        return self.surface
+
+    def Predict(self, models_type, jaw, inputs):
+        """Run the (models_type, jaw) UNet on a stack of views (N, 4, H, W)."""
+        net = self.GetNet(models_type, jaw)
+        inputs = inputs.to(self.device).float()
+        with torch.no_grad():
+            if len(inputs) <= self.batch_size:
+                return net(inputs)
+            return torch.cat([net(chunk) for chunk in torch.split(inputs, self.batch_size)], dim=0)
+
+    def PredictTeeth(self, models_type, jaw, labels):
+        """Render every tooth of labels x every camera point of the current surface and segment the views.
+
+        Returns:
+            (class of each pixel (teeth, cameras, H, W), closest face under each pixel (teeth, cameras, H, W))
+        """
+        agent = self.GetAgent(models_type, jaw)
+        agent.PositionAgents(self.surface.RI, self.surface.V, labels)
+        images, pix_to_face = agent.GetViewBatch(self.surface.meshe)
+        n_teeth, n_cams = images.shape[:2]
+
+        pred = torch.argmax(self.Predict(models_type, jaw, images.flatten(0, 1)).type(torch.int16), dim=1)
+        return pred.view(n_teeth, n_cams, *pred.shape[1:]), pix_to_face[..., 0]
@@ -251,6 +251,46 @@ def RemoveExtraFaces(F, num_faces, RI, label):
         logger.error(f"Error removing extra faces: {e}")
         raise
 
+def LandmarkCentroids(pred, pix_to_face, F, V, RI, label, n_classes):
+    """Centroid of the faces of a tooth seen under each predicted class, without Python loops.
+
+    Args:
+        pred : (...) predicted class of every pixel of every view
+        pix_to_face : (...) face index under every pixel, same shape as pred, -1 on the background
+        F, V, RI : (1, F, 3) faces, (1, V, 3) vertices and (1, V) region ids of the mesh
+        label : region id of the tooth, faces with no vertex in the tooth are dropped
+        n_classes : number of classes of pred, class 0 is the background
+    Returns:
+        {class: (3,) mean position of the vertices of the kept faces}, with a face
+        counted once per pixel it covers
+    """
+    try:
+        device = V.device
+        pred = pred.to(device).reshape(-1)
+        pix_to_face = pix_to_face.to(device).reshape(-1)
+
+        selected = (pred > 0) & (pix_to_face >= 0)
+        classes = pred[selected].long()
+        faces = pix_to_face[selected].long()
+
+        face_verts = F[0].to(device)[faces]
+        keep = (RI[0].to(device)[face_verts] == int(label)).any(dim=1)
+        classes = classes[keep]
+        face_centers = V[0][face_verts[keep]].mean(dim=1)
+
+        sums = torch.zeros((n_classes, 3), dtype=V.dtype, device=device).index_add_(0, classes, face_centers)
+        counts = torch.bincount(classes, minlength=n_classes)
+
+        centroids = {}
+        for cls in range(1, n_classes):
+            if counts[cls] > 0:
+                centroids[cls] = sums[cls] / counts[cls]
+        logger.debug(f"Kept {int(keep.sum())} out of {len(faces)} faces for label {label}")
+        return centroids
+    except Exception as e:
+        logger.error(f"Error computing landmark centroids: {e}")
+        raise
+
 def Upscale(landmark_pos, mean_arr, scale_factor):
     """Upscale landmark position with error handling."""
     try:
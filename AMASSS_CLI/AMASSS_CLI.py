@@ -3,9 +3,9 @@
 AMASSS_CLI.py – Adaptation for nnUNet v2 (MAX, MAND, CB)
 """
 import argparse
-import time, os, sys, glob, subprocess, shutil
+import time, os, sys, shutil
 import numpy as np
-import torch, itk, cc3d, dicom2nifti
+import torch, itk, dicom2nifti
 import SimpleITK as sitk
 import vtk
 import re
@@ -28,6 +28,19 @@ formatter = logging.Formatter('%(name)s - %(levelname)s - (%(filename)s:%(lineno
 console_handler.setFormatter(formatter)
 logger.addHandler(console_handler)
 
+# --- DYNAMIC IMPORTS ---
+try:
+    # Add parent directory to sys.path for local imports
+    sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+    from AMASSS_CLI_utils import (
+        NNUNetEngine, FindModels, FormatTimings, ScanCache, RunWorker,
+        LabelMeshes,
+    )
+except ImportError as e:
+    logger.error(f"Failed to import required modules: {e}")
+    sys.exit(1)
+
 
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -49,59 +62,34 @@ for g,d in LABELS.items():
     for k,v in d.items():
         NAMES_FROM_LABELS[g][v] = k
 
-def wait_for_stable_output(process, output_path, timeout_s=900, poll_s=1.0, stable_checks=3, min_size_bytes=262144):
-    """Wait until process exits or output file exists with stable, significant size."""
-    start_t = time.time()
-    last_size = -1
-    stable_count = 0
+def PredictWithSubprocess(volume_file, case_id, nnunet_models, tmp, callback=None):
+    """Fallback prediction with the nnUNetv2_predict CLI, when nnunetv2 can't be imported in-process.
 
-    while True:
-        rc = process.poll()
+    The volume is copied once in tmp with the nnUNet naming, then each structure is
+    predicted by its own nnUNetv2_predict process (see predict_worker); an output is
+    only read once its process has exited.
+    """
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    input_dir = os.path.join(tmp, "input")
+    os.makedirs(input_dir, exist_ok=True)
+    shutil.copy(volume_file, os.path.join(input_dir, f"p_{case_id}_0000.nii.gz"))
 
-        if os.path.isfile(output_path):
-            try:
-                cur_size = os.path.getsize(output_path)
-            except OSError:
-                cur_size = -1
+    prediction_segmentation = {}
+    for struct_idx, (struct, plans_dir) in enumerate(nnunet_models.items(), start=1):
+        outp = os.path.join(tmp, f"pred_{struct}")
+        os.makedirs(outp, exist_ok=True)
+        nifti_pred = os.path.join(outp, f"p_{case_id}.nii.gz")
 
-            if cur_size >= min_size_bytes:
-                if cur_size == last_size:
-                    stable_count += 1
-                else:
-                    stable_count = 1
-                    last_size = cur_size
+        logger.info(f"Predicting {struct} on device: {device}")
+        timings = RunWorker(input_dir, nifti_pred, plans_dir, device, timeout_s=3600)
+        logger.info(f"Prediction for {struct} completed ({FormatTimings(timings)})")
 
-                if stable_count >= stable_checks:
-                    logger.info(
-                        f"Stable output detected ({cur_size} bytes) at {output_path}"
-                    )
-                    return True
-            else:
-                stable_count = 0
-                last_size = cur_size
-
-        if rc is not None:
-            if rc != 0:
-                raise subprocess.CalledProcessError(rc, process.args)
-
-            if os.path.isfile(output_path):
-                try:
-                    final_size = os.path.getsize(output_path)
-                except OSError:
-                    final_size = -1
-                logger.info(
-                    f"Prediction process exited cleanly; output found ({final_size} bytes)"
-                )
-                return True
-
-            raise FileNotFoundError(f"Process exited but output file is missing: {output_path}")
-
-        if (time.time() - start_t) > timeout_s:
-            raise TimeoutError(
-                f"Timeout waiting for stable output file: {output_path}"
-            )
+        if callback is not None:
+            callback(struct_idx, struct)
 
-        time.sleep(poll_s)
+        arr = sitk.GetArrayFromImage(sitk.ReadImage(nifti_pred))
+        prediction_segmentation[struct] = (arr > 0).astype(np.uint8)
+    return prediction_segmentation
 
 MODELS_GROUP = {
     "LARGE":{
@@ -152,17 +140,23 @@ def Write(vtkdata, output_name):
         logger.error(f"Error writing VTK file {output_name}: {e}")
         raise
 
-def SavePredToVTK(file_path, temp_folder, smoothing, vtk_output_path, model_size="LARGE"):
-    """Save prediction to VTK with error handling."""
+def SavePredToVTK(file_path, smoothing, vtk_output_path, model_size="LARGE", seg_arr=None, geometry=None):
+    """Save prediction to VTK with error handling.
+
+    The labels are meshed in memory from seg_arr (read from file_path when not given)
+    with one discrete marching cubes pass.
+    """
     try:
-        if not os.path.exists(file_path):
-            logger.error(f"File not found: {file_path}")
-            raise FileNotFoundError(f"File does not exist: {file_path}")
-        
-        logger.debug(f"Converting prediction to VTK: {file_path}")
+        if seg_arr is None or geometry is None:
+            if not os.path.exists(file_path):
+                logger.error(f"File not found: {file_path}")
+                raise FileNotFoundError(f"File does not exist: {file_path}")
 
-        img = sitk.ReadImage(file_path)
-        arr = sitk.GetArrayFromImage(img)
+            img = sitk.ReadImage(file_path)
+            seg_arr = sitk.GetArrayFromImage(img)
+            geometry = {"spacing": img.GetSpacing(), "origin": img.GetOrigin()}
+
+        logger.debug(f"Converting prediction to VTK: {file_path}")
 
         base = os.path.basename(file_path)
         for ext in ('.nii.gz', '.nrrd.gz', '.nii', '.nrrd'):
@@ -187,53 +181,23 @@ def SavePredToVTK(file_path, temp_folder, smoothing, vtk_output_path, model_size
                 logger.error(f"Error writing VTK file: {e}")
                 raise
 
-        def mesh_from_nrrd(nrrd, iters, color_rgb):
-            try:
-                r = vtk.vtkNrrdReader()
-                r.SetFileName(nrrd)
-                r.Update()
-                dmc = vtk.vtkDiscreteMarchingCubes()
-                dmc.SetInputConnection(r.GetOutputPort())
-                dmc.GenerateValues(1, 1, 1)
-                s = vtk.vtkSmoothPolyDataFilter()
-                s.SetInputConnection(dmc.GetOutputPort())
-                s.SetNumberOfIterations(iters)
-                s.Update()
-                poly = s.GetOutput()
-                cols = vtk.vtkUnsignedCharArray()
-                cols.SetName("Colors")
-                cols.SetNumberOfComponents(3)
-                cols.SetNumberOfTuples(poly.GetNumberOfCells())
-                for i in range(poly.GetNumberOfCells()):
-                    cols.SetTuple(i, color_rgb)
-                poly.GetCellData().SetScalars(cols)
-                return poly
-            except Exception as e:
-                logger.error(f"Error creating mesh from NRRD: {e}")
-                raise
-
         # MODE MERGED
         if is_merged:
             logger.debug("Creating merged segmentation")
-            append = vtk.vtkAppendPolyData()
-            for label in sorted(np.unique(arr)):
+            colors = {}
+            for label in np.unique(seg_arr):
+                label = int(label)
                 if label == 0:
                     continue
-                try:
-                    struct = NAMES_FROM_LABELS[model_size][label]
-
-                    tmp_nrrd = os.path.join(temp_folder, f"temp.nrrd")
-                    mask = (arr == label).astype(np.uint8)
-                    img2 = sitk.GetImageFromArray(mask)
-                    img2.CopyInformation(img)
-                    sitk.WriteImage(img2, tmp_nrrd)
-                    color = LABEL_COLORS.get(label, [255, 255, 255])
-                    mesh = mesh_from_nrrd(tmp_nrrd, smoothing, color)
-                    append.AddInputData(mesh)
-                except Exception as e:
-                    logger.warning(f"Error processing label {label}: {e}")
+                if label not in NAMES_FROM_LABELS[model_size]:
+                    logger.warning(f"Error processing label {label}: unknown label")
                     continue
-            
+                colors[label] = LABEL_COLORS.get(label, [255, 255, 255])
+
+            meshes = LabelMeshes(seg_arr, geometry["spacing"], geometry["origin"], colors, smoothing)
+            append = vtk.vtkAppendPolyData()
+            for label in sorted(meshes):
+                append.AddInputData(meshes[label])
             append.Update()
             merged_poly = append.GetOutput()
 
@@ -251,16 +215,12 @@ def SavePredToVTK(file_path, temp_folder, smoothing, vtk_output_path, model_size
         logger.debug("Creating separate segmentation")
         struct = base.split('_')[-1]
 
-        tmp_nrrd = os.path.join(temp_folder, f"temp.nrrd")
-        m = (arr > 0).astype(np.uint8)
-        i2 = sitk.GetImageFromArray(m)
-        i2.CopyInformation(img)
-        sitk.WriteImage(i2, tmp_nrrd)
-
         label_index = LABELS[model_size][struct]
         color = LABEL_COLORS.get(label_index, [255, 255, 255])
 
-        poly = mesh_from_nrrd(tmp_nrrd, smoothing, color)
+        m = (seg_arr > 0).astype(np.uint8)
+        meshes = LabelMeshes(m, geometry["spacing"], geometry["origin"], {1: color}, smoothing)
+        poly = meshes.get(1, vtk.vtkPolyData())
         outname = f"{base}.vtk"
         outvtk = os.path.join(vtk_output_path, outname) if output_is_dir else os.path.join(os.path.dirname(vtk_output_path), outname)
         write_poly(poly, outvtk)
@@ -316,86 +276,6 @@ def SetSpacingFromRef(filepath, refFile, interpolator="NearestNeighbor", outpath
         logger.error(f"Error setting spacing: {e}")
         raise
 
-def CleanArray(seg_arr, radius):
-    """Clean segmentation array using morphological operations with error handling."""
-    try:
-        if seg_arr is None:
-            logger.error("Input segmentation array is None")
-            raise ValueError("Segmentation array is None")
-        
-        if seg_arr.size == 0:
-            logger.error("Input segmentation array is empty")
-            raise ValueError("Segmentation array is empty")
-        
-        logger.debug(f"Cleaning array with radius: {radius}")
-        
-        try:
-            img = sitk.GetImageFromArray(seg_arr.astype(np.uint8))
-            logger.debug("Converted array to SimpleITK image")
-        except Exception as e:
-            logger.error(f"Error converting array to SimpleITK image: {e}")
-            raise
-        
-        try:
-            img = sitk.BinaryDilate(img, [radius]*3)
-            logger.debug("Completed binary dilation")
-        except Exception as e:
-            logger.error(f"Error during binary dilation: {e}")
-            raise
-        
-        try:
-            img = sitk.BinaryFillhole(img)
-            logger.debug("Completed binary fill hole")
-        except Exception as e:
-            logger.error(f"Error during binary fill hole: {e}")
-            raise
-        
-        try:
-            img = sitk.BinaryErode(img, [radius]*3)
-            logger.debug("Completed binary erosion")
-        except Exception as e:
-            logger.error(f"Error during binary erosion: {e}")
-            raise
-        
-        try:
-            arr = sitk.GetArrayFromImage(img)
-            logger.debug("Converted SimpleITK image back to array")
-        except Exception as e:
-            logger.error(f"Error converting SimpleITK image to array: {e}")
-            raise
-        
-        try:
-            cc, n = cc3d.connected_components(arr, return_N=True)
-            logger.debug(f"Found {n} connected components")
-            
-            if n > 1:
-                sizes = [(cc==i).sum() for i in range(1, n+1)]
-                max_idx = int(np.argmax(sizes))
-                arr = (cc == (1 + max_idx)).astype(np.uint8)
-                logger.debug(f"Selected largest connected component with {sizes[max_idx]} voxels")
-        except Exception as e:
-            logger.error(f"Error during connected components analysis: {e}")
-            raise
-        
-        logger.debug("Array cleaning completed successfully")
-        return arr
-    except Exception as e:
-        logger.error(f"Error in CleanArray: {e}")
-        raise
-
-def CropSkin(skin_seg_arr,thickness):
-    img = sitk.GetImageFromArray(skin_seg_arr.astype(np.uint8))
-    fill = sitk.BinaryFillhole(img)
-    ero = sitk.BinaryErode(fill,[thickness]*3)
-    arr = sitk.GetArrayFromImage(fill)
-    earr = sitk.GetArrayFromImage(ero)
-    crop = np.where(earr==1,0,arr)
-    cc, n = cc3d.connected_components(crop,return_N=True)
-    if n>1:
-        sizes=[(cc==i).sum() for i in range(1,n+1)]
-        crop=(cc==(1+int(np.argmax(sizes)))).astype(np.uint8)
-    return crop
-
 def SavePrediction(img,ref_filepath,outpath,output_spacing):
     ref = sitk.ReadImage(ref_filepath)
     out = sitk.GetImageFromArray(img.astype(np.int16))
@@ -404,11 +284,54 @@ def SavePrediction(img,ref_filepath,outpath,output_spacing):
     out.SetOrigin(ref.GetOrigin())
     sitk.WriteImage(out, outpath)
 
-def SaveSeg(file_path, spacing, seg_arr, input_path, temp_path, outputdir, temp_folder, save_vtk, smoothing=5, model_size="LARGE"):
-    """Save segmentation with error handling for prediction, spacing correction, and VTK conversion."""
+def SaveSeg(file_path, spacing, seg_arr, input_path, temp_path, outputdir, save_vtk, smoothing=5, model_size="LARGE", cache=None):
+    """Save segmentation with error handling for prediction, spacing correction, and VTK conversion.
+
+    When the ScanCache of the input is given and the mask already has the input size,
+    the mask is written directly with the cached geometry instead of going through
+    temp_path and reading the reference volume back.
+    """
     try:
         logger.debug(f"Saving segmentation for: {file_path}")
-        
+
+        # the mask can be meshed from memory only when it is written in the input geometry
+        in_memory = cache is not None and tuple(seg_arr.shape[::-1]) == tuple(cache.geometry["size"])
+        if in_memory:
+            try:
+                out = cache.ImageFromArray(seg_arr.astype(np.int16))
+                sitk.WriteImage(out, file_path)
+                logger.info(f"Segmentation saved with reference geometry to: {file_path}")
+            except Exception as e:
+                logger.error(f"Error saving prediction: {e}")
+                raise
+        else:
+            SaveSegFromRef(file_path, spacing, seg_arr, input_path, temp_path)
+
+        # Save VTK mesh if requested
+        if save_vtk:
+            try:
+                logger.debug(f"Converting to VTK with smoothing: {smoothing}")
+                if in_memory:
+                    SavePredToVTK(
+                        file_path, smoothing, vtk_output_path=outputdir,
+                        model_size=model_size, seg_arr=seg_arr, geometry=cache.geometry,
+                    )
+                else:
+                    # SaveSegFromRef resampled the mask: mesh what was written
+                    SavePredToVTK(file_path, smoothing, vtk_output_path=outputdir, model_size=model_size)
+                logger.info("VTK mesh saved successfully")
+            except Exception as e:
+                logger.error(f"Error saving VTK mesh: {e}")
+                raise
+
+        logger.info(f"Segmentation saving completed successfully for: {file_path}")
+    except Exception as e:
+        logger.error(f"Error in SaveSeg: {e}")
+        raise
+
+def SaveSegFromRef(file_path, spacing, seg_arr, input_path, temp_path):
+    """Save a mask through temp_path and resample it on the reference volume read from input_path."""
+    try:
         # Step 1: Save prediction
         try:
             logger.debug(f"Step 1: Saving prediction with spacing {spacing}")
@@ -430,20 +353,8 @@ def SaveSeg(file_path, spacing, seg_arr, input_path, temp_path, outputdir, temp_
         except Exception as e:
             logger.error(f"Error setting spacing: {e}")
             raise
-        
-        # Step 3: Save VTK mesh if requested
-        if save_vtk:
-            try:
-                logger.debug(f"Step 3: Converting to VTK with smoothing: {smoothing}")
-                SavePredToVTK(file_path, temp_folder, smoothing, vtk_output_path=outputdir)
-                logger.info("VTK mesh saved successfully")
-            except Exception as e:
-                logger.error(f"Error saving VTK mesh: {e}")
-                raise
-        
-        logger.info(f"Segmentation saving completed successfully for: {file_path}")
     except Exception as e:
-        logger.error(f"Error in SaveSeg: {e}")
+        logger.error(f"Error in SaveSegFromRef: {e}")
         raise
 # -- Main adapt for nnUNet v2 ---
 def main(args):
@@ -503,6 +414,24 @@ def main(args):
             logger.error(f"Error during input file discovery: {e}")
             raise
 
+        # ===== MODEL LOADING PHASE =====
+        try:
+            logger.debug("Searching for nnUNet models")
+            nnunet_models = FindModels(args["modelDirectory"], args["skullStructure"].split(","))
+            if not nnunet_models:
+                logger.error("No models found for any structure")
+                raise FileNotFoundError("No nnUNet models found for specified structures")
+            logger.info(f"Found {len(nnunet_models)} models to process")
+
+            try:
+                engine = NNUNetEngine(nnunet_models, device=DEVICE)
+            except ImportError as e:
+                logger.warning(f"nnunetv2 can't be imported in-process ({e}); falling back to nnUNetv2_predict")
+                engine = None
+        except Exception as e:
+            logger.error(f"Error during model loading: {e}")
+            raise
+
         start_time = time.time()
         print("<filter-start><filter-name>AMASSS</filter-name></filter-start>", flush=True)
         sys.stdout.flush()
@@ -541,167 +470,41 @@ def main(args):
                     logger.error(f"Error creating output directory: {e}")
                     raise
 
-                # --- INPUT FILE COPY ---
-                try:
-                    tmp_name = f"p_{case_id}_0000.nii.gz"
-                    input_vol = os.path.join(tmp, tmp_name)
-                    shutil.copy(volume_file, input_vol)
-                    logger.debug(f"Input volume copied to: {input_vol}")
-                except Exception as e:
-                    logger.error(f"Error copying input volume: {e}")
-                    raise
-
-                # --- MODEL DISCOVERY ---
-                try:
-                    logger.debug("Searching for nnUNet models")
-                    nnunet_models = {}
-                    for struct in args["skullStructure"].split(","):
-                        try:
-                            root = os.path.join(args["modelDirectory"], struct)
-                            if not os.path.exists(root):
-                                logger.warning(f"Model directory not found for structure {struct}: {root}")
-                                continue
-                            
-                            pattern = os.path.join(root, "**", "*__nnUNetPlans__3d_fullres")
-                            plans = glob.glob(pattern, recursive=True)
-                            if plans:
-                                nnunet_models[struct] = plans[0]
-                                logger.debug(f"Found model for {struct}: {plans[0]}")
-                            else:
-                                logger.warning(f"No model found for structure {struct}")
-                        except Exception as e:
-                            logger.warning(f"Error searching model for {struct}: {e}")
-                            continue
-                    
-                    if not nnunet_models:
-                        logger.error("No models found for any structure")
-                        raise FileNotFoundError("No nnUNet models found for specified structures")
-                    
-                    logger.info(f"Found {len(nnunet_models)} models to process")
-                except Exception as e:
-                    logger.error(f"Error during model discovery: {e}")
-                    raise
-
-                # --- PREDICTIONS LOOP ---
+                # --- PREDICTIONS ---
                 total_struct = len(nnunet_models)
                 total_steps = scan_count * total_struct
-                prediction_segmentation = {}
 
-                logger.debug("Starting predictions for all structures")
-                
-                for struct_idx, (struct, plans_dir) in enumerate(nnunet_models.items(), start=1):
-                    struct_context = f"structure {struct_idx}/{total_struct}: {struct}"
-                    logger.info(f"Processing {struct_context}")
-                    
+                def report_progress(struct_idx, struct):
                     try:
-                        # Setup nnUNet environment
-                        try:
-                            dataset_name = os.path.basename(os.path.dirname(plans_dir))
-                            os.environ['nnUNet_results'] = os.path.dirname(os.path.dirname(plans_dir))
-                            outp = os.path.join(tmp, f"pred_{struct}")
-                            os.makedirs(outp, exist_ok=True)
-                            logger.debug(f"nnUNet output directory: {outp}")
-                        except Exception as e:
-                            logger.error(f"Error setting up nnUNet environment: {e}")
-                            raise
-
-                        # Find checkpoint
-                        try:
-                            checkpoint = os.path.join(plans_dir, "fold_0", "checkpoint_final.pth")
-                            if not os.path.isfile(checkpoint):
-                                logger.error(f"Checkpoint not found for {struct}: {checkpoint}")
-                                raise FileNotFoundError(f"Model checkpoint not found: {checkpoint}")
-                            logger.debug(f"Checkpoint found: {checkpoint}")
-                        except Exception as e:
-                            logger.error(f"Error locating checkpoint: {e}")
-                            raise
-
-                        # Run nnUNet prediction
-                        try:
-                            if torch.cuda.is_available():
-                                device = "cuda"
-                            else:
-                                device = "cpu"
-                                
-                            logger.info(f"Predicting {struct} on device: {device}")
-                            
-                            cmd = [
-                                "nnUNetv2_predict",
-                                "-i", tmp,
-                                "-o", outp,
-                                "-d", dataset_name,
-                                "-c", "3d_fullres",
-                                "-f", "0",
-                                "-device", device,
-                                "--disable_tta",
-                            ]
-                            print(cmd)
-
-                            nifti_pred = os.path.join(outp, f"p_{case_id}.nii.gz")
-
-                            # Start prediction and keep checking output stability to avoid waiting only on process signal.
-                            proc = subprocess.Popen(cmd, stdout=None, stderr=None, close_fds=True)
-                            wait_for_stable_output(
-                                proc,
-                                nifti_pred,
-                                timeout_s=3600,
-                                poll_s=1.0,
-                                stable_checks=3,
-                                min_size_bytes=100,
-                            )
-
-                            if proc.poll() is None:
-                                logger.info("Stable output reached before process exit; stopping predictor process")
-                                proc.terminate()
-                                try:
-                                    proc.wait(timeout=5)
-                                except subprocess.TimeoutExpired:
-                                    proc.kill()
-                                    proc.wait(timeout=5)
-
-                            logger.info(f"Prediction for {struct} completed")
-                        except subprocess.CalledProcessError as e:
-                            logger.error(f"nnUNet prediction failed for {struct}: {e}")
-                            raise
-                        except Exception as e:
-                            logger.error(f"Error executing nnUNet prediction: {e}")
-                            raise
+                        step = (scan_idx - 1) * total_struct + struct_idx
+                        fraction = step / total_steps
+                        print(f"<filter-progress>{fraction:.4f}</filter-progress>", flush=True)
+                        sys.stdout.flush()
+                        logger.debug(f"Progress: {fraction:.4f}")
+                    except Exception as e:
+                        logger.warning(f"Error reporting progress: {e}")
 
-                        # Report progress
-                        try:
-                            step = (scan_idx - 1) * total_struct + struct_idx
-                            fraction = step / total_steps
-                            print(f"<filter-progress>{fraction:.4f}</filter-progress>", flush=True)
-                            sys.stdout.flush()
-                            logger.debug(f"Progress: {fraction:.4f}")
-                        except Exception as e:
-                            logger.warning(f"Error reporting progress: {e}")
+                # one decoded/preprocessed copy of the scan shared by every structure
+                cache = ScanCache(volume_file)
 
-                        # Load prediction
-                        try:
-                            if not os.path.isfile(nifti_pred):
-                                logger.error(f"Prediction output not found: {nifti_pred}")
-                                raise FileNotFoundError(f"nnUNet output file not found: {nifti_pred}")
-                            
-                            img = sitk.ReadImage(nifti_pred)
-                            arr = sitk.GetArrayFromImage(img)
-                            mask = (arr > 0).astype(np.uint8)
-                            prediction_segmentation[struct] = mask
-                            logger.debug(f"Loaded prediction mask for {struct}")
-                        except Exception as e:
-                            logger.error(f"Error loading prediction for {struct}: {e}")
-                            raise
-                    
-                    except Exception as e:
-                        logger.error(f"Error processing {struct_context}: {e}")
-                        raise
+                try:
+                    if engine is not None:
+                        logger.debug("Starting in-process predictions for all structures")
+                        prediction_segmentation = engine.Predict(cache, callback=report_progress)
+                    else:
+                        prediction_segmentation = PredictWithSubprocess(
+                            volume_file, case_id, nnunet_models, tmp, callback=report_progress
+                        )
+                except Exception as e:
+                    logger.error(f"Error during predictions for {scan_context}: {e}")
+                    raise
 
                 # --- SEGMENTATION SAVING PHASE ---
                 try:
                     logger.debug("Starting segmentation saving")
                     
                     try:
-                        spacing = list(sitk.ReadImage(volume_file).GetSpacing())
+                        spacing = list(cache.geometry["spacing"])
                         logger.debug(f"Image spacing: {spacing}")
                     except Exception as e:
                         logger.error(f"Error reading image spacing: {e}")
@@ -717,7 +520,8 @@ def main(args):
                                     SaveSeg(
                                         outfn, spacing, mask, volume_file,
                                         os.path.join(tmp, "tmp.nii.gz"),
-                                        outdir, tmp, args["genVtk"], args["vtk_smooth"], "LARGE"
+                                        outdir, args["genVtk"], args["vtk_smooth"], "LARGE",
+                                        cache=cache,
                                     )
                                     logger.info(f"Saved segmentation for {struct}")
                                 except Exception as e:
@@ -745,7 +549,8 @@ def main(args):
                             SaveSeg(
                                 outfn, spacing, merged, volume_file,
                                 os.path.join(tmp, "tmp.nii.gz"),
-                                outdir, tmp, args["genVtk"], args["vtk_smooth"], "LARGE"
+                                outdir, args["genVtk"], args["vtk_smooth"], "LARGE",
+                                cache=cache,
                             )
                             logger.info("Merged segmentation saved")
                         except Exception as e:
@@ -759,6 +564,7 @@ def main(args):
 
                 # --- CLEANUP ---
                 try:
+                    cache.Evict()
                     shutil.rmtree(tmp, ignore_errors=True)
                     os.makedirs(tmp, exist_ok=True)
                     logger.debug("Temporary files cleaned up")
@@ -777,6 +583,9 @@ def main(args):
                 else:
                     raise
 
+        if engine is not None:
+            engine.Release()
+
         # --- FINAL REPORT ---
         try:
             elapsed = time.time() - start_time
@@ -0,0 +1,5 @@
+from .predictor import NNUNetEngine, FindModels, FormatTimings, ReadNNUNetInput, CHECKPOINT_NAME, WHOLE_PREDICTION
+from .cache import ScanCache
+from .predict_worker import RunWorker
+from .cleanup import CleanMask, SkinShell, KeepLargestComponent, BoundingBox
+from .mesh import LabelMeshes, ArrayToVTKImage, ColorCells
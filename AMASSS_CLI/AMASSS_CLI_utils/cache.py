@@ -0,0 +1,138 @@
+import SimpleITK as sitk
+
+from AMASSS_CLI_utils.predictor import ReadNNUNetInput
+
+import logging
+import sys
+# --- LOGGING CONFIGURATION ---
+logger = logging.getLogger("AMASSS_CLI_cache")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+if logger.handlers:
+    logger.handlers.clear()
+console_handler = logging.StreamHandler(sys.stdout)
+console_handler.setLevel(logging.INFO)
+formatter = logging.Formatter('%(name)s - %(levelname)s - (%(filename)s:%(lineno)d) - %(message)s')
+console_handler.setFormatter(formatter)
+logger.addHandler(console_handler)
+
+
+def _Nbytes(value):
+    """Size in bytes of the arrays/tensors held in a cache entry."""
+    if isinstance(value, (tuple, list)):
+        return sum(_Nbytes(v) for v in value)
+    if hasattr(value, "nbytes"):
+        return int(value.nbytes)
+    if hasattr(value, "element_size") and hasattr(value, "nelement"):
+        return int(value.element_size() * value.nelement())
+    return 0
+
+
+class ScanCache:
+    """Preprocess once, predict many: per-scan cache shared by every structure model.
+
+    The volume is decoded once, each distinct preprocessing configuration is run
+    once, and the reference geometry used to save the masks is kept so the input
+    never has to be read back from disk. Use it as a context manager so that
+    everything is evicted when the scan is finished.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._input = None
+        self._geometry = None
+        self._preprocessed = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.peak_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.Evict()
+        return False
+
+    @property
+    def nbytes(self):
+        total = _Nbytes(self._input[0]) if self._input is not None else 0
+        return total + sum(_Nbytes(v) for v in self._preprocessed.values())
+
+    def _Track(self):
+        self.peak_bytes = max(self.peak_bytes, self.nbytes)
+
+    def GetInput(self):
+        """Decoded (1, z, y, x) float32 volume and its nnUNet properties."""
+        if self._input is None:
+            self.misses += 1
+            self._input = ReadNNUNetInput(self.filepath)
+            self._Track()
+            logger.debug(f"Decoded {self.filepath}")
+        else:
+            self.hits += 1
+        return self._input
+
+    @property
+    def geometry(self):
+        """Spacing, origin, direction and size of the scan, read from the header only if not decoded yet."""
+        if self._geometry is None:
+            if self._input is not None:
+                data, props = self._input
+                sitk_stuff = props["sitk_stuff"]
+                self._geometry = {
+                    "spacing": tuple(sitk_stuff["spacing"]),
+                    "origin": tuple(sitk_stuff["origin"]),
+                    "direction": tuple(sitk_stuff["direction"]),
+                    "size": tuple(int(s) for s in data.shape[1:][::-1]),
+                }
+            else:
+                reader = sitk.ImageFileReader()
+                reader.SetFileName(self.filepath)
+                reader.ReadImageInformation()
+                self._geometry = {
+                    "spacing": reader.GetSpacing(),
+                    "origin": reader.GetOrigin(),
+                    "direction": reader.GetDirection(),
+                    "size": reader.GetSize(),
+                }
+        return self._geometry
+
+    def GetPreprocessed(self, key, preprocess):
+        """Return the entry stored under key, computing it with preprocess(data, props) on a miss.
+
+        Models whose plans share the same resampling and normalization use the same
+        key, so the preprocessing only runs once for all of them.
+        """
+        if key in self._preprocessed:
+            self.hits += 1
+            return self._preprocessed[key]
+
+        data, props = self.GetInput()
+        self.misses += 1
+        value = preprocess(data, props)
+        self._preprocessed[key] = value
+        self._Track()
+        return value
+
+    def ImageFromArray(self, arr):
+        """Wrap an array in a SimpleITK image with the scan geometry."""
+        geometry = self.geometry
+        img = sitk.GetImageFromArray(arr)
+        img.SetSpacing(geometry["spacing"])
+        img.SetOrigin(geometry["origin"])
+        img.SetDirection(geometry["direction"])
+        return img
+
+    def Evict(self):
+        """Drop the decoded and preprocessed data and log the cache statistics."""
+        if self._input is not None or self._preprocessed:
+            logger.info(self.Report())
+        self._input = None
+        self._preprocessed.clear()
+
+    def Report(self):
+        return (
+            f"Scan cache for {self.filepath}: {self.hits} hit(s), {self.misses} miss(es), "
+            f"peak {self.peak_bytes / 1024 ** 2:.1f} MB"
+        )
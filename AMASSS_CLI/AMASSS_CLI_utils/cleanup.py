@@ -0,0 +1,83 @@
+import numpy as np
+import SimpleITK as sitk
+import cc3d
+
+import logging
+import sys
+# --- LOGGING CONFIGURATION ---
+logger = logging.getLogger("AMASSS_CLI_cleanup")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+if logger.handlers:
+    logger.handlers.clear()
+console_handler = logging.StreamHandler(sys.stdout)
+console_handler.setLevel(logging.INFO)
+formatter = logging.Formatter('%(name)s - %(levelname)s - (%(filename)s:%(lineno)d) - %(message)s')
+console_handler.setFormatter(formatter)
+logger.addHandler(console_handler)
+
+
+def BoundingBox(mask, margin=0):
+    """Slices of the bounding box of the non zero voxels grown by margin, or None if the mask is empty."""
+    slices = []
+    for axis in range(mask.ndim):
+        other_axes = tuple(a for a in range(mask.ndim) if a != axis)
+        nonzero = np.flatnonzero(mask.any(axis=other_axes))
+        if nonzero.size == 0:
+            return None
+        start = max(int(nonzero[0]) - margin, 0)
+        stop = min(int(nonzero[-1]) + 1 + margin, mask.shape[axis])
+        slices.append(slice(start, stop))
+    return tuple(slices)
+
+
+def KeepLargestComponent(mask):
+    """Keep the largest connected component, sizes computed in a single bincount pass."""
+    cc, n = cc3d.connected_components(mask, return_N=True)
+    if n <= 1:
+        return (cc > 0).astype(np.uint8)
+    sizes = np.bincount(cc.ravel(), minlength=n + 1)
+    sizes[0] = 0
+    return (cc == int(np.argmax(sizes))).astype(np.uint8)
+
+
+def _Closing(crop, radius):
+    img = sitk.GetImageFromArray(crop)
+    img = sitk.BinaryDilate(img, [radius] * 3)
+    img = sitk.BinaryFillhole(img)
+    img = sitk.BinaryErode(img, [radius] * 3)
+    return sitk.GetArrayFromImage(img)
+
+
+def _Shell(crop, thickness):
+    fill = sitk.BinaryFillhole(sitk.GetImageFromArray(crop))
+    ero = sitk.BinaryErode(fill, [thickness] * 3)
+    arr = sitk.GetArrayFromImage(fill)
+    earr = sitk.GetArrayFromImage(ero)
+    return np.where(earr == 1, 0, arr).astype(np.uint8)
+
+
+def _InBoundingBox(seg_arr, margin, operation):
+    """Apply operation on the bounding box of the mask only and paste the result back.
+
+    The margin keeps at least one background layer around everything the operation
+    can grow, so the crop gives the same result as the whole volume.
+    """
+    mask = (seg_arr > 0).astype(np.uint8)
+    box = BoundingBox(mask, margin)
+    out = np.zeros(mask.shape, dtype=np.uint8)
+    if box is None:
+        return out
+    out[box] = KeepLargestComponent(operation(np.ascontiguousarray(mask[box])))
+    return out
+
+
+def CleanMask(seg_arr, radius):
+    """Closing (dilate, fill holes, erode) then largest connected component."""
+    return _InBoundingBox(seg_arr, radius + 1, lambda crop: _Closing(crop, radius))
+
+
+def SkinShell(skin_seg_arr, thickness):
+    """Outer shell of thickness voxels of the filled skin, largest connected component."""
+    return _InBoundingBox(skin_seg_arr, 1, lambda crop: _Shell(crop, thickness))
+
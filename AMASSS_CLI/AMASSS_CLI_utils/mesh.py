@@ -0,0 +1,117 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import vtk
+from vtk.util.numpy_support import numpy_to_vtk
+
+from AMASSS_CLI_utils.cleanup import BoundingBox
+
+import logging
+import sys
+# --- LOGGING CONFIGURATION ---
+logger = logging.getLogger("AMASSS_CLI_mesh")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+if logger.handlers:
+    logger.handlers.clear()
+console_handler = logging.StreamHandler(sys.stdout)
+console_handler.setLevel(logging.INFO)
+formatter = logging.Formatter('%(name)s - %(levelname)s - (%(filename)s:%(lineno)d) - %(message)s')
+console_handler.setFormatter(formatter)
+logger.addHandler(console_handler)
+
+
+def ArrayToVTKImage(arr, spacing, origin):
+    """Wrap a contiguous (z, y, x) array in a vtkImageData without copying it.
+
+    The caller must keep arr alive as long as the image is used.
+    """
+    img = vtk.vtkImageData()
+    img.SetDimensions(arr.shape[2], arr.shape[1], arr.shape[0])
+    img.SetSpacing(spacing)
+    img.SetOrigin(origin)
+    scalars = numpy_to_vtk(arr.ravel(), deep=False)
+    scalars.SetName("labels")
+    img.GetPointData().SetScalars(scalars)
+    return img
+
+
+def ColorCells(poly, color_rgb):
+    """Give every cell of poly the same "Colors" scalar."""
+    colors = np.tile(np.asarray(color_rgb, dtype=np.uint8), (poly.GetNumberOfCells(), 1))
+    cols = numpy_to_vtk(colors, deep=True, array_type=vtk.VTK_UNSIGNED_CHAR)
+    cols.SetName("Colors")
+    poly.GetCellData().SetScalars(cols)
+    return poly
+
+
+def _ExtractLabel(contour, label):
+    threshold = vtk.vtkThreshold()
+    threshold.SetInputData(contour)
+    threshold.SetInputArrayToProcess(0, 0, 0, vtk.vtkDataObject.FIELD_ASSOCIATION_CELLS, vtk.vtkDataSetAttributes.SCALARS)
+    threshold.SetLowerThreshold(label)
+    threshold.SetUpperThreshold(label)
+    threshold.SetThresholdFunction(vtk.vtkThreshold.THRESHOLD_BETWEEN)
+    geometry = vtk.vtkGeometryFilter()
+    geometry.SetInputConnection(threshold.GetOutputPort())
+    geometry.Update()
+    return geometry.GetOutput()
+
+
+def _SmoothLabel(contour, label, iterations, color_rgb):
+    s = vtk.vtkSmoothPolyDataFilter()
+    s.SetInputData(_ExtractLabel(contour, label))
+    s.SetNumberOfIterations(iterations)
+    s.Update()
+    return ColorCells(s.GetOutput(), color_rgb)
+
+
+def LabelMeshes(arr, spacing, origin, colors, smoothing, max_workers=None):
+    """Mesh every label of a label map with a single discrete marching cubes pass.
+
+    Args:
+        arr : (z, y, x) label map
+        spacing, origin : (x, y, z) geometry of arr
+        colors : {label: [r, g, b]} of the labels to mesh
+        smoothing : number of smoothing iterations
+        max_workers : threads used to extract and smooth the labels
+    Returns:
+        {label: vtkPolyData} in physical coordinates
+    """
+    labels = [int(label) for label in colors]
+    box = BoundingBox(np.isin(arr, labels), margin=1)
+    if box is None:
+        return {}
+
+    # only mesh the bounding box, shifting the origin so the points stay in place
+    crop = np.ascontiguousarray(arr[box])
+    offset = [box[2].start, box[1].start, box[0].start]
+    crop_origin = [o + i * s for o, i, s in zip(origin, offset, spacing)]
+    img = ArrayToVTKImage(crop, spacing, crop_origin)
+
+    dmc = vtk.vtkDiscreteMarchingCubes()
+    dmc.SetInputData(img)
+    for i, label in enumerate(labels):
+        dmc.SetValue(i, label)
+    dmc.Update()
+    contour = dmc.GetOutput()
+    # build the lazy cells/links once here, the threads must only read the contour
+    contour.BuildCells()
+    contour.BuildLinks()
+
+    def _Input():
+        # each thread gets its own data object sharing the points and cells of the contour
+        copy = vtk.vtkPolyData()
+        copy.ShallowCopy(contour)
+        return copy
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {
+            label: pool.submit(_SmoothLabel, _Input(), label, smoothing, colors[label])
+            for label in labels
+        }
+        meshes = {label: future.result() for label, future in futures.items()}
+
+    # the vtkImageData points to crop's buffer
+    del img, crop
+    return {label: poly for label, poly in meshes.items() if poly.GetNumberOfCells() > 0}
@@ -0,0 +1,71 @@
+"""
+Out-of-process nnUNet prediction of one structure with the nnUNetv2_predict CLI.
+
+Used when nnunetv2 can't be imported in this interpreter: the CLI of the nnUNet
+installation is run in its own process and the prediction is read once that process
+has exited successfully, with no file size polling. The phases of nnUNetv2_predict
+can't be timed from outside of its process, the fallback only reports the whole
+prediction (WHOLE_PREDICTION); per-phase timings come from the in-process NNUNetEngine.
+"""
+import os
+import sys
+import time
+import subprocess
+
+from AMASSS_CLI_utils.predictor import WHOLE_PREDICTION
+
+import logging
+# --- LOGGING CONFIGURATION ---
+logger = logging.getLogger("AMASSS_CLI_worker")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+if logger.handlers:
+    logger.handlers.clear()
+console_handler = logging.StreamHandler(sys.stdout)
+console_handler.setLevel(logging.INFO)
+formatter = logging.Formatter('%(name)s - %(levelname)s - (%(filename)s:%(lineno)d) - %(message)s')
+console_handler.setFormatter(formatter)
+logger.addHandler(console_handler)
+
+
+def RunWorker(input_dir, output_path, plans_dir, device, timeout_s=3600):
+    """Predict one structure with nnUNetv2_predict and block until the process exits.
+
+    Args:
+        input_dir : folder holding the input volume, named p_<case_id>_0000.nii.gz
+        output_path : segmentation written by nnUNetv2_predict, <output folder>/p_<case_id>.nii.gz
+        plans_dir : *__nnUNetPlans__3d_fullres folder of the model
+    Returns:
+        {WHOLE_PREDICTION: seconds}
+    Raises:
+        subprocess.CalledProcessError if nnUNetv2_predict fails
+        TimeoutError if it does not finish within timeout_s
+        FileNotFoundError if it exits without writing output_path
+    """
+    dataset_name = os.path.basename(os.path.dirname(plans_dir))
+    env = dict(os.environ, nnUNet_results=os.path.dirname(os.path.dirname(plans_dir)))
+    cmd = [
+        "nnUNetv2_predict",
+        "-i", input_dir,
+        "-o", os.path.dirname(output_path),
+        "-d", dataset_name,
+        "-c", "3d_fullres",
+        "-f", "0",
+        "-device", device,
+        "--disable_tta",
+    ]
+
+    start = time.time()
+    proc = subprocess.Popen(cmd, env=env, close_fds=True)
+    try:
+        rc = proc.wait(timeout=timeout_s)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+        raise TimeoutError(f"Timeout waiting for prediction: {output_path}")
+
+    if rc != 0:
+        raise subprocess.CalledProcessError(rc, cmd)
+    if not os.path.isfile(output_path):
+        raise FileNotFoundError(f"nnUNetv2_predict exited without writing: {output_path}")
+    return {WHOLE_PREDICTION: time.time() - start}
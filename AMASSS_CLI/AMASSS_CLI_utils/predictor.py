@@ -0,0 +1,225 @@
+import os
+import glob
+import json
+import time
+import multiprocessing
+from copy import deepcopy
+
+import numpy as np
+import torch
+import SimpleITK as sitk
+
+import logging
+import sys
+# --- LOGGING CONFIGURATION ---
+logger = logging.getLogger("AMASSS_CLI_predictor")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+if logger.handlers:
+    logger.handlers.clear()
+console_handler = logging.StreamHandler(sys.stdout)
+console_handler.setLevel(logging.INFO)
+formatter = logging.Formatter('%(name)s - %(levelname)s - (%(filename)s:%(lineno)d) - %(message)s')
+console_handler.setFormatter(formatter)
+logger.addHandler(console_handler)
+
+CHECKPOINT_NAME = "checkpoint_final.pth"
+
+
+def FindModels(model_directory, structures):
+    """Return {structure: plans_dir} for every structure with a trained 3d_fullres model."""
+    models = {}
+    for struct in structures:
+        root = os.path.join(model_directory, struct)
+        if not os.path.exists(root):
+            logger.warning(f"Model directory not found for structure {struct}: {root}")
+            continue
+
+        pattern = os.path.join(root, "**", "*__nnUNetPlans__3d_fullres")
+        plans = glob.glob(pattern, recursive=True)
+        if not plans:
+            logger.warning(f"No model found for structure {struct}")
+            continue
+
+        checkpoint = os.path.join(plans[0], "fold_0", CHECKPOINT_NAME)
+        if not os.path.isfile(checkpoint):
+            logger.warning(f"Checkpoint not found for {struct}: {checkpoint}")
+            continue
+
+        models[struct] = plans[0]
+        logger.debug(f"Found model for {struct}: {plans[0]}")
+    return models
+
+
+# only phase timed by the nnUNetv2_predict fallback, which can't be split in
+# preprocessing, inference and export from outside of its process
+WHOLE_PREDICTION = "whole prediction"
+
+
+def FormatTimings(timings):
+    """'preprocessing 1.20s, inference 8.31s, export 0.95s'
+
+    or 'preprocessing + inference + export 10.46s (nnUNetv2_predict, not split)' for the fallback
+    """
+    if set(timings) == {WHOLE_PREDICTION}:
+        return f"preprocessing + inference + export {timings[WHOLE_PREDICTION]:.2f}s (nnUNetv2_predict, not split)"
+    return ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in timings.items())
+
+
+def ReadNNUNetInput(filepath):
+    """Read a single-channel volume the way nnunetv2's SimpleITKIO does.
+
+    Returns the (1, z, y, x) float32 array and the properties dict expected by
+    nnUNetPredictor.predict_single_npy_array.
+    """
+    img = sitk.ReadImage(filepath)
+    data = sitk.GetArrayFromImage(img).astype(np.float32, copy=False)[None]
+    spacing = img.GetSpacing()
+    props = {
+        "sitk_stuff": {
+            "spacing": spacing,
+            "origin": img.GetOrigin(),
+            "direction": img.GetDirection(),
+        },
+        "spacing": list(np.abs(spacing[::-1])),
+    }
+    return data, props
+
+
+class NNUNetEngine:
+    """In-process nnUNet v2 inference that keeps one predictor per structure resident.
+
+    Each checkpoint is loaded once when the engine is created; every scan is then
+    streamed through all the loaded structures and the segmentations are returned
+    as numpy arrays in the input geometry, without writing anything to disk.
+    """
+
+    def __init__(self, models, device=None, fold=0, use_mirroring=False, tile_step_size=0.5):
+        """
+        Args:
+            models : {structure: path of the *__nnUNetPlans__3d_fullres folder}
+            device : torch device used for inference (cuda if available by default)
+            fold : fold of the trained model to load
+            use_mirroring : test time augmentation (disabled like --disable_tta)
+            tile_step_size : sliding window step size
+        """
+        from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+
+        self.device = device if device is not None else torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        if self.device.type == "cpu":
+            torch.set_num_threads(multiprocessing.cpu_count())
+
+        self.predictors = {}
+        # per-phase timings of the last prediction of each structure
+        self.timings = {}
+        for struct, plans_dir in models.items():
+            start = time.time()
+            predictor = nnUNetPredictor(
+                tile_step_size=tile_step_size,
+                use_gaussian=True,
+                use_mirroring=use_mirroring,
+                perform_everything_on_device=self.device.type == "cuda",
+                device=self.device,
+                verbose=False,
+                verbose_preprocessing=False,
+                allow_tqdm=False,
+            )
+            predictor.initialize_from_trained_model_folder(
+                plans_dir,
+                use_folds=(fold,),
+                checkpoint_name=CHECKPOINT_NAME,
+            )
+            self.predictors[struct] = predictor
+            logger.info(f"Loaded {struct} model in {time.time() - start:.2f}s on {self.device}")
+
+    @property
+    def structures(self):
+        return list(self.predictors.keys())
+
+    @staticmethod
+    def PreprocessKey(predictor):
+        """Models with equal keys preprocess the input identically and can share the cached result."""
+        plans_manager = predictor.plans_manager
+        configuration_manager = predictor.configuration_manager
+        return (
+            configuration_manager.preprocessor_class.__name__,
+            tuple(plans_manager.transpose_forward),
+            tuple(configuration_manager.spacing),
+            tuple(configuration_manager.normalization_schemes),
+            tuple(configuration_manager.use_mask_for_norm),
+            json.dumps(plans_manager.foreground_intensity_properties_per_channel, sort_keys=True),
+        )
+
+    @staticmethod
+    def Preprocess(predictor, data, props):
+        """Crop, resample and normalize the decoded input with the predictor's plans."""
+        preprocessor = predictor.configuration_manager.preprocessor_class(verbose=False)
+        # run_case_npy fills the properties dict with the cropping/resampling information
+        case_props = deepcopy(props)
+        out = preprocessor.run_case_npy(
+            data,
+            None,
+            case_props,
+            predictor.plans_manager,
+            predictor.configuration_manager,
+            predictor.dataset_json,
+        )
+        tensor = torch.from_numpy(out[0]).to(dtype=torch.float32, memory_format=torch.contiguous_format)
+        return tensor, case_props
+
+    def PredictStructure(self, struct, cache):
+        """Segment one structure and return a binary uint8 mask."""
+        from nnunetv2.inference.export_prediction import convert_predicted_logits_to_segmentation_with_correct_shape
+
+        predictor = self.predictors[struct]
+        timings = {}
+
+        start = time.time()
+        tensor, case_props = cache.GetPreprocessed(
+            self.PreprocessKey(predictor),
+            lambda data, props: self.Preprocess(predictor, data, props),
+        )
+        timings["preprocessing"] = time.time() - start
+
+        start = time.time()
+        logits = predictor.predict_logits_from_preprocessed_data(tensor).cpu()
+        timings["inference"] = time.time() - start
+
+        start = time.time()
+        seg = convert_predicted_logits_to_segmentation_with_correct_shape(
+            logits,
+            predictor.plans_manager,
+            predictor.configuration_manager,
+            predictor.label_manager,
+            case_props,
+            return_probabilities=False,
+        )
+        del logits
+        mask = (np.asarray(seg) > 0).astype(np.uint8)
+        timings["export"] = time.time() - start
+
+        self.timings[struct] = timings
+        return mask
+
+    def Predict(self, cache, callback=None):
+        """Run every loaded structure on the scan held by cache.
+
+        Args:
+            cache : ScanCache of the scan, shared by all the structures
+            callback : optional callable(struct_idx, struct) called after each structure
+        Returns:
+            {structure: uint8 mask} in the same (z, y, x) layout as sitk.GetArrayFromImage
+        """
+        masks = {}
+        for struct_idx, struct in enumerate(self.predictors, start=1):
+            masks[struct] = self.PredictStructure(struct, cache)
+            logger.info(f"Prediction for {struct} completed ({FormatTimings(self.timings[struct])})")
+            if callback is not None:
+                callback(struct_idx, struct)
+        return masks
+
+    def Release(self):
+        """Free the resident networks."""
+        self.predictors.clear()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
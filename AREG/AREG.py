@@ -1250,7 +1250,7 @@ class AREGWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             logger.debug(f"Segmentation environment: {check_env}")
             
             if check_env:
-                list_libs_IOS = [("tqdm",None,None),('vtk',None,None),('pandas',None,None)]
+                list_libs_IOS = [("tqdm",None,None),('vtk',None,None),('pandas',None,None),('scipy',None,None)]
                 
                 monai_version = '==1.3.2' if sys.version_info >= (3, 10) else '==0.7.0'
                 list_libs_IOS.append(('monai', monai_version, None))
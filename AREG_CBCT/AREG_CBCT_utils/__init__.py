@@ -1,6 +1,8 @@
 from .utils import (
     GetDictPatients,
     VoxelBasedRegistration,
+    RegistrationProfile,
+    REGISTRATION_PROFILES,
     LoadOnlyLandmarks,
     applyTransformLandmarks,
     WriteJson,
@@ -11,7 +11,9 @@
 import numpy as np
 import time
 import sys
+import shutil
 import logging
+import tempfile
 from glob import iglob
 import os, json
 import SimpleITK as sitk
@@ -498,7 +500,30 @@ def applyMask(image, mask, label):
 """
 
 
-def make_rigid_param_map_deterministic():
+REGISTRATION_PROFILES = ("deterministic", "fast-parallel", "coarse-to-fine-early-stop")
+REGISTRATION_SEED = 121212
+
+
+def RegistrationProfile(profile=None):
+    """Elastix profile, from the argument or the AREG_REG_PROFILE env var (default "deterministic")."""
+    profile = profile or os.environ.get("AREG_REG_PROFILE", "deterministic")
+    if profile not in REGISTRATION_PROFILES:
+        raise ValueError(f"Unknown registration profile {profile}, expected one of {REGISTRATION_PROFILES}")
+    return profile
+
+
+def make_rigid_param_map(profile="deterministic", center_of_rotation=None):
+    """Rigid Elastix parameters of a registration profile
+
+    center_of_rotation (physical point) disables Elastix's automatic initialization, the
+    initial translation is then given to ElastixReg as initial_transform.
+
+    - deterministic : single thread, full grid sampling, 1500 iterations per level
+    - fast-parallel : all the cores, 30000 random samples drawn with a fixed seed,
+      500 iterations per level, stopped early at 1e-5 value/gradient tolerance
+    - coarse-to-fine-early-stop : fast-parallel with fewer samples and looser
+      tolerances on the coarse levels, so that they stop as soon as they converge
+    """
     # Create a new parameter object and get the default rigid transformation map (EulerTransform)
     po = itk.ParameterObject.New()
     pm = po.GetDefaultParameterMap("rigid")
@@ -527,46 +552,209 @@ def make_rigid_param_map_deterministic():
     pm["MaximumStepLength"] = ["2.0"]
     pm["MinimumStepLength"] = ["0.001"]
     pm["ValueTolerance"] = ["1e-6"]
-    pm["GradientTolerance"] = ["1e-6"]
+    pm["GradientMagnitudeTolerance"] = ["1e-6"]
 
     # Initialization and scale estimation
     pm["AutomaticTransformInitialization"] = ["true"]
     pm["AutomaticScalesEstimation"] = ["true"]
+    if center_of_rotation is not None:
+        pm["AutomaticTransformInitialization"] = ["false"]
+        pm["CenterOfRotationPoint"] = [str(float(c)) for c in center_of_rotation]
 
     # Masking and output settings
     pm["ErodeMask"] = ["true"]
     pm["WriteResultImage"] = ["false"]
+    # Per level metric and timings, only written when an output directory is set
+    pm["WriteIterationInfo"] = ["true"]
 
     # Compatibility setting (ignored with Grid sampler but doesn't interfere)
     pm["NumberOfSpatialSamples"] = ["30000"]
 
+    if profile != "deterministic":
+        # Same random samples at every run, fixed for the whole level
+        pm["NumberOfThreads"] = [str(os.cpu_count() or 1)]
+        pm["ImageSampler"] = ["RandomCoordinate"]
+        pm["RandomSeed"] = [str(REGISTRATION_SEED)]
+        pm["MaximumNumberOfIterations"] = ["500"]
+        # Stop a level once the metric or its gradient stops moving
+        pm["ValueTolerance"] = ["1e-5"]
+        pm["GradientMagnitudeTolerance"] = ["1e-5"]
+
+    if profile == "coarse-to-fine-early-stop":
+        pm["NumberOfSpatialSamples"] = ["5000", "10000", "20000"]
+        pm["MaximumNumberOfIterations"] = ["300", "200", "100"]
+        pm["ValueTolerance"] = ["1e-4", "1e-5", "1e-6"]
+        pm["GradientMagnitudeTolerance"] = ["1e-4", "1e-5", "1e-6"]
+
     po.AddParameterMap(pm)
     return po
 
 
-def ElastixReg(fixed_image, moving_image, initial_transform=None):
+def make_rigid_param_map_deterministic():
+    return make_rigid_param_map("deterministic")
+
+
+def ReadIterationInfo(output_dir):
+    """Iterations, final metric value and time (s) of each level from the Elastix IterationInfo files"""
+    levels = []
+    for path in sorted(iglob(os.path.join(output_dir, "IterationInfo.0.R*.txt"))):
+        with open(path) as f:
+            header = f.readline().rstrip("\n").split("\t")
+            rows = [line.split() for line in f if line.strip()]
+        if not rows:
+            continue
+        metric_col = next(i for i, name in enumerate(header) if "Metric" in name)
+        time_col = next(i for i, name in enumerate(header) if "Time[ms]" in name)
+        levels.append(
+            {
+                "iterations": len(rows),
+                "metric": float(rows[-1][metric_col]),
+                "time": sum(float(row[time_col]) for row in rows) / 1000,
+            }
+        )
+    return levels
+
+
+def ElastixReg(fixed_image, moving_image, initial_transform=None, profile="deterministic", center_of_rotation=None):
     # Set up and run the Elastix registration method
     elastix = itk.ElastixRegistrationMethod.New(fixed_image, moving_image)
-    elastix.SetParameterObject(make_rigid_param_map_deterministic())
+    elastix.SetParameterObject(make_rigid_param_map(profile, center_of_rotation))
     if initial_transform is not None:
         elastix.SetInitialTransformParameterObject(initial_transform)
     elastix.SetLogToConsole(False)
-    elastix.UpdateLargestPossibleRegion()
+
+    output_dir = tempfile.mkdtemp(prefix="areg_elastix_")
+    try:
+        elastix.SetOutputDirectory(output_dir)
+        start = time.time()
+        elastix.UpdateLargestPossibleRegion()
+        total = time.time() - start
+
+        try:
+            for level, info in enumerate(ReadIterationInfo(output_dir)):
+                logger.info(
+                    f"Registration level {level} ({profile}): {info['iterations']} iterations, "
+                    f"metric {info['metric']:.6f}, {info['time']:.2f}s"
+                )
+        except Exception as e:
+            logger.warning(f"Could not read the Elastix iteration info: {e}")
+        logger.info(f"Registration ({profile}) took {total:.2f}s")
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
     return elastix.GetTransformParameterObject()
 
 
-def MaskedImage(fixed_image_path, fixed_seg_path, temp_folder, SegLabel=None):
-    """Apply a segmentation mask to the fixed image and save the result"""
-    fixed_image_sitk = sitk.ReadImage(fixed_image_path)
-    fixed_seg_sitk = sitk.ReadImage(fixed_seg_path)
+def SitkToItk(image):
+    """Float ITK image viewing the pixel buffer of a SimpleITK image, without copy
+
+    The image is only cast when it is not float32 already. The ITK image does not own
+    its pixels: the returned SimpleITK image holds them and must be kept alive as long
+    as the ITK image is used.
+
+    Returns: (itk image, SimpleITK image holding the pixels)
+    """
+    if image.GetPixelID() != sitk.sitkFloat32:
+        image = sitk.Cast(image, sitk.sitkFloat32)
+    itk_image = itk.GetImageViewFromArray(sitk.GetArrayViewFromImage(image))
+    itk_image.SetOrigin(image.GetOrigin())
+    itk_image.SetSpacing(image.GetSpacing())
+    itk_image.SetDirection(itk.matrix_from_array(np.reshape(image.GetDirection(), (3, 3))))
+    return itk_image, image
+
+
+def CropToMask(image, mask, margin=2):
+    """Crop image to the bounding box of the non zero voxels of mask grown by margin voxels"""
+    stats = sitk.LabelShapeStatisticsImageFilter()
+    stats.Execute(sitk.Cast(mask != 0, sitk.sitkUInt8))
+    if not stats.HasLabel(1):
+        return image
+    bbox = stats.GetBoundingBox(1)
+    dim = image.GetDimension()
+    start = [max(bbox[i] - margin, 0) for i in range(dim)]
+    stop = [min(bbox[i] + bbox[dim + i] + margin, image.GetSize()[i]) for i in range(dim)]
+    return sitk.RegionOfInterest(image, [e - b for b, e in zip(start, stop)], start)
+
+
+def MaskedImage(fixed_image_sitk, fixed_seg_sitk, SegLabel=None):
+    """Apply a segmentation mask to the fixed image and crop it to the mask, in memory"""
     fixed_seg_sitk.SetOrigin(fixed_image_sitk.GetOrigin())
     fixed_image_masked = applyMask(fixed_image_sitk, fixed_seg_sitk, label=SegLabel)
 
-    # Save the masked image to a temporary location
-    output_path = os.path.join(temp_folder, "fixed_image_masked.nii.gz")
-    sitk.WriteImage(sitk.Cast(fixed_image_masked, sitk.sitkInt16), output_path)
+    # Crop to the voxels kept by applyMask, the masked intensities can be 0 inside the mask
+    seg_array = sitk.GetArrayFromImage(fixed_seg_sitk)
+    if SegLabel is not None and SegLabel in np.unique(seg_array):
+        seg_array = seg_array == SegLabel
+    crop_mask = sitk.GetImageFromArray((seg_array != 0).astype(np.uint8))
+    crop_mask.CopyInformation(fixed_image_masked)
+    fixed_image_masked = CropToMask(fixed_image_masked, crop_mask)
+
+    # Same intensities as the int16 image the registration used to read back from disk
+    return sitk.Cast(fixed_image_masked, sitk.sitkInt16)
+
 
-    return output_path
+def GeometricCenter(image):
+    """Physical point at the centre of the grid of a SimpleITK image"""
+    return np.array(image.TransformContinuousIndexToPhysicalPoint([(s - 1) / 2 for s in image.GetSize()]))
+
+
+def TranslationParameterObject(translation, fixed_image):
+    """Elastix TranslationTransform parameter object, on the grid of the fixed image (SimpleITK)"""
+    po = itk.ParameterObject.New()
+    po.AddParameterMap(
+        {
+            "Transform": ["TranslationTransform"],
+            "NumberOfParameters": ["3"],
+            "TransformParameters": [str(float(t)) for t in translation],
+            "InitialTransformParametersFileName": ["NoInitialTransform"],
+            "HowToCombineTransforms": ["Compose"],
+            "FixedImageDimension": ["3"],
+            "MovingImageDimension": ["3"],
+            "FixedInternalImagePixelType": ["float"],
+            "MovingInternalImagePixelType": ["float"],
+            "UseDirectionCosines": ["true"],
+            "Size": [str(s) for s in fixed_image.GetSize()],
+            "Index": ["0", "0", "0"],
+            "Spacing": [str(s) for s in fixed_image.GetSpacing()],
+            "Origin": [str(o) for o in fixed_image.GetOrigin()],
+            "Direction": [str(d) for d in fixed_image.GetDirection()],
+        }
+    )
+    return po
+
+
+def MaskedRegistration(fixed_image_sitk, moving_image_sitk, fixed_seg_sitk, SegLabel=None, profile="deterministic"):
+    """Rigid registration of the moving image on the fixed image masked and cropped to its segmentation
+
+    Elastix's automatic initialization would put the centre of the moving image on the
+    centre of the cropped fixed image, i.e. on the ROI. Like the registration of the
+    uncropped images, the geometric centres of the full images are matched instead (as
+    initial transform) and the rotation is centred on the full fixed image.
+
+    Returns: sitk.Euler3DTransform, same convention as MatrixRetrieval
+    """
+    center = GeometricCenter(fixed_image_sitk)
+    offset = GeometricCenter(moving_image_sitk) - center
+
+    fixed_masked_sitk = MaskedImage(fixed_image_sitk, fixed_seg_sitk, SegLabel=SegLabel)
+    fixed_image, fixed_pixels = SitkToItk(fixed_masked_sitk)
+    moving_image, moving_pixels = SitkToItk(moving_image_sitk)
+    logger.debug(f"Masked fixed image created with size {fixed_masked_sitk.GetSize()}")
+
+    TransformObj = ElastixReg(
+        fixed_image,
+        moving_image,
+        initial_transform=TranslationParameterObject(offset, fixed_masked_sitk),
+        profile=profile,
+        center_of_rotation=center,
+    )
+    transform = MatrixRetrieval(TransformObj)
+
+    # The initial translation is applied before the rotation: R(x + offset - c) + c + t,
+    # which is the registration of the full images with translation R @ offset + t
+    rotation = np.reshape(transform.GetMatrix(), (3, 3))
+    transform.SetTranslation((np.asarray(transform.GetTranslation()) + rotation @ offset).tolist())
+    return transform
 
 
 def VoxelBasedRegistration(
@@ -576,9 +764,16 @@ def VoxelBasedRegistration(
     temp_folder,
     approx=False,
     SegLabel=None,
+    profile=None,
 ):
-    """Perform voxel-based registration using Elastix with comprehensive error handling."""
+    """Perform voxel-based registration using Elastix with comprehensive error handling.
+
+    profile selects the Elastix parameters, see make_rigid_param_map and RegistrationProfile.
+    The images stay in memory: temp_folder is kept for compatibility, nothing is written to it.
+    """
     try:
+        profile = RegistrationProfile(profile)
+
         # ===== INPUT VALIDATION =====
         try:
             logger.debug("Validating registration input files")
@@ -599,53 +794,29 @@ def VoxelBasedRegistration(
         # ===== LOAD MOVING IMAGE =====
         try:
             logger.debug(f"Loading moving image: {moving_image_path}")
-            moving_image = itk.imread(moving_image_path, itk.F)
+            # read once: registered as float, resampled with its own pixel type
+            moving_image_sitk = sitk.ReadImage(moving_image_path)
             logger.debug("Moving image loaded successfully")
         except Exception as e:
             logger.error(f"Error loading moving image: {e}")
             raise
 
-        # ===== CREATE MASKED FIXED IMAGE =====
-        try:
-            logger.debug("Creating masked fixed image")
-            masked_image_path = MaskedImage(
-                fixed_image_path, fixed_seg_path, temp_folder, SegLabel=SegLabel
-            )
-            logger.debug(f"Masked image created: {masked_image_path}")
-        except Exception as e:
-            logger.error(f"Error creating masked image: {e}")
-            raise
-
-        # ===== LOAD MASKED FIXED IMAGE =====
-        try:
-            logger.debug("Loading masked fixed image")
-            fixed_image_masked = itk.imread(masked_image_path, itk.F)
-            logger.debug("Masked fixed image loaded successfully")
-        except Exception as e:
-            logger.error(f"Error loading masked fixed image: {e}")
-            raise
-
         # ===== PERFORM REGISTRATION =====
         try:
             logger.debug("Starting Elastix registration")
-            TransformObj_Fine = ElastixReg(
-                fixed_image_masked, moving_image, initial_transform=None
+            transforms_Fine = MaskedRegistration(
+                sitk.ReadImage(fixed_image_path),
+                moving_image_sitk,
+                sitk.ReadImage(fixed_seg_path),
+                SegLabel=SegLabel,
+                profile=profile,
             )
+            Transforms = [transforms_Fine]
             logger.info("Elastix registration completed")
         except Exception as e:
             logger.error(f"Error during Elastix registration: {e}")
             raise
 
-        # ===== EXTRACT TRANSFORMATION =====
-        try:
-            logger.debug("Extracting transformation matrix")
-            transforms_Fine = MatrixRetrieval(TransformObj_Fine)
-            Transforms = [transforms_Fine]
-            logger.debug("Transformation matrix extracted")
-        except Exception as e:
-            logger.error(f"Error extracting transformation matrix: {e}")
-            raise
-
         # ===== COMPUTE FINAL MATRIX =====
         try:
             logger.debug("Computing final transformation matrix")
@@ -659,7 +830,7 @@ def VoxelBasedRegistration(
         try:
             logger.debug("Resampling moving image with final transform")
             resample_t2 = sitk.Cast(
-                ResampleImage(sitk.ReadImage(moving_image_path), transform), sitk.sitkInt16
+                ResampleImage(moving_image_sitk, transform), sitk.sitkInt16
             )
             logger.info("Moving image resampled successfully")
         except Exception as e:
@@ -803,7 +974,10 @@ def convertdicom2nifti(input_folder, output_folder=None):
 
 def MatrixRetrieval(TransformParameterMapObject):
     """Retrieve the matrix from the transform parameter map"""
-    ParameterMap = TransformParameterMapObject.GetParameterMap(0)
+    # the registered transform is the last map, after the initial transform if any
+    ParameterMap = TransformParameterMapObject.GetParameterMap(
+        TransformParameterMapObject.GetNumberOfParameterMaps() - 1
+    )
 
     if ParameterMap["Transform"][0] == "AffineTransform":
         matrix = [float(i) for i in ParameterMap["TransformParameters"]]
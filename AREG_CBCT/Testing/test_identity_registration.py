@@ -0,0 +1,60 @@
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+IMPORT_ERROR = None
+try:
+    import numpy as np
+    import SimpleITK as sitk
+    from AREG_CBCT_utils.utils import MaskedRegistration
+except ImportError as e:
+    IMPORT_ERROR = str(e)
+
+
+def SyntheticScan(size=80, spacing=0.5, seed=0):
+    """Smooth random texture in a sphere, int16 like a CBCT, with a non trivial origin"""
+    rng = np.random.default_rng(seed)
+    noise = sitk.GetImageFromArray(rng.normal(size=(size, size, size)).astype(np.float32))
+    texture = sitk.GetArrayFromImage(sitk.SmoothingRecursiveGaussian(noise, 3.0))
+    zz, yy, xx = np.mgrid[:size, :size, :size] - (size - 1) / 2
+    head = (xx**2 + yy**2 + zz**2) < (0.45 * size) ** 2
+    array = np.where(head, 1000 + 4000 * texture, 0).astype(np.int16)
+
+    image = sitk.GetImageFromArray(array)
+    image.SetSpacing([spacing] * 3)
+    image.SetOrigin([-12.0, 7.5, 30.0])
+    return image
+
+
+def OffCenterSegmentation(image, label=1):
+    """Box segmentation in a corner of the scan, far from the centre of the grid"""
+    size = image.GetSize()[0]
+    array = np.zeros(sitk.GetArrayViewFromImage(image).shape, dtype=np.uint8)
+    array[size // 8 : size // 2, size // 8 : size // 2, size // 2 : 7 * size // 8] = label
+    seg = sitk.GetImageFromArray(array)
+    seg.CopyInformation(image)
+    return seg
+
+
+@unittest.skipIf(IMPORT_ERROR is not None, f"AREG_CBCT_utils can't be imported: {IMPORT_ERROR}")
+class IdentityRegistrationTest(unittest.TestCase):
+    """A scan registered on itself with an off-centre ROI must give the identity"""
+
+    def test_identity(self):
+        image = SyntheticScan()
+        transform = MaskedRegistration(image, image, OffCenterSegmentation(image), SegLabel=1, profile="fast-parallel")
+
+        # largest displacement of the corners of the scan, in mm
+        size = image.GetSize()
+        corners = [
+            image.TransformIndexToPhysicalPoint([i * (size[0] - 1), j * (size[1] - 1), k * (size[2] - 1)])
+            for i in (0, 1) for j in (0, 1) for k in (0, 1)
+        ]
+        error = max(np.linalg.norm(np.subtract(transform.TransformPoint(p), p)) for p in corners)
+        self.assertLess(error, image.GetSpacing()[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -145,44 +145,27 @@ def main(args):
             logger.info(f"Processing {sample_context}")
             
             try:
-                # ===== UPPER SURFACE T1 =====
+                # ===== UPPER SURFACES T1 AND T2 =====
                 try:
-                    logger.debug(f"Processing upper T1 surface")
+                    logger.debug(f"Processing upper T1 and T2 surfaces")
                     name_t1 = os.path.basename(dataset.getUpperPath(idx, "T1"))
+                    name_t2 = os.path.basename(dataset.getUpperPath(idx, "T2"))
                     surf_T1 = dataset.getUpperSurf(idx, "T1")
+                    surf_T2 = dataset.getUpperSurf(idx, "T2")
                     
                     if surf_T1 is None:
                         logger.warning(f"Upper T1 surface is None, skipping")
                         raise ValueError("Upper T1 surface not found")
-                    
-                    surf_T1 = Patched(dataset[idx, "T1"], surf_T1)
-                    WriteSurf(surf_T1, args.output, name_t1, args.suffix)
-                    logger.debug(f"Saved upper T1 surface")
-                except Exception as e:
-                    logger.error(f"Error processing upper T1 surface: {e}")
-                    raise
-
-                # ===== UPDATE LOG =====
-                try:
-                    with open(args.log_path, "w") as log_f:
-                        log_f.write(str(1))
-                except Exception as e:
-                    logger.warning(f"Error updating log file: {e}")
-
-                # ===== UPPER SURFACE T2 =====
-                try:
-                    logger.debug(f"Processing upper T2 surface")
-                    name_t2 = os.path.basename(dataset.getUpperPath(idx, "T2"))
-                    surf_T2 = dataset.getUpperSurf(idx, "T2")
-                    
                     if surf_T2 is None:
                         logger.warning(f"Upper T2 surface is None, skipping")
                         raise ValueError("Upper T2 surface not found")
                     
-                    surf_T2 = Patched(dataset[idx, "T2"], surf_T2)
-                    logger.debug(f"Predicted upper T2 surface")
+                    # both time points share one forward pass
+                    surf_T1, surf_T2 = Patched.PredictBatch(dataset.getBatch(idx, ("T1", "T2")), [surf_T1, surf_T2])
+                    WriteSurf(surf_T1, args.output, name_t1, args.suffix)
+                    logger.debug(f"Saved upper T1 surface, predicted upper T2 surface")
                 except Exception as e:
-                    logger.error(f"Error processing upper T2 surface: {e}")
+                    logger.error(f"Error processing upper surfaces: {e}")
                     raise
 
                 # ===== UPDATE LOG =====
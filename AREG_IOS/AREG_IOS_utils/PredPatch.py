@@ -1,8 +1,9 @@
 from typing import Any
 import torch
+from torch.nn.utils.rnn import pad_sequence
 from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk
 from AREG_IOS_utils.net import MonaiUNetHRes
-from AREG_IOS_utils.post_process import RemoveIslands, DilateLabel, ErodeLabel
+from AREG_IOS_utils.post_process import MeshGraph, RemoveIslands, DilateLabel, ErodeLabel
 import logging
 import sys
 # ===== Logging Configuration =====
@@ -24,69 +25,93 @@ class PredPatch:
 
     """
 
-    def __init__(self, path_model) -> None:
+    def __init__(self, path_model, device=None) -> None:
+        if device is None:
+            device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.device = device
+
         self.model = MonaiUNetHRes()
-        self.model.load_state_dict(torch.load(path_model)["state_dict"])
+        self.model.load_state_dict(torch.load(path_model, map_location=self.device)["state_dict"])
 
-        self.device = torch.device("cuda")
         self.model.to(self.device)
         self.model.eval()
         self.softmax = torch.nn.Softmax(dim=2)
 
     def __call__(self, batch, surf) -> Any:
+        return self.PredictBatch([batch], [surf])[0]
+
+    def PredictBatch(self, batches, surfs) -> list:
+        """
+        Predict the patch of several surfaces with a single forward pass
+
+        Args:
+            batches : list of (V, F, CN) given by DatasetPatch
+            surfs : list of the vtkPolyData matching batches, the "Butterfly" array is added to them
+
+        Returns:
+            surfs
+        """
         with torch.no_grad():
 
             out_channels = 2
 
-            V, F, CN = batch
+            n_verts = [V.shape[0] for V, _, _ in batches]
+            n_faces = [F.shape[0] for _, F, _ in batches]
+
+            # padded faces (-1) are dropped by Meshes, the padded vertices are never referenced
+            V = pad_sequence([V for V, _, _ in batches], batch_first=True)
+            F = pad_sequence([F for _, F, _ in batches], batch_first=True, padding_value=-1)
+            CN = pad_sequence([CN for _, _, CN in batches], batch_first=True)
 
-            V = V.cuda(non_blocking=True)
-            F = F.cuda(non_blocking=True)
-            CN = CN.cuda(non_blocking=True).to(torch.float32)
-            CN = CN.unsqueeze(0)
-            F = F.unsqueeze(0)
-            V = V.unsqueeze(0)
+            V = V.to(self.device, non_blocking=True)
+            F = F.to(self.device, non_blocking=True)
+            CN = CN.to(self.device, non_blocking=True).to(torch.float32)
 
             x, X, PF = self.model((V, F, CN))
             x = self.softmax(x * (PF >= 0))
 
-            P_faces = torch.zeros(out_channels, F.shape[1]).to(self.device)
-            V_labels_prediction = (
-                torch.zeros(V.shape[1]).to(self.device).to(torch.int64)
-            )
-
-            PF = PF.squeeze()
-            x = x.squeeze(0)
-
-            for pf, pred in zip(PF, x):
-                P_faces[:, pf] += pred
+            # PF indexes the packed faces of the whole batch: accumulate every
+            # view of every surface with one index_add_
+            PF = PF.reshape(-1)
+            x = x.permute(2, 0, 1, 3, 4).reshape(out_channels, -1)
+            visible = PF >= 0
 
+            P_faces = torch.zeros(out_channels, sum(n_faces), device=self.device)
+            P_faces.index_add_(1, PF[visible], x[:, visible])
             P_faces = torch.argmax(P_faces, dim=0)
 
-            faces_pid0 = F[0, :, 0]
-            V_labels_prediction[faces_pid0] = P_faces
-
-            V_labels_prediction = torch.where(V_labels_prediction >= 1, 1, 0)
-
-            V_labels_prediction = numpy_to_vtk(V_labels_prediction.cpu().numpy())
-            V_labels_prediction.SetName("Butterfly")
-            surf.GetPointData().AddArray(V_labels_prediction)
-
-            # Post Process
-            # fill the holes in patch
-            RemoveIslands(surf, V_labels_prediction, 33, 500, ignore_neg1=True)
-            for label in range(2):
-                RemoveIslands(surf, V_labels_prediction, label, 200, ignore_neg1=True)
-
-            for label in range(1, 2):
-                DilateLabel(
-                    surf,
-                    V_labels_prediction,
-                    label,
-                    iterations=2,
-                    dilateOverTarget=False,
-                    target=None,
-                )
-                ErodeLabel(surf, V_labels_prediction, label, iterations=2, target=None)
-
-        return surf
+            for i, (P_faces_surf, surf) in enumerate(zip(torch.split(P_faces, n_faces), surfs)):
+                V_labels_prediction = torch.zeros(n_verts[i], dtype=torch.int64, device=self.device)
+
+                faces_pid0 = F[i, : n_faces[i], 0]
+                V_labels_prediction[faces_pid0] = P_faces_surf
+
+                V_labels_prediction = torch.where(V_labels_prediction >= 1, 1, 0)
+                self.PostProcess(surf, V_labels_prediction.cpu().numpy())
+
+        return surfs
+
+    def PostProcess(self, surf, labels):
+        V_labels_prediction = numpy_to_vtk(labels)
+        V_labels_prediction.SetName("Butterfly")
+        surf.GetPointData().AddArray(V_labels_prediction)
+
+        # Post Process
+        # the adjacency of the surface is built once for every operation
+        graph = MeshGraph.FromSurf(surf)
+        # fill the holes in patch
+        RemoveIslands(surf, V_labels_prediction, 33, 500, ignore_neg1=True, graph=graph)
+        for label in range(2):
+            RemoveIslands(surf, V_labels_prediction, label, 200, ignore_neg1=True, graph=graph)
+
+        for label in range(1, 2):
+            DilateLabel(
+                surf,
+                V_labels_prediction,
+                label,
+                iterations=2,
+                dilateOverTarget=False,
+                target=None,
+                graph=graph,
+            )
+            ErodeLabel(surf, V_labels_prediction, label, iterations=2, target=None, graph=graph)
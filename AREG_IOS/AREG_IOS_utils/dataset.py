@@ -76,6 +76,10 @@ class DatasetPatch(Dataset):
 
         return V, F, CN
 
+    def getBatch(self, index, times=("T1", "T2")):
+        """list of the (V, F, CN) of the upper surfaces of a patient, to predict them together"""
+        return [self[index, time] for time in times]
+
     def isLower(self):
         out = True
         if self.list_lower == None:
@@ -1,9 +1,11 @@
-import vtk
 import numpy as np
 import argparse
 import sys
 import os
 import math
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+from vtk.util.numpy_support import vtk_to_numpy
 
 import logging
 # ===== Logging Configuration =====
@@ -19,169 +21,250 @@ console_handler.setFormatter(formatter)
 logger.addHandler(console_handler)
 
 
-def ConnectedRegion(vtkdata, pid, labels, label, pid_visited):
-
-    neighbor_pids = GetNeighborIds(vtkdata, pid, labels, label, pid_visited)
-    all_connected_pids = [pid]
-    all_connected_pids.extend(neighbor_pids)
-
-    while len(neighbor_pids):
-        npid = neighbor_pids.pop()
-        next_neighbor_pids = GetNeighborIds(vtkdata, npid, labels, label, pid_visited)
-        neighbor_pids.extend(next_neighbor_pids)
-        all_connected_pids = np.append(all_connected_pids, next_neighbor_pids)
-
-    return np.unique(all_connected_pids)
-
-
-def NeighborLabel(vtkdata, labels, label, connected_pids):
-    neighbor_ids = []
-
-    for pid in connected_pids:
-        cells_id = vtk.vtkIdList()
-        vtkdata.GetPointCells(int(pid), cells_id)
-        for ci in range(cells_id.GetNumberOfIds()):
-            points_id_inner = vtk.vtkIdList()
-            vtkdata.GetCellPoints(cells_id.GetId(ci), points_id_inner)
-            for pi in range(points_id_inner.GetNumberOfIds()):
-                pid_inner = points_id_inner.GetId(pi)
-                if labels.GetTuple(pid_inner)[0] != label:
-                    neighbor_ids.append(pid_inner)
-
-    neighbor_ids = np.unique(neighbor_ids)
-    neighbor_labels = []
-
-    for nid in neighbor_ids:
-        neighbor_labels.append(labels.GetTuple(nid)[0])
-
-    if len(neighbor_labels) > 0:
-        return max(neighbor_labels, key=neighbor_labels.count)
-    return -1
-
-
-def RemoveIslands(vtkdata, labels, label, min_count, ignore_neg1=False):
-
-    pid_visited = np.zeros(labels.GetNumberOfTuples())
-    for pid in range(labels.GetNumberOfTuples()):
-        if labels.GetTuple(pid)[0] == label and pid_visited[pid] == 0:
-            connected_pids = ConnectedRegion(vtkdata, pid, labels, label, pid_visited)
-            if connected_pids.shape[0] < min_count:
-                neighbor_label = NeighborLabel(vtkdata, labels, label, connected_pids)
-                if ignore_neg1 == True and neighbor_label != -1:
-                    for cpid in connected_pids:
-                        labels.SetTuple(int(cpid), (neighbor_label,))
+class MeshGraph:
+    """
+    Point adjacency of a surface as a CSR sparse matrix, built once from its cells.
+
+    Two points are neighbors when they share a cell, as with GetPointCells/GetCellPoints.
+    The label operations work on numpy arrays and update them in place, so a vtk
+    array seen through vtk_to_numpy is modified directly.
+    """
+
+    def __init__(self, faces, n_points):
+        """
+        Args:
+            faces : (F, k) point ids of each cell, or (connectivity, offsets) of cells of any size
+            n_points : number of points of the surface
+        """
+        if isinstance(faces, tuple):
+            connectivity, offsets = faces
+            sizes = np.diff(offsets)
+            n_cells = len(sizes)
+            cell_ids = np.repeat(np.arange(n_cells), sizes)
+        else:
+            faces = np.asarray(faces)
+            n_cells = faces.shape[0]
+            connectivity = faces.reshape(-1)
+            cell_ids = np.repeat(np.arange(n_cells), faces.shape[1])
+
+        self.n_points = n_points
+        incidence = sparse.csr_matrix(
+            (np.ones(len(connectivity), dtype=np.int32), (connectivity, cell_ids)),
+            shape=(n_points, n_cells),
+        )
+        adjacency = (incidence @ incidence.T).tocsr()
+        adjacency.setdiag(0)
+        adjacency.eliminate_zeros()
+        adjacency.data[:] = 1
+        adjacency.sort_indices()
+        self.adjacency = adjacency
+
+    @classmethod
+    def FromSurf(cls, vtkdata):
+        polys = vtkdata.GetPolys()
+        connectivity = vtk_to_numpy(polys.GetConnectivityArray()).astype(np.int64)
+        offsets = vtk_to_numpy(polys.GetOffsetsArray()).astype(np.int64)
+        return cls((connectivity, offsets), vtkdata.GetNumberOfPoints())
+
+    def Neighbors(self, pid):
+        """Sorted ids of the points sharing a cell with pid"""
+        A = self.adjacency
+        return A.indices[A.indptr[pid] : A.indptr[pid + 1]]
+
+    def Touching(self, mask):
+        """Points with at least one neighbor in mask"""
+        return (self.adjacency @ mask.astype(np.int32)) > 0
+
+    def Components(self, mask):
+        """
+        Connected components of the points of mask
+
+        Returns:
+            (n_points,) component id of every point, -1 outside of mask, and the number of components
+        """
+        ids = np.flatnonzero(mask)
+        components = np.full(self.n_points, -1, dtype=np.int64)
+        if len(ids) == 0:
+            return components, 0
+        n, sub_components = connected_components(
+            self.adjacency[ids][:, ids], directed=False
+        )
+        components[ids] = sub_components
+        return components, n
+
+    def FirstNeighbor(self, rows, eligible):
+        """
+        Smallest eligible neighbor of each point of rows
+
+        Returns:
+            (len(rows),) point id, -1 where no neighbor is eligible
+        """
+        A = self.adjacency[rows].multiply(eligible[np.newaxis, :].astype(np.int32)).tocsr()
+        A.eliminate_zeros()
+        A.sort_indices()
+        first = np.full(len(rows), -1, dtype=np.int64)
+        has_neighbor = np.diff(A.indptr) > 0
+        first[has_neighbor] = A.indices[A.indptr[:-1][has_neighbor]]
+        return first
+
+    def NeighborLabels(self, labels, components, selected, label):
+        """
+        Most frequent label among the distinct neighbors of each selected component
+
+        Neighbors with label are not counted, ties go to the label of the
+        neighbor with the smallest id.
+
+        Returns:
+            {component id: label}
+        """
+        rows = np.isin(components, selected)
+        incidence = sparse.csr_matrix(
+            (np.ones(rows.sum(), dtype=np.int32), (components[rows], np.flatnonzero(rows))),
+            shape=(int(components.max()) + 1, self.n_points),
+        )
+        touching = (incidence @ self.adjacency).tocoo()
+        comp, nid = touching.row, touching.col
+        other = labels[nid] != label
+        comp, nid = comp[other], nid[other]
+
+        out = {}
+        if len(comp) == 0:
+            return out
+        values, label_idx = np.unique(labels[nid], return_inverse=True)
+        order = np.lexsort((nid, label_idx, comp))
+        comp, nid, label_idx = comp[order], nid[order], label_idx[order]
+
+        # count and first neighbor id of every (component, label) pair
+        key = comp * len(values) + label_idx
+        starts = np.flatnonzero(np.r_[True, key[1:] != key[:-1]])
+        counts = np.diff(np.r_[starts, len(key)])
+        pair_comp, pair_label, pair_nid = comp[starts], label_idx[starts], nid[starts]
+
+        # best label per component: highest count, then smallest first neighbor id
+        order = np.lexsort((pair_nid, -counts, pair_comp))
+        pair_comp, pair_label = pair_comp[order], pair_label[order]
+        first = np.r_[True, pair_comp[1:] != pair_comp[:-1]]
+        for c, l in zip(pair_comp[first], pair_label[first]):
+            out[int(c)] = values[l]
+        return out
+
+    def RemoveIslands(self, labels, label, min_count, ignore_neg1=False):
+        """Give the regions of label smaller than min_count the most frequent label around them"""
+        components, n = self.Components(labels == label)
+        if n == 0:
+            return labels
+        sizes = np.bincount(components[components >= 0], minlength=n)
+        small = np.flatnonzero(sizes < min_count)
+        if len(small) == 0 or not ignore_neg1:
+            return labels
+
+        # islands of the same label never touch each other, so they can all be relabeled at once
+        neighbor_labels = self.NeighborLabels(labels, components, small, label)
+        # -1 means no neighbor, the island keeps its label
+        lut = np.full(n, -1, dtype=labels.dtype)
+        for c, l in neighbor_labels.items():
+            lut[c] = l
+        new_labels = lut[np.maximum(components, 0)]
+        relabel = (components >= 0) & (new_labels != -1)
+        labels[relabel] = new_labels[relabel]
+        return labels
+
+    def DilateLabel(self, labels, label, iterations=2, dilateOverTarget=False, target=None):
+        """Grow label by one ring of neighbors per iteration"""
+        while iterations > 0:
+            frontier = self.Touching(labels == label)
+            if dilateOverTarget:
+                frontier &= labels == target
+            else:
+                frontier &= labels != label
+            labels[frontier] = label
+            iterations -= 1
+        return labels
+
+    def ErodeLabel(self, labels, label, ignore_label=None, iterations=math.inf, target=None):
+        """Shrink label by one ring per iteration, each eroded point takes the label of its first eligible neighbor"""
+        pid_labels = np.flatnonzero(labels == label)
+
+        while len(pid_labels) and iterations != 0:
+            eligible = labels != label
+            if ignore_label is not None:
+                eligible &= labels != ignore_label
+            if target is not None:
+                eligible &= labels == target
+
+            first = self.FirstNeighbor(pid_labels, eligible)
+            eroded = first >= 0
+            if not eroded.any():
+                break
+            labels[pid_labels[eroded]] = labels[first[eroded]]
+            pid_labels = pid_labels[~eroded]
+            iterations -= 1
+        return labels
+
+
+def LabelArray(labels):
+    """numpy view of a single component vtk array, or the numpy array itself"""
+    if isinstance(labels, np.ndarray):
+        return labels
+    return vtk_to_numpy(labels).reshape(-1)
+
+
+def _Graph(vtkdata, graph):
+    return graph if graph is not None else MeshGraph.FromSurf(vtkdata)
+
+
+def _Modified(labels):
+    if not isinstance(labels, np.ndarray):
+        labels.Modified()
+
+
+def ConnectedRegion(vtkdata, pid, labels, label, pid_visited, graph=None):
+
+    graph = _Graph(vtkdata, graph)
+    arr = LabelArray(labels)
+    components, _ = graph.Components((arr == label) & (pid_visited == 0) | (np.arange(len(arr)) == pid))
+    connected_pids = np.flatnonzero(components == components[pid])
+    pid_visited[connected_pids] = 1
+
+    return connected_pids
+
+
+def NeighborLabel(vtkdata, labels, label, connected_pids, graph=None):
+    graph = _Graph(vtkdata, graph)
+    arr = LabelArray(labels)
+    components = np.full(len(arr), -1, dtype=np.int64)
+    components[np.asarray(connected_pids, dtype=np.int64)] = 0
+    neighbor_labels = graph.NeighborLabels(arr, components, [0], label)
+
+    return neighbor_labels.get(0, -1)
+
+
+def RemoveIslands(vtkdata, labels, label, min_count, ignore_neg1=False, graph=None):
+
+    _Graph(vtkdata, graph).RemoveIslands(LabelArray(labels), label, min_count, ignore_neg1=ignore_neg1)
+    _Modified(labels)
 
 
 def ErodeLabel(
-    vtkdata, labels, label, ignore_label=None, iterations=math.inf, target=None
+    vtkdata, labels, label, ignore_label=None, iterations=math.inf, target=None, graph=None
 ):
 
-    pid_labels = []
-    for pid in range(labels.GetNumberOfTuples()):
-        if labels.GetTuple(pid)[0] == label:
-            pid_labels.append(pid)
-
-    while pid_labels and iterations != 0:
-        pid_labels_remain = pid_labels
-        pid_labels = []
-
-        all_neighbor_pids = []
-        all_neighbor_labels = []
-
-        while pid_labels_remain:
-
-            pid = pid_labels_remain.pop()
-
-            neighbor_pids = GetNeighbors(vtkdata, pid)
-            is_neighbor = False
+    _Graph(vtkdata, graph).ErodeLabel(
+        LabelArray(labels), label, ignore_label=ignore_label, iterations=iterations, target=target
+    )
+    _Modified(labels)
 
-            for npid in neighbor_pids:
-                neighbor_label = labels.GetTuple(npid)[0]
-                if (
-                    neighbor_label != label
-                    and (ignore_label == None or neighbor_label != ignore_label)
-                    and (target == None or neighbor_label == target)
-                ):
 
-                    all_neighbor_pids.append(pid)
-                    all_neighbor_labels.append(neighbor_label)
-                    is_neighbor = True
-                    break
-
-            if not is_neighbor:
-                pid_labels.append(pid)
+def DilateLabel(
+    vtkdata, labels, label, iterations=2, dilateOverTarget=False, target=None, graph=None
+):
 
-        if all_neighbor_pids:
-            for npid, nlabel in zip(all_neighbor_pids, all_neighbor_labels):
-                labels.SetTuple(int(npid), (nlabel,))
-        else:
-            break
-        iterations -= 1
+    _Graph(vtkdata, graph).DilateLabel(
+        LabelArray(labels), label, iterations=iterations, dilateOverTarget=dilateOverTarget, target=target
+    )
+    _Modified(labels)
 
 
-def DilateLabel(
-    vtkdata, labels, label, iterations=2, dilateOverTarget=False, target=None
-):
+def GetNeighbors(vtkdata, pid, graph=None):
 
-    pid_labels = []
-
-    while iterations > 0:
-        # Get all neighbors to the 'label' that have a different label
-        all_neighbor_labels = []
-        for pid in range(labels.GetNumberOfTuples()):
-            if labels.GetTuple(pid)[0] == label:
-                neighbor_pids = GetNeighbors(vtkdata, pid)
-                pid_labels.append(pid)
-
-                for npid in neighbor_pids:
-                    neighbor_label = labels.GetTuple(npid)[0]
-
-                    if dilateOverTarget:
-                        if neighbor_label == target:
-                            all_neighbor_labels.append(npid)
-                    else:
-                        if neighbor_label != label:
-                            all_neighbor_labels.append(npid)
-
-        # Dilate them, i.e., change the value to label
-        for npid in all_neighbor_labels:
-            labels.SetTuple(int(npid), (label,))
-
-        iterations -= 1
-
-
-def GetNeighborIds(vtkdata, pid, labels, label, pid_visited):
-    cells_id = vtk.vtkIdList()
-    vtkdata.GetPointCells(pid, cells_id)
-    neighbor_pids = []
-
-    for ci in range(cells_id.GetNumberOfIds()):
-        points_id_inner = vtk.vtkIdList()
-        vtkdata.GetCellPoints(cells_id.GetId(ci), points_id_inner)
-        for pi in range(points_id_inner.GetNumberOfIds()):
-            pid_inner = points_id_inner.GetId(pi)
-            if (
-                labels.GetTuple(pid_inner)[0] == label
-                and pid_inner != pid
-                and pid_visited[pid_inner] == 0
-            ):
-                pid_visited[pid_inner] = 1
-                neighbor_pids.append(pid_inner)
-
-    return np.unique(neighbor_pids).tolist()
-
-
-def GetNeighbors(vtkdata, pid):
-    cells_id = vtk.vtkIdList()
-    vtkdata.GetPointCells(pid, cells_id)
-    neighbor_pids = []
-
-    for ci in range(cells_id.GetNumberOfIds()):
-        points_id_inner = vtk.vtkIdList()
-        vtkdata.GetCellPoints(cells_id.GetId(ci), points_id_inner)
-        for pi in range(points_id_inner.GetNumberOfIds()):
-            pid_inner = points_id_inner.GetId(pi)
-            if pid_inner != pid:
-                neighbor_pids.append(pid_inner)
-
-    return np.unique(neighbor_pids).tolist()
+    return _Graph(vtkdata, graph).Neighbors(pid).tolist()
@@ -6,6 +6,7 @@ import shutil
 import argparse
 import platform
 import logging
+import time
 
 import pyvista as pv
 import SimpleITK as sitk
@@ -60,106 +61,112 @@ def align_by_landmarks(moving_mesh, moving_lms, fixed_lms):
     
     return aligned_mesh, matrix, aligned_lms
 
-def run_icp_point_to_plane(moving_mesh, fixed_mesh, max_dist=1.5):
+class PointToPlaneICP:
     """
-    ICP Point-to-Plane
+    Rigid point-to-plane ICP onto a fixed surface.
+
+    The KD-tree and the point normals of the fixed surface are built once, so the
+    same engine registers both jaws onto the CBCT surface. The moving cloud is
+    registered coarse-to-fine on strided subsets of its points, each iteration
+    solves the linearised point-to-plane least squares problem (small angle
+    rotation) and a level stops when the update is smaller than the tolerance.
     """
-    from scipy.spatial import cKDTree
-    from scipy.spatial.transform import Rotation
-    
-    # 1. Extract points
-    moving_pts = np.asarray(moving_mesh.points)
-    fixed_pts = np.asarray(fixed_mesh.points)
-    
-    fixed_mesh_copy = fixed_mesh.copy()
-    fixed_mesh_copy.compute_normals(inplace=True)
-    fixed_normals = np.asarray(fixed_mesh_copy.cell_data['Normals'] 
-                               if 'Normals' in fixed_mesh_copy.cell_data 
-                               else fixed_mesh_copy.point_data['Normals'])
-    
-    transformation = np.eye(4)
-    moving_pts_transformed = moving_pts.copy()
-    
-    print("Optimisation Point-to-Plane on going...")
-    
-    max_iterations = 2000
-    prev_rmse = np.inf
-    rmse_threshold = 1e-8
-    fitness_threshold = 1e-8
-    prev_fitness = 0
-    
-    for iteration in range(max_iterations):
-        # 2. Find correspondances (nearest neighbors)
-        kdtree = cKDTree(fixed_pts)
-        distances, indices = kdtree.query(moving_pts_transformed, k=1)
-        
-        # Filter the points too far
+
+    def __init__(self, fixed_mesh):
+        from scipy.spatial import cKDTree
+
+        fixed_mesh_copy = fixed_mesh.copy()
+        fixed_mesh_copy.compute_normals(point_normals=True, cell_normals=False, inplace=True)
+        self.fixed_pts = np.asarray(fixed_mesh_copy.points, dtype=np.float64)
+        self.fixed_normals = np.asarray(fixed_mesh_copy.point_data['Normals'], dtype=np.float64)
+        self.kdtree = cKDTree(self.fixed_pts)
+
+    def Step(self, source, max_dist):
+        """
+        One linearised point-to-plane step for the points source
+
+        Returns:
+            (4, 4) update, or None without enough correspondences, inlier RMSE, fitness
+        """
+        from scipy.spatial.transform import Rotation
+
+        distances, indices = self.kdtree.query(source, k=1, distance_upper_bound=max_dist)
         valid_mask = distances < max_dist
-        valid_indices = indices[valid_mask]
-        valid_moving = moving_pts_transformed[valid_mask]
-        valid_distances = distances[valid_mask]
-        
-        # Calcul fitness and RMSE
-        inlier_rmse = np.sqrt(np.mean(valid_distances**2)) if len(valid_distances) > 0 else np.inf
-        fitness = np.sum(valid_mask) / len(moving_pts)
-        
-        # check convergence
-        rmse_change = abs(prev_rmse - inlier_rmse)
-        fitness_change = abs(prev_fitness - fitness)
-        
-        if rmse_change < rmse_threshold and fitness_change < fitness_threshold:
-            print(f"Convergence reached at iteration {iteration}")
-            break
-        
-        prev_rmse = inlier_rmse
-        prev_fitness = fitness
-        
-        # 3. Calcul of the transformation (Point-to-Plane with SVD)
-        if len(valid_indices) < 3:
-            print(f"Iteration {iteration}: Not enough correspondances")
-            break
-        
-        # corresponding Points 
-        source = valid_moving
-        target = fixed_pts[valid_indices]
-        
-        # Center points
-        source_center = np.mean(source, axis=0)
-        target_center = np.mean(target, axis=0)
-        source_centered = source - source_center
-        target_centered = target - target_center
-        
-        # covariance Matrix 
-        H = source_centered.T @ target_centered
-        U, S, Vt = np.linalg.svd(H)
-        R = Vt.T @ U.T
-        
-        # Assure a clean rotation (det(R) = 1)
-        if np.linalg.det(R) < 0:
-            Vt[-1, :] *= -1
-            R = Vt.T @ U.T
-        
-        t = target_center - R @ source_center
-        
-        # 4. Apply the transformation
+        fitness = np.sum(valid_mask) / len(source)
+        if np.sum(valid_mask) < 6:
+            return None, np.inf, fitness
+        inlier_rmse = np.sqrt(np.mean(distances[valid_mask]**2))
+
+        p = source[valid_mask]
+        q = self.fixed_pts[indices[valid_mask]]
+        n = self.fixed_normals[indices[valid_mask]]
+
+        # n . (p + w x p + t - q) = 0  ->  [p x n, n] . [w, t] = n . (q - p)
+        A = np.hstack([np.cross(p, n), n])
+        b = np.einsum('ij,ij->i', n, q - p)
+        x = np.linalg.lstsq(A.T @ A, A.T @ b, rcond=None)[0]
+
         delta_transform = np.eye(4)
-        delta_transform[:3, :3] = R
-        delta_transform[:3, 3] = t
-        
-        transformation = delta_transform @ transformation
-        
-        # Transform points
-        moving_pts_homogeneous = np.hstack([moving_pts, np.ones((moving_pts.shape[0], 1))])
-        moving_pts_transformed = (moving_pts_homogeneous @ transformation.T)[:, :3]
-        
-        if (iteration + 1) % 100 == 0 or iteration < 10:
-            print(f"  Iteration {iteration + 1}: RMSE = {inlier_rmse:.6f}, Fitness = {fitness:.4f}")
-    
+        delta_transform[:3, :3] = Rotation.from_rotvec(x[:3]).as_matrix()
+        delta_transform[:3, 3] = x[3:]
+        return delta_transform, inlier_rmse, fitness
+
+    def __call__(self, moving_pts, max_dist=1.5, levels=(16, 4, 1), max_iterations=50, tolerance=1e-6, transformation=None):
+        """
+        Args:
+            moving_pts : (N, 3) points of the moving surface
+            levels : stride of the subset of moving points used at each level, coarse to fine
+            max_iterations : maximum number of iterations per level
+            tolerance : a level stops when the rotation (rad) and the translation of an update are both below it
+
+        Returns:
+            (4, 4) transformation, inlier RMSE and fitness on all the moving points
+        """
+        moving_pts = np.asarray(moving_pts, dtype=np.float64)
+        transformation = np.eye(4) if transformation is None else np.array(transformation, dtype=np.float64)
+
+        for step in levels:
+            subset = moving_pts[::step]
+            for iteration in range(max_iterations):
+                source = subset @ transformation[:3, :3].T + transformation[:3, 3]
+                delta_transform, inlier_rmse, fitness = self.Step(source, max_dist)
+                if delta_transform is None:
+                    logger.warning(f"ICP level 1/{step}, iteration {iteration}: not enough correspondences")
+                    break
+                transformation = delta_transform @ transformation
+
+                angle = np.arccos(np.clip((np.trace(delta_transform[:3, :3]) - 1) / 2, -1, 1))
+                if angle < tolerance and np.linalg.norm(delta_transform[:3, 3]) < tolerance:
+                    break
+            logger.debug(f"ICP level 1/{step} ({len(subset)} points): {iteration + 1} iterations, RMSE = {inlier_rmse:.6f}, Fitness = {fitness:.4f}")
+
+        source = moving_pts @ transformation[:3, :3].T + transformation[:3, 3]
+        distances, _ = self.kdtree.query(source, k=1, distance_upper_bound=max_dist)
+        valid_mask = distances < max_dist
+        fitness = np.sum(valid_mask) / len(moving_pts)
+        inlier_rmse = np.sqrt(np.mean(distances[valid_mask]**2)) if np.any(valid_mask) else np.inf
+        return transformation, inlier_rmse, fitness
+
+
+def run_icp_point_to_plane(moving_mesh, fixed_mesh, max_dist=1.5, engine=None, levels=(16, 4, 1), tolerance=1e-6):
+    """
+    ICP Point-to-Plane
+
+    engine : PointToPlaneICP of fixed_mesh, built here if not given
+    """
+    if engine is None:
+        engine = PointToPlaneICP(fixed_mesh)
+
+    tic = time.time()
+    transformation, inlier_rmse, fitness = engine(
+        moving_mesh.points, max_dist=max_dist, levels=levels, tolerance=tolerance
+    )
+
     # 5. Apply final transformation
     final_mesh = moving_mesh.transform(transformation, inplace=False)
-    
-    print(f"ICP Finished. Fitness: {fitness:.4f}, Inlier RMSE: {inlier_rmse:.4f}")
-    
+
+    logger.info(f"ICP Finished in {time.time() - tic:.2f}s. Fitness: {fitness:.4f}, Inlier RMSE: {inlier_rmse:.4f}")
+
     return final_mesh, transformation
 
 def save_registered_ios(registered_vtk_upper,registered_vtk_lower,output_path,num_patient):
@@ -415,14 +422,17 @@ def main(args):
             logger.debug(f"IOS Lower landmarks after alignment:\n{aligned_lms_ios_lower}")
             
             # 3. RUN ICP REGISTRATION
+            # both jaws are registered onto the same CBCT surface
+            icp_engine = PointToPlaneICP(cbct_surface)
+
             logger.debug(f"Running ICP for upper jaw")
             registered_ios_upper, mat_icp_upper = run_icp_point_to_plane(
-                aligned_ios_upper, cbct_surface, max_dist=1.0
+                aligned_ios_upper, cbct_surface, max_dist=1.0, engine=icp_engine
             )
             
             logger.debug(f"Running ICP for lower jaw")
             registered_ios_lower, mat_icp_lower = run_icp_point_to_plane(
-                aligned_ios_lower, cbct_surface, max_dist=1.0
+                aligned_ios_lower, cbct_surface, max_dist=1.0, engine=icp_engine
             )
             logger.info(f"ICP registration completed for patient {patient_id}")
             
@@ -1,11 +1,13 @@
 import os
 import vtk
+import itertools
 import numpy as np
 from vtk.util.numpy_support import vtk_to_numpy
 from ASO_IOS_utils.utils import LoadJsonLandmarks, ReadSurf
 from ASO_IOS_utils.transformation import (
     TranslationDict,
     RotationMatrix,
+    RotationMatrixBatch,
     ApplyTransform,
     TransformDict,
 )
@@ -161,11 +163,6 @@ class InitIcp:
         source = {k: source[k] for k in sorted(source)}
         target = {k: target[k] for k in sorted(target)}
 
-        script_dir = os.path.dirname(__file__)
-        if not os.path.exists(os.path.join(script_dir, "cache")):
-            os.mkdir(os.path.join(script_dir, "cache"))
-        np.save(os.path.join(script_dir, "cache", "source.npy"), source)
-        np.save(os.path.join(script_dir, "cache", "target.npy"), target)
         best = self.FindOptimalLandmarks(source, target)
 
         (
@@ -261,41 +258,86 @@ class InitIcp:
 
         return source, TransformMatrix
 
-    def FindOptimalLandmarks(self, source, target):
+    def FindOptimalLandmarks(self, source, target, max_elements=2**22):
         """
         Find the optimal landmarks to use for the Init ICP
 
+        Every ordered triplet of landmarks is evaluated, so the result is the
+        same at every run. Ties go to the first triplet in sorted key order.
+
         Parameters
         ----------
         source : dict
             source landmarks
         target : dict
             target landmarks
+        max_elements : int
+            bound on the number of transformed points held in memory at once
 
         Returns
         -------
         list
             list of the optimal landmarks
         """
+        labels = list(source.keys())
+        n = len(labels)
+        source_arr = np.stack([np.asarray(source[k]) for k in labels])
+        target_arr = np.stack([np.asarray(target[k]) for k in labels])
 
-        # remplacer 210 by n*(n-1)*(n-2)   (n)
-        dist, LMlist, ii = [], [], 0
-        script_dir = os.path.dirname(__file__)
-        n = len(source)
-        while len(dist) < n * (n - 1) * (n - 2) and ii < 2500:
-            ii += 1
-
-            source = np.load(
-                os.path.join(script_dir, "cache", "source.npy"), allow_pickle=True
-            ).item()
-            firstpick, secondpick, thirdpick, d = self.InitICP(
-                source, target, search=True
-            )
-            if [firstpick, secondpick, thirdpick] not in LMlist:
-                dist.append(d)
-                LMlist.append([firstpick, secondpick, thirdpick])
+        triplets = np.array(list(itertools.permutations(range(n), 3)), dtype=np.int64)
+        chunk = max(1, max_elements // n)
+
+        best, best_dist = triplets[0], np.inf
+        for start in range(0, len(triplets), chunk):
+            batch = triplets[start : start + chunk]
+            dist = self.TripletMeanDistances(source_arr, target_arr, batch)
+            dist = np.where(np.isnan(dist), np.inf, dist)
+            idx = int(np.argmin(dist))
+            if dist[idx] < best_dist:
+                best, best_dist = batch[idx], dist[idx]
+
+        return [labels[i] for i in best]
+
+    def TripletMeanDistances(self, source, target, triplets):
+        """
+        Vectorized InitICP: mean distance after the init transform of each triplet
+
+        Parameters
+        ----------
+        source : numpy array
+            (N, 3) source landmarks
+        target : numpy array
+            (N, 3) target landmarks
+        triplets : numpy array
+            (M, 3) indices of the first, second and third picks
+
+        Returns
+        -------
+        numpy array
+            (M,) mean distance between the transformed source and the target,
+            nan where the transform is undefined
+        """
+        first, second, third = triplets.T
+        m = np.arange(len(triplets))
 
-        return LMlist[dist.index(min(dist))]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            # translation on the first pick
+            src = source[None] + (target[first] - source[first])[:, None]
+
+            # rotation aligning the second pick
+            v1 = np.absolute(src[m, second] - src[m, first])
+            v2 = np.absolute(target[second] - target[first])
+            angle, axis = self.AngleAndAxisBatch(v2, v1)
+            src = np.einsum("mab,mnb->mna", RotationMatrixBatch(axis, angle), src)
+
+            # rotation around the first to second pick direction for the third pick
+            v1 = np.absolute(src[m, third] - src[m, first])
+            v2 = np.absolute(target[third] - target[first])
+            angle, _ = self.AngleAndAxisBatch(v2, v1)
+            axis = np.absolute(src[m, second] - src[m, first])
+            src = np.einsum("mab,mnb->mna", RotationMatrixBatch(axis, angle), src)
+
+            return np.linalg.norm(src - target[None], axis=2).mean(axis=1)
 
     def ComputeMeanDistance(self, source, target):
         """
@@ -348,6 +390,26 @@ class InitIcp:
         # axis = axis / np.linalg.norm(axis)
         return angle, axis
 
+    def AngleAndAxisBatch(self, v1, v2):
+        """
+        Vectorized AngleAndAxisVectors for (M, 3) arrays of vectors
+
+        Returns
+        -------
+        angle : numpy array
+            (M,) angles between the vectors
+        axis : numpy array
+            (M, 3) axes of rotation between the vectors
+        """
+        v1_u = v1 / np.amax(v1, axis=1, keepdims=True)
+        v2_u = v2 / np.amax(v2, axis=1, keepdims=True)
+        angle = np.arccos(
+            np.sum(v1_u * v2_u, axis=1)
+            / (np.linalg.norm(v1_u, axis=1) * np.linalg.norm(v2_u, axis=1))
+        )
+        axis = np.cross(v1_u, v2_u)
+        return angle, axis
+
 
 class vtkTeeth:
     def __init__(self, list_teeth, property=None):
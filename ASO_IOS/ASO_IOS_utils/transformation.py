@@ -57,6 +57,40 @@ def RotationMatrix(axis, theta):
     )
 
 
+def RotationMatrixBatch(axis, theta):
+    """
+    Vectorized RotationMatrix for a batch of axes and angles
+
+    Parameters
+    ----------
+    axis : np.array
+        (M, 3) axes of rotation
+    theta : np.array
+        (M,) angles of rotation in radians
+
+    Returns
+    -------
+    np.array
+        (M, 3, 3) rotation matrices
+    """
+
+    axis = np.asarray(axis, dtype=np.float64)
+    theta = np.asarray(theta, dtype=np.float64)
+    axis = axis / np.linalg.norm(axis, axis=1, keepdims=True)
+    a = np.cos(theta / 2.0)
+    b, c, d = (-axis * np.sin(theta / 2.0)[:, None]).T
+    aa, bb, cc, dd = a * a, b * b, c * c, d * d
+    bc, ad, ac, ab, bd, cd = b * c, a * d, a * c, a * b, b * d, c * d
+    return np.stack(
+        [
+            np.stack([aa + bb - cc - dd, 2 * (bc + ad), 2 * (bd - ac)], axis=-1),
+            np.stack([2 * (bc - ad), aa + cc - bb - dd, 2 * (cd + ab)], axis=-1),
+            np.stack([2 * (bd + ac), 2 * (cd - ab), aa + dd - bb - cc], axis=-1),
+        ],
+        axis=1,
+    )
+
+
 def TranslationDict(source, transform):
     """
     Apply translation to source dictionary of landmarks
@@ -0,0 +1,293 @@
+import SimpleITK as sitk
+import logging
+import numpy as np
+import os,json,sys,re,time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from Crop_Volumes_utils.FilesType import Search, ChangeKeyDict
+from Crop_Volumes_utils.GenerateVTKfromSeg import convertNiftiToVTK
+from Crop_Volumes_utils.StreamCrop import CropVolume, ReadHeader, ROIBounds
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# ===== Logging Configuration =====
+logger = logging.getLogger("Autocrop3D_BatchCrop")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+if logger.handlers:
+    logger.handlers.clear()
+console_handler = logging.StreamHandler(sys.stdout)
+console_handler.setLevel(logging.INFO)
+formatter = logging.Formatter('%(name)s - %(levelname)s - (%(filename)s:%(lineno)d) - %(message)s')
+console_handler.setFormatter(formatter)
+logger.addHandler(console_handler)
+
+SCAN_EXTENSIONS = (".nii.gz",".nii",".nrrd.gz",".nrrd",".gipl.gz",".gipl")
+
+# the patient name is the file name up to the first of these tags (or the first '.')
+PATIENT_TAGS = ('_Scan','_scan','_Seg','_seg','_Or','_OR','_MAND','_MD','_MAX','_MX','_CB','_lm','_T2','_T1','_Cl','.')
+PATIENT_PATTERN = re.compile('|'.join(re.escape(tag) for tag in PATIENT_TAGS))
+
+
+def PatientName(path):
+    return PATIENT_PATTERN.split(os.path.basename(path), maxsplit=1)[0]
+
+
+# default number of workers, whatever the number of cores
+MAX_DEFAULT_WORKERS = 4
+# share of the available memory the running crops may use by default
+DEFAULT_MEMORY_SHARE = 0.5
+# one file per output folder recording the parameters each output was cropped with
+MANIFEST_NAME = '.autocrop3d_manifest.json'
+
+
+def Workers(workers=None):
+    '''
+    Number of scans cropped at the same time: workers if > 0, else the AUTOCROP_WORKERS env var,
+    else the number of cores up to MAX_DEFAULT_WORKERS
+    '''
+    if not workers:
+        workers = os.environ.get("AUTOCROP_WORKERS", min(os.cpu_count() or 1, MAX_DEFAULT_WORKERS))
+    return max(int(workers), 1)
+
+
+def AvailableMemory():
+    '''Available RAM in bytes, None if it can't be known'''
+    if psutil is not None:
+        return psutil.virtual_memory().available
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def MemoryBudget(memory_gb=None):
+    '''
+    Memory (bytes) the scans being cropped may use together: memory_gb if > 0, else the
+    AUTOCROP_MEMORY_GB env var, else DEFAULT_MEMORY_SHARE of the available RAM (no limit if unknown)
+    '''
+    if not memory_gb:
+        memory_gb = os.environ.get("AUTOCROP_MEMORY_GB")
+    if memory_gb:
+        return float(memory_gb) * 1024**3
+    available = AvailableMemory()
+    return available * DEFAULT_MEMORY_SHARE if available else None
+
+
+def DiscoverJobs(path_input, ROI_Path, OutputPath, suffix_namefile):
+    '''
+    List the scans to crop with their ROI and output paths, before cropping anything
+
+    Output: list of dict with the keys patient, key (extension), scan, roi, out, vtk_out
+    '''
+    ScanList = Search(path_input, *SCAN_EXTENSIONS)
+
+    # Include case with a folder of ROI corresponding to a folder of scans
+    ROIList = Search(ROI_Path,".mrk.json")
+    ROI_dict = ChangeKeyDict(ROIList) if len(ROIList['.mrk.json']) >1 else None
+
+    jobs = []
+    for key,data in ScanList.items():
+        for patient_path in data:
+            patient = PatientName(patient_path)
+
+            roi = ROI_Path
+            if ROI_dict is not None:
+                if patient not in ROI_dict:
+                    logger.warning('No ROI for patient:'+str(patient))
+                    continue
+                roi = ROI_dict[patient]
+
+            # Create the output path
+            # relative_path = all folder to get to the file we want in the input
+            relative_path = os.path.relpath(patient_path,path_input)
+            filename_interm = os.path.basename(patient_path).split('.')[0]
+            filename = filename_interm + "_"+ suffix_namefile + key
+
+            vtk_filename = filename_interm + "_" + suffix_namefile + "_vtk.vtk"
+            ScanOutPath = os.path.join(OutputPath,relative_path).replace(os.path.basename(relative_path),filename)
+            VTKOutPath = os.path.join(OutputPath,relative_path).replace(os.path.basename(relative_path),vtk_filename)
+
+            jobs.append({'patient':patient,'key':key,'scan':patient_path,'roi':roi,'out':ScanOutPath,'vtk_out':VTKOutPath})
+    return jobs
+
+
+def ManifestPath(job):
+    return os.path.join(os.path.dirname(job['out']), MANIFEST_NAME)
+
+
+def ReadManifest(path):
+    '''{output file name: crop stamp} of an output folder, empty if missing or unreadable'''
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+
+def WriteManifest(path, manifest):
+    tmp_path = path + '.tmp'
+    with open(tmp_path,'w') as f:
+        json.dump(manifest,f,indent=1)
+    os.replace(tmp_path, path)
+
+
+def CropStamp(job, originalSize):
+    '''Parameters an output is cropped with'''
+    ROI_Center, ROI_Size = LoadROI(job['roi'])
+    return {'scan':os.path.abspath(job['scan']),'center':ROI_Center.tolist(),'size':ROI_Size.tolist(),'originalSize':bool(originalSize)}
+
+
+def IsUpToDate(job, stamp, manifest):
+    '''The output is newer than the scan and the ROI, and the manifest of its folder records the same stamp'''
+    if not os.path.isfile(job['out']) or manifest.get(os.path.basename(job['out'])) != stamp:
+        return False
+    return os.path.getmtime(job['out']) >= max(os.path.getmtime(job['scan']), os.path.getmtime(job['roi']))
+
+
+def LoadROI(roi_path):
+    ROI = json.load(open(roi_path))['markups'][0]
+    return np.array(ROI['center']), np.array(ROI['size'])
+
+
+def EstimateMemory(job, originalSize):
+    '''Bytes needed to crop a scan, from its header: the ROI, and the whole scan when the original size is kept'''
+    reader = ReadHeader(job['scan'])
+    Lower, Upper = ROIBounds(reader, *LoadROI(job['roi']))
+    pixel_size = sitk.Image([1,1,1], reader.GetPixelID(), reader.GetNumberOfComponents()).GetSizeOfPixelComponent()
+    pixel_size *= reader.GetNumberOfComponents()
+
+    n_voxels = int(np.prod([max(u - l, 0) for l, u in zip(Lower, Upper)]))
+    if originalSize:
+        n_voxels += int(np.prod(reader.GetSize()))
+    return n_voxels * pixel_size
+
+
+def CropJob(job, originalSize):
+    '''
+    Crop one scan, write it and its surface for the segmentations
+
+    Output: (status, seconds, error message)
+    '''
+    tic = time.time()
+    try:
+        img_crop, _, _ = CropVolume(job['scan'], *LoadROI(job['roi']), originalSize=originalSize)
+        os.makedirs(os.path.dirname(job['out']), exist_ok=True)
+        sitk.WriteImage(img_crop,job['out'])
+        del img_crop
+    except Exception as e:
+        return 'failed', time.time() - tic, str(e)
+
+    if "seg" in job['out'].lower():
+        try :
+            convertNiftiToVTK(job['out'],job['vtk_out'])
+        except :
+            pass
+    return 'cropped', time.time() - tic, None
+
+
+class BatchCrop:
+    '''
+    Crop a list of scans with a bounded pool of workers.
+
+    SimpleITK releases the GIL while reading, resampling and writing, so the scans are
+    cropped by threads and ITK's own threads are shared between the workers. A scan is
+    only started when its estimated memory fits in the budget next to the running ones,
+    the biggest scan alone is always allowed. Outputs newer than their scan and ROI and
+    cropped with the same ROI and originalSize are skipped: the parameters of each output
+    are recorded in a MANIFEST_NAME file of its output folder.
+    '''
+
+    def __init__(self, jobs, originalSize, workers=None, memory_budget=None, skip_up_to_date=True, progress=None) -> None:
+        '''
+        Input: jobs from DiscoverJobs, originalSize to keep the size of the scans,
+                workers and memory_budget (bytes) default to Workers() and MemoryBudget(),
+                progress called with the number of finished scans after each one
+        '''
+        self.jobs = jobs
+        self.originalSize = originalSize
+        self.workers = Workers(workers)
+        self.memory_budget = memory_budget if memory_budget is not None else MemoryBudget()
+        self.skip_up_to_date = skip_up_to_date
+        self.progress = progress
+        self.results = []
+        self.wall_time = 0.0
+        # manifests of the output folders, only touched by the scheduling thread
+        self.manifests = {}
+
+    def _Manifest(self, job):
+        path = ManifestPath(job)
+        if path not in self.manifests:
+            self.manifests[path] = ReadManifest(path)
+        return path, self.manifests[path]
+
+    def _Finished(self, job, status, seconds, error=None, stamp=None):
+        self.results.append((job, status, seconds))
+        if status == 'failed':
+            logger.error("Error for patient: "+str(job['patient']))
+            logger.error('The error says: '+str(error))
+        if status == 'cropped' and stamp is not None:
+            path, manifest = self._Manifest(job)
+            manifest[os.path.basename(job['out'])] = stamp
+            try:
+                WriteManifest(path, manifest)
+            except Exception as e:
+                logger.warning(f"Could not write {path}: {e}")
+        if self.progress is not None:
+            self.progress(len(self.results))
+
+    def Run(self):
+        tic = time.time()
+        pending = []
+        for job in self.jobs:
+            try:
+                stamp = CropStamp(job, self.originalSize)
+                if self.skip_up_to_date and IsUpToDate(job, stamp, self._Manifest(job)[1]):
+                    self._Finished(job, 'up to date', 0.0)
+                    continue
+                pending.append((job, EstimateMemory(job, self.originalSize), stamp))
+            except Exception as e:
+                self._Finished(job, 'failed', 0.0, e)
+
+        # ITK threads of each crop, so the workers do not oversubscribe the cores
+        sitk.ProcessObject_SetGlobalDefaultNumberOfThreads(max((os.cpu_count() or 1) // self.workers, 1))
+
+        running = {}
+        in_use = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while pending or running:
+                while pending and len(running) < self.workers:
+                    job, memory, stamp = pending[0]
+                    if running and self.memory_budget is not None and in_use + memory > self.memory_budget:
+                        break
+                    pending.pop(0)
+                    running[executor.submit(CropJob, job, self.originalSize)] = (job, memory, stamp)
+                    in_use += memory
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job, memory, stamp = running.pop(future)
+                    in_use -= memory
+                    self._Finished(job, *future.result(), stamp=stamp)
+
+        self.wall_time = time.time() - tic
+        return self.results
+
+    def Report(self):
+        '''Log the time of each scan and the throughput of the batch'''
+        for job, status, seconds in sorted(self.results, key=lambda r: r[0]['scan']):
+            logger.info(f"{os.path.basename(job['scan'])}: {status}, {seconds:.2f}s")
+
+        cropped = [seconds for _, status, seconds in self.results if status == 'cropped']
+        skipped = sum(status == 'up to date' for _, status, _ in self.results)
+        failed = sum(status == 'failed' for _, status, _ in self.results)
+        throughput = len(cropped) / self.wall_time * 60 if self.wall_time > 0 else 0.0
+        speedup = sum(cropped) / self.wall_time if self.wall_time > 0 else 0.0
+        logger.info(
+            f"{len(cropped)} scan(s) cropped, {skipped} up to date, {failed} failed in {self.wall_time:.2f}s "
+            f"({throughput:.1f} scans/min, {speedup:.1f}x over sequential, {self.workers} worker(s), "
+            f"memory budget {'none' if self.memory_budget is None else f'{self.memory_budget / 1024**3:.1f} GB'})"
+        )
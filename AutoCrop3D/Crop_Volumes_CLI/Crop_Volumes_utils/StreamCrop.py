@@ -0,0 +1,111 @@
+import SimpleITK as sitk
+import logging
+import numpy as np
+import sys
+
+# ===== Logging Configuration =====
+logger = logging.getLogger("Autocrop3D_StreamCrop")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+if logger.handlers:
+    logger.handlers.clear()
+console_handler = logging.StreamHandler(sys.stdout)
+console_handler.setLevel(logging.INFO)
+formatter = logging.Formatter('%(name)s - %(levelname)s - (%(filename)s:%(lineno)d) - %(message)s')
+console_handler.setFormatter(formatter)
+logger.addHandler(console_handler)
+
+
+def ReadHeader(path):
+    '''
+    Read only the header of a scan (size, origin, spacing, direction), no voxel is loaded
+
+    Output: sitk.ImageFileReader of the scan, ready to extract a region
+    '''
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(path)
+    reader.ReadImageInformation()
+    return reader
+
+
+def PhysicalPointToContinuousIndex(reader, point):
+    '''
+    Same as Image.TransformPhysicalPointToContinuousIndex, from the header of the scan
+    '''
+    direction = np.array(reader.GetDirection()).reshape(3, 3)
+    spacing = np.array(reader.GetSpacing())
+    matrix = direction @ np.diag(spacing)
+    return np.linalg.solve(matrix, np.array(point) - np.array(reader.GetOrigin()))
+
+
+def ROIBounds(reader, ROI_Center, ROI_Size):
+    '''
+    Voxel bounds of a Region Of Interest in a scan, clipped to the scan
+
+    Output: Lower, Upper index of the ROI (Upper excluded)
+    '''
+    Lower = ROI_Center - ROI_Size / 2
+    Upper = ROI_Center + ROI_Size / 2
+
+    Lower = PhysicalPointToContinuousIndex(reader, Lower).astype(int)
+    Upper = PhysicalPointToContinuousIndex(reader, Upper).astype(int)
+
+    for i in range(3):
+        if Lower[i] > Upper[i]:
+            Lower[i], Upper[i] = Upper[i], Lower[i]
+    # Bounds checking
+    img_size = reader.GetSize()
+    Lower = [max(0, int(l)) for l in Lower]
+    Upper = [min(img_size[i], int(u)) for i, u in enumerate(Upper)]
+    return Lower, Upper
+
+
+def ReadROI(reader, Lower, Upper):
+    '''
+    Read only the voxels of [Lower, Upper[ from the scan
+
+    NRRD and uncompressed NIfTI are streamed from the file, the other formats
+    are read by ITK and cropped before reaching python.
+    '''
+    size_ROI = [int(Upper[i] - Lower[i]) for i in range(3)]
+    if min(size_ROI) <= 0:
+        raise ValueError(f'Empty ROI, Lower: {Lower}, Upper: {Upper}')
+    reader.SetExtractIndex([int(l) for l in Lower])
+    reader.SetExtractSize(size_ROI)
+    return reader.Execute()
+
+
+def PadToHeader(img_roi, reader, Lower):
+    '''
+    Put back the cropped scan in the grid of the original scan, with 0 outside of the ROI
+
+    The padding and the geometry only come from the header, the original voxels are not needed.
+    '''
+    img_size = reader.GetSize()
+    pad_lower = [int(l) for l in Lower]
+    pad_upper = [int(img_size[i] - Lower[i] - img_roi.GetSize()[i]) for i in range(3)]
+    img_crop = sitk.ConstantPad(img_roi, pad_lower, pad_upper, 0)
+
+    img_crop.SetOrigin(reader.GetOrigin())
+    img_crop.SetSpacing(reader.GetSpacing())
+    img_crop.SetDirection(reader.GetDirection())
+    return img_crop
+
+
+def CropVolume(patient_path, ROI_Center, ROI_Size, originalSize=False):
+    '''
+    Crop a scan to a Region Of Interest, reading only the voxels of the ROI
+
+    Input: Path of the scan, center and size of the ROI (physical space),
+            originalSize to keep the size and the geometry of the original scan
+
+    Output: Cropped scan, Lower and Upper index of the ROI
+    '''
+    reader = ReadHeader(patient_path)
+    Lower, Upper = ROIBounds(reader, np.array(ROI_Center), np.array(ROI_Size))
+    img_crop = ReadROI(reader, Lower, Upper)
+
+    if originalSize:
+        img_crop = PadToHeader(img_crop, reader, Lower)
+
+    return img_crop, Lower, Upper
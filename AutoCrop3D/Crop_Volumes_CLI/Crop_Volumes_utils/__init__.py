@@ -1,3 +1,5 @@
 from .CropCBCT import Crop
 from .FilesType import Search
-from .GenerateVTKfromSeg import convertNiftiToVTK
\ No newline at end of file
+from .GenerateVTKfromSeg import convertNiftiToVTK
+from .StreamCrop import CropVolume, ReadHeader, ReadROI, PadToHeader
+from .BatchCrop import BatchCrop, DiscoverJobs, PatientName
\ No newline at end of file
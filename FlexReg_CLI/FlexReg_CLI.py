@@ -5,6 +5,7 @@ import vtk
 import SimpleITK as sitk
 from FlexReg_Method.make_butterfly import butterflyPatch
 from FlexReg_Method.draw import drawPatch
+from FlexReg_Method.propagation import DEVICE
 from FlexReg_Method.ICP import vtkICP,ICP
 from FlexReg_Method.vtkSegTeeth import vtkMeshTeeth
 import os 
@@ -215,7 +216,7 @@ def main(args):
         
         if modelNode.GetPointData().HasArray(array_name):
             current_array = modelNode.GetPointData().GetArray(array_name)
-            current_tensor = torch.tensor(vtk_to_numpy(current_array)).to(torch.float32).cuda()
+            current_tensor = torch.tensor(vtk_to_numpy(current_array)).to(torch.float32).to(DEVICE)
             
             if final_array is None:
                 final_array = current_tensor
@@ -228,7 +229,7 @@ def main(args):
 
     if final_array is None:
         num_points = modelNode.GetNumberOfPoints()
-        V_label = torch.zeros(num_points).to(torch.float32).cuda()
+        V_label = torch.zeros(num_points).to(torch.float32).to(DEVICE)
     else:
         V_label = final_array
         
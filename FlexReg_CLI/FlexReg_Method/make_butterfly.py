@@ -4,7 +4,7 @@ import vtk
 from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk
 from FlexReg_Method.orientation import orientation
 from FlexReg_Method.util import vtkMeanTeeth, ToothNoExist
-from FlexReg_Method.propagation import Dilation
+from FlexReg_Method.propagation import Dilation, VertexAdjacency
 
 
 import sys
@@ -50,11 +50,111 @@ def Bezier_bled(point1,point2,point3,pas):
 
 
 
-def butterflyPatch(surf,
-            tooth_anterior_right,
-         tooth_anterior_left,
-         tooth_posterior_right,
-         tooth_posterior_left,
+def MirroredBezier(landmark_posterior,landmark_middle_posterior,landmark_anterior,pas=0.01):
+    """
+    Bezier curve from landmark_posterior to landmark_anterior, mirrored over the line joining them
+
+    Returns:
+        (S, 2) points of the curve in the xy plane
+    """
+    bezier = Bezier_bled(landmark_posterior[:2],landmark_middle_posterior[:2],landmark_anterior[:2],pas)
+    v_bezier = bezier - np.expand_dims(landmark_posterior[:2],axis=0)
+    v_norm_bezier = np.expand_dims(np.linalg.norm(v_bezier, axis=1),axis=0).T
+    v_norm_bezier[v_norm_bezier == 0] += 0.01
+    v_bezier = v_bezier / v_norm_bezier
+
+    v = np.expand_dims(landmark_anterior[:2] - landmark_posterior[:2], axis=0).T
+    v_norm = np.linalg.norm(v)
+    v = v / v_norm
+    P = np.matmul(v , v.T)
+
+    bezier_proj = ( P @ v_bezier.T).T *v_norm_bezier + landmark_posterior[:2]
+    return 2*bezier_proj - bezier
+
+
+class Grid2D:
+    """
+    Uniform grid over 2D points, for fixed radius queries without a (samples x points) distance matrix.
+
+    The points are sorted by cell once, a query only looks at the cells around each sample.
+    """
+
+    def __init__(self, points, cell_size):
+        """
+        Args:
+            points : (N, 2) tensor
+            cell_size : side of a cell, the radius of the queries is a good choice
+        """
+        self.points = points
+        self.cell_size = cell_size
+        self.origin = points.min(dim=0).values
+
+        cells = torch.floor((points - self.origin) / cell_size).to(torch.int64)
+        self.shape = cells.max(dim=0).values + 1
+        self.keys, self.order = torch.sort(cells[:, 0] * self.shape[1] + cells[:, 1])
+
+    def Query(self, samples, radius):
+        """Sorted ids of the points closer than radius to at least one of the samples (S, 2)"""
+        samples = torch.as_tensor(samples).to(self.points.dtype)
+        reach = int(np.ceil(radius / self.cell_size))
+        steps = torch.arange(-reach, reach + 1)
+        offsets = torch.stack(torch.meshgrid(steps, steps, indexing='ij'), dim=-1).reshape(-1, 2)
+
+        cells = torch.floor((samples - self.origin) / self.cell_size).to(torch.int64)
+        cells = (cells.unsqueeze(1) + offsets.unsqueeze(0)).reshape(-1, 2)
+        owners = torch.arange(samples.shape[0]).repeat_interleave(offsets.shape[0])
+        inside = (cells >= 0).all(dim=1) & (cells < self.shape).all(dim=1)
+        cells, owners = cells[inside], owners[inside]
+
+        keys = cells[:, 0] * self.shape[1] + cells[:, 1]
+        start = torch.searchsorted(self.keys, keys)
+        counts = torch.searchsorted(self.keys, keys, right=True) - start
+        # position in keys of every candidate point
+        shift = torch.repeat_interleave(start - (torch.cumsum(counts, dim=0) - counts), counts)
+        ids = self.order[torch.arange(int(counts.sum())) + shift]
+        owners = owners.repeat_interleave(counts)
+
+        dist = torch.sum(torch.square(self.points[ids] - samples[owners]), dim=1)
+        return torch.unique(ids[dist < radius ** 2])
+
+
+class ButterflyEditor:
+    """
+    Butterfly patches of one surface.
+
+    The orientation, the centroids of the teeth, the grid over the oriented vertices and the
+    adjacency are computed once. The vertices hit by each boundary curve are kept with the
+    landmarks they come from, so when a single ratio or adjust changes only the curves
+    using the moved landmark are searched again.
+    """
+
+    radius = 0.7
+
+    def __init__(self, surf, tooth_anterior_right, tooth_anterior_left, tooth_posterior_right, tooth_posterior_left):
+        self.teeth = (tooth_anterior_right, tooth_anterior_left, tooth_posterior_right, tooth_posterior_left)
+
+        surf_tmp = vtk.vtkPolyData()
+        surf_tmp.DeepCopy(surf)
+        centroidf = vtkMeanTeeth(list(self.teeth),property='Universal_ID')
+        # raise ToothNoExist
+        self.surf_tmp = orientation(surf_tmp,[[-0.5,-0.5,0],[0,0,0],[0.5,-0.5,0]],
+                                   ['3','5','12','14'])
+        self.centroid = centroidf(self.surf_tmp)
+
+        self.V = torch.tensor(vtk_to_numpy(self.surf_tmp.GetPoints().GetData())).to(torch.float32)
+        self.F = torch.tensor(vtk_to_numpy(self.surf_tmp.GetPolys().GetData()).reshape(-1, 4)[:,1:]).to(torch.int64)
+        self.grid = Grid2D(self.V[:,:2], self.radius)
+        self.adjacency = VertexAdjacency(self.F, self.V.shape[0])
+        self.hits = {}
+
+    def Hits(self, name, landmarks, curve):
+        """Vertices close to the curve name, searched again only if its landmarks moved"""
+        key = tuple(np.asarray(landmark, dtype=np.float64).tobytes() for landmark in landmarks)
+        if name not in self.hits or self.hits[name][0] != key:
+            self.hits[name] = (key, self.grid.Query(curve(*landmarks), self.radius))
+        return self.hits[name][1]
+
+    def __call__(self,
         ratio_anterior_right,
         ratio_anterior_left,
         ratio_posterior_left,
@@ -63,133 +163,114 @@ def butterflyPatch(surf,
         adjust_anterior_left,
         adjust_posterior_right,
         adjust_posterior_left,
-        index
-         ):
-    
-  
-
-    surf_tmp = vtk.vtkPolyData()
-    surf_tmp.DeepCopy(surf)
-
-
-    radius = 0.7
-
-    centroidf = vtkMeanTeeth([tooth_anterior_right,tooth_anterior_left,tooth_posterior_right,tooth_posterior_left],property='Universal_ID')
-
-    try :
-        surf_tmp = orientation(surf_tmp,[[-0.5,-0.5,0],[0,0,0],[0.5,-0.5,0]],
-                                   ['3','5','12','14'])
-        centroid = centroidf(surf_tmp)
-
-    except ToothNoExist as error:
-        logger.error(f' Error {error}')
-        return
-    V = torch.tensor(vtk_to_numpy(surf_tmp.GetPoints().GetData())).to(torch.float32)
-    F = torch.tensor(vtk_to_numpy(surf_tmp.GetPolys().GetData()).reshape(-1, 4)[:,1:]).to(torch.int64)
-
-    centroid_anterior_right = centroid[str(tooth_anterior_right)] + np.array([0,adjust_anterior_right,0],dtype=np.float32)
-    centroid_anterior_left = centroid[str(tooth_anterior_left)] + np.array([0,adjust_anterior_left,0],dtype=np.float32)
-
-
-    centroid_posterior_rigth = centroid[str(tooth_posterior_right)] + np.array([0,adjust_posterior_right,0],dtype=np.float32)
-    centroid_posterior_left = centroid[str(tooth_posterior_left)]+ np.array([0,adjust_posterior_left ,0],dtype=np.float32)
-
+        ):
+        """
+        Returns:
+            (V,) tensor, 1 on the vertices of the patch
+        """
+        tooth_anterior_right, tooth_anterior_left, tooth_posterior_right, tooth_posterior_left = self.teeth
+        centroid = self.centroid
 
-    landmark_anterior_left = (1-ratio_anterior_left) * centroid_anterior_right + ratio_anterior_left * centroid_anterior_left
-    landmark_anterior_right = (1-ratio_anterior_right) * centroid_anterior_left + ratio_anterior_right * centroid_anterior_right
+        centroid_anterior_right = centroid[str(tooth_anterior_right)] + np.array([0,adjust_anterior_right,0],dtype=np.float32)
+        centroid_anterior_left = centroid[str(tooth_anterior_left)] + np.array([0,adjust_anterior_left,0],dtype=np.float32)
 
-    landmark_posterior_left = (1-ratio_posterior_left) * centroid_posterior_rigth + ratio_posterior_left * centroid_posterior_left
-    landmark_posterior_right = (1- ratio_posterior_right) * centroid_posterior_left + ratio_posterior_right * centroid_posterior_rigth
-    landmark_middle_posterior = (landmark_posterior_left + landmark_posterior_right) / 2
 
+        centroid_posterior_rigth = centroid[str(tooth_posterior_right)] + np.array([0,adjust_posterior_right,0],dtype=np.float32)
+        centroid_posterior_left = centroid[str(tooth_posterior_left)]+ np.array([0,adjust_posterior_left ,0],dtype=np.float32)
 
 
-    middle = (landmark_posterior_left + landmark_anterior_right) / 2
+        landmark_anterior_left = (1-ratio_anterior_left) * centroid_anterior_right + ratio_anterior_left * centroid_anterior_left
+        landmark_anterior_right = (1-ratio_anterior_right) * centroid_anterior_left + ratio_anterior_right * centroid_anterior_right
 
+        landmark_posterior_left = (1-ratio_posterior_left) * centroid_posterior_rigth + ratio_posterior_left * centroid_posterior_left
+        landmark_posterior_right = (1- ratio_posterior_right) * centroid_posterior_left + ratio_posterior_right * centroid_posterior_rigth
+        landmark_middle_posterior = (landmark_posterior_left + landmark_posterior_right) / 2
 
 
-    #rectangle limit
-    t = np.arange(0,1,0.01)
-    haut_seg = Segment2D(landmark_anterior_left,landmark_anterior_right)
-    haut_seg = torch.tensor(haut_seg(t)).t().to(torch.float32)
-    
-    dis = torch.cdist(haut_seg,V[:,:2])
-    arg_haut_seg = torch.unique(torch.argwhere(dis < radius).squeeze()[:,1])
 
+        middle = (landmark_posterior_left + landmark_anterior_right) / 2
 
-    bas_seg = Segment2D(landmark_posterior_left,landmark_posterior_right)
-    bas_seg = torch.tensor(bas_seg(t)).t().to(torch.float32)
-    dis = torch.cdist(bas_seg,V[:,:2])
-    arg_bas_seg = torch.unique(torch.argwhere(dis < radius).squeeze()[:,1])
 
 
+        #rectangle limit
+        t = np.arange(0,1,0.01)
+        segment = lambda point1, point2 : Segment2D(point1,point2)(t).T
+        arg_haut_seg = self.Hits('haut_seg', (landmark_anterior_left,landmark_anterior_right), segment)
+        arg_bas_seg = self.Hits('bas_seg', (landmark_posterior_left,landmark_posterior_right), segment)
 
-    
+        #bezier droite
+        arg_bezier = self.Hits('bezier',
+                               (landmark_posterior_right,landmark_middle_posterior,landmark_anterior_right),
+                               MirroredBezier)
 
+        #bezier gauche
+        arg_bezier2 = self.Hits('bezier2',
+                                (landmark_posterior_left,landmark_middle_posterior,landmark_anterior_left),
+                                MirroredBezier)
 
-    #bezier droite
-    bezier = Bezier_bled(landmark_posterior_right[:2],landmark_middle_posterior[:2],landmark_anterior_right[:2],0.01)
-    v_bezier = bezier - np.expand_dims(landmark_posterior_right[:2],axis=0)
-    v_norm_bezier = np.expand_dims(np.linalg.norm(v_bezier, axis=1),axis=0).T
-    
-    for i in range(len(v_norm_bezier)):
-        if v_norm_bezier[i] == 0:
-            v_norm_bezier[i] += 0.01
 
-    v_bezier = v_bezier / v_norm_bezier
 
-    v = np.expand_dims(landmark_anterior_right[:2] - landmark_posterior_right[:2], axis=0).T
-    v_norm = np.linalg.norm(v)
-    v = v / v_norm
-    P = np.matmul(v , v.T)
+        V_label = torch.zeros((self.V.shape[0]))
+        V_label[arg_haut_seg] = 1
+        V_label[arg_bas_seg] = 1
+        V_label[arg_bezier] = 1
+        V_label[arg_bezier2] = 1
 
-    bezier_proj = ( P @ v_bezier.T).T *v_norm_bezier + landmark_posterior_right[:2]
-    sym = 2*bezier_proj - bezier
 
-    bezier = torch.tensor(sym,dtype=torch.float32)
-    dist = torch.cdist(bezier,V[:,:2])
-    arg_bezier = torch.argwhere(dist < radius)[:,1]
 
+        dist = torch.sum(torch.square(self.V[:,:2] - torch.tensor(middle[:2],dtype=torch.float32)), dim=1)
+        middle_arg = torch.argmin(dist)
+        return Dilation(middle_arg,self.F,V_label,adjacency=self.adjacency)
 
 
+# editor of the last surface, reused while the same surface is edited
+_editor = {}
 
-    #bezier gauche
-    bezier2 = Bezier_bled(landmark_posterior_left[:2],landmark_middle_posterior[:2],landmark_anterior_left[:2],0.01)
-    v_bezier = bezier2 - np.expand_dims(landmark_posterior_left[:2],axis=0)
-    v_norm_bezier = np.expand_dims(np.linalg.norm(v_bezier, axis=1),axis=0).T
-    for i in range(len(v_norm_bezier)):
-        if v_norm_bezier[i] == 0:
-            v_norm_bezier[i] += 0.01
-    v_bezier = v_bezier / v_norm_bezier
 
-    v = np.expand_dims(landmark_anterior_left[:2] - landmark_posterior_left[:2], axis=0).T
-    v_norm = np.linalg.norm(v)
-    v = v / v_norm
-    P = np.matmul(v , v.T)
-
-    bezier_proj = ( P @ v_bezier.T).T *v_norm_bezier + landmark_posterior_left[:2]
-    sym = 2*bezier_proj - bezier2
-
-    bezier2 = torch.tensor(sym,dtype=torch.float32)
-    dist = torch.cdist(bezier2,V[:,:2])
-    logger.debug(f'bezier2.shape {bezier2.shape}, V[:,;2].shape {V[:,:2].shape}')
-    arg_bezier2 = torch.argwhere(dist < radius)[:,1]
+def GetButterflyEditor(surf, tooth_anterior_right, tooth_anterior_left, tooth_posterior_right, tooth_posterior_left):
+    """ButterflyEditor of surf, built again only when the surface or the teeth change"""
+    key = (id(surf), surf.GetNumberOfPoints(), surf.GetPoints().GetMTime(),
+           tooth_anterior_right, tooth_anterior_left, tooth_posterior_right, tooth_posterior_left)
+    if _editor.get('key') != key:
+        _editor.clear()
+        _editor['editor'] = ButterflyEditor(surf, tooth_anterior_right, tooth_anterior_left,
+                                            tooth_posterior_right, tooth_posterior_left)
+        _editor['key'] = key
+    return _editor['editor']
 
 
+def butterflyPatch(surf,
+            tooth_anterior_right,
+         tooth_anterior_left,
+         tooth_posterior_right,
+         tooth_posterior_left,
+        ratio_anterior_right,
+        ratio_anterior_left,
+        ratio_posterior_left,
+        ratio_posterior_right,
+        adjust_anterior_right,
+        adjust_anterior_left,
+        adjust_posterior_right,
+        adjust_posterior_left,
+        index
+         ):
 
+    try :
+        editor = GetButterflyEditor(surf,tooth_anterior_right,tooth_anterior_left,
+                                    tooth_posterior_right,tooth_posterior_left)
 
+    except ToothNoExist as error:
+        logger.error(f' Error {error}')
+        return
 
-    V_label = torch.zeros((V.shape[0]))
-    V_label[arg_haut_seg] = 1
-    V_label[arg_bas_seg] = 1
-    V_label[arg_bezier] = 1
-    V_label[arg_bezier2] = 1
-
-
-
-    dist = torch.cdist(torch.tensor(middle[:2]).unsqueeze(0),V[:,:2]).squeeze()
-    middle_arg = torch.argmin(dist)
-    V_label = Dilation(middle_arg,F,V_label,surf_tmp)
+    V_label = editor(ratio_anterior_right,
+                     ratio_anterior_left,
+                     ratio_posterior_left,
+                     ratio_posterior_right,
+                     adjust_anterior_right,
+                     adjust_anterior_left,
+                     adjust_posterior_right,
+                     adjust_posterior_left)
 
 
 
@@ -198,4 +279,4 @@ def butterflyPatch(surf,
 
 
 
-    surf.GetPointData().AddArray(V_labels_prediction)
\ No newline at end of file
+    surf.GetPointData().AddArray(V_labels_prediction)
@@ -1,8 +1,6 @@
 from typing import Any
 import torch
-from collections import deque
-import vtk
-import numpy as np
+from vtk.util.numpy_support import vtk_to_numpy
 
 import sys
 import logging
@@ -20,82 +18,99 @@ console_handler.setFormatter(formatter)
 logger.addHandler(console_handler)
 
 
+DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+class VertexAdjacency:
+    """
+    Vertex adjacency of a triangle mesh in CSR form (indptr, indices), built once.
+
+    Memory is linear in the number of edges and the tensors stay on the device of F.
+    """
+
+    def __init__(self, F, n_verts=None):
+        F = F.to(torch.int64)
+        if n_verts is None:
+            n_verts = int(F.max()) + 1
+        self.n_verts = n_verts
+
+        edges = torch.cat([F[:, [0, 1]], F[:, [1, 2]], F[:, [2, 0]]])
+        edges = torch.cat([edges, edges.flip(1)])
+        # sorted unique (src, dst) pairs
+        keys = torch.unique(edges[:, 0] * n_verts + edges[:, 1])
+        src, self.indices = keys // n_verts, keys % n_verts
+
+        counts = torch.bincount(src, minlength=n_verts)
+        self.indptr = torch.zeros(n_verts + 1, dtype=torch.int64, device=F.device)
+        self.indptr[1:] = torch.cumsum(counts, dim=0)
+
+    @classmethod
+    def FromSurf(cls, vtkdata, device=DEVICE):
+        F = torch.tensor(vtk_to_numpy(vtkdata.GetPolys().GetData()).reshape(-1, 4)[:, 1:]).to(torch.int64)
+        return cls(F.to(device), vtkdata.GetNumberOfPoints())
+
+    def Neighbors(self, ids):
+        """Concatenated neighbors of the vertices ids, with repetitions"""
+        start = self.indptr[ids]
+        counts = self.indptr[ids + 1] - start
+        # position of every neighbor in indices
+        shift = torch.repeat_interleave(start - (torch.cumsum(counts, dim=0) - counts), counts)
+        pos = torch.arange(int(counts.sum()), device=ids.device) + shift
+        return self.indices[pos]
+
+    def FloodFill(self, frontier, visited):
+        """
+        Grow visited from frontier, ring by ring, until no unvisited neighbor is left
+
+        Args:
+            frontier : vertex ids of the first ring
+            visited : (n_verts,) boolean mask, updated in place
+        """
+        while frontier.numel() > 0:
+            visited[frontier] = True
+            neighbors = self.Neighbors(frontier)
+            neighbors = neighbors[~visited[neighbors]]
+            frontier = torch.unique(neighbors)
+        return visited
+
+
 def Difference(t1,t2):
-    t1 = t1.unsqueeze(0).expand(len(t2),-1)
-    t2 = t2.unsqueeze(1)
-    d = torch.count_nonzero(t1 -t2,dim=-1)
-    arg = torch.argwhere(d == t1.shape[1])
-    dif = torch.unique(t2[arg])
-    return dif
+    """Elements of t2 that are not in t1"""
+    return torch.unique(t2[~torch.isin(t2, t1)])
 
 
 def Neighbours(arg_point,F):
-    neighbours = torch.tensor([]).cuda()
-    F2 = F.unsqueeze(0).expand(len(arg_point),-1,-1)
-    arg_point = arg_point.unsqueeze(1).unsqueeze(2)
-    arg = torch.argwhere((F2-arg_point) == 0)
-
-    neighbours = torch.unique(F[arg[:,1],:])
-    return neighbours
+    """Vertices of the faces touching arg_point, arg_point included"""
+    faces = torch.isin(F, arg_point.to(F.device)).any(dim=1)
+    return torch.unique(F[faces])
 
 
 def GetNeighbors(vtkdata, pids_tensor):
-    all_neighbor_pids = []
-
-    # Convertir le tensor en une liste d'entiers
-    pids_list = pids_tensor.tolist()
-
-    for pid in pids_list:
-        cells_id = vtk.vtkIdList()
-        vtkdata.GetPointCells(pid, cells_id)
-
-        for ci in range(cells_id.GetNumberOfIds()):
-            points_id_inner = vtk.vtkIdList()
-            vtkdata.GetCellPoints(cells_id.GetId(ci), points_id_inner)
-            for pi in range(points_id_inner.GetNumberOfIds()):
-                pid_inner = points_id_inner.GetId(pi)
-                if pid_inner != pid:
-                    all_neighbor_pids.append(pid_inner)
-
-    # Rendre unique tous les indices de voisins
-    unique_neighbors = np.unique(all_neighbor_pids).tolist()
-    return torch.tensor(unique_neighbors).cuda().to(torch.int64)
-
-
-
-
-def Dilation(arg_point,F,texture,surf):
-    arg_point = torch.tensor([arg_point]).cuda().to(torch.int64)
-    F = F.cuda()
-    texture = texture.cuda()
-    neighbour = Neighbours(arg_point,F)
-    arg_texture = torch.argwhere(texture == 1).squeeze()
-    dif = neighbour.to(torch.int64)
-    dif  = Difference(arg_texture,dif)
-
-    dif_queue = [Neighbours(arg_point,F).to(torch.int64)]
-    
-
-    nmb_treatment = 1000
-
-    while dif_queue :  # La boucle continue tant que l'une des files d'attente n'est pas vide
-        new_neighbour_batch = []
-        while dif_queue:
-            current_dif = dif_queue.pop(0)
-            if current_dif.numel() > nmb_treatment:
-                dif_queue.append(current_dif[nmb_treatment:])
-                current_dif = current_dif[:nmb_treatment]
-            texture[current_dif] = 1
-            new_neighbour_batch.append(GetNeighbors(surf,current_dif))
-        
-        arg_texture = torch.argwhere(texture == 1).squeeze()
-        
-        while new_neighbour_batch:
-            current_neighbours = new_neighbour_batch.pop(0)
-            if current_neighbours.numel() > nmb_treatment:
-                new_neighbour_batch.append(current_neighbours[nmb_treatment:])
-                current_neighbours = current_neighbours[:nmb_treatment]
-            dif = Difference(arg_texture, current_neighbours.to(torch.int64))
-            if dif.numel() > 0:
-                dif_queue.append(dif)
-    return texture
\ No newline at end of file
+    pids_tensor = pids_tensor.to(DEVICE).to(torch.int64)
+    neighbors = VertexAdjacency.FromSurf(vtkdata).Neighbors(pids_tensor)
+    return torch.unique(neighbors)
+
+
+def Dilation(arg_point,F,texture,surf=None,adjacency=None):
+    """
+    Fill the region containing arg_point, bounded by the vertices where texture == 1
+
+    Runs on the device of texture. surf is not used anymore, the adjacency is
+    built from F unless it is given.
+    """
+    device = texture.device
+    F = F.to(device).to(torch.int64)
+    if adjacency is None:
+        adjacency = VertexAdjacency(F, texture.shape[0])
+
+    arg_point = torch.as_tensor(arg_point, device=device).to(torch.int64).reshape(1)
+    visited = texture == 1
+
+    # the first ring is expanded even where it is already labeled
+    frontier = Neighbours(arg_point, F)
+    visited[frontier] = True
+    neighbors = adjacency.Neighbors(frontier)
+    adjacency.FloodFill(torch.unique(neighbors[~visited[neighbors]]), visited)
+
+    texture[visited] = 1
+    return texture
@@ -17,6 +17,7 @@ set(MODULE_PYTHON_SCRIPTS
   ${MODULE_NAME}/resample_create_csv.py
   ${MODULE_NAME}/resample.py
   ${MODULE_NAME}/TMJ_crop.py
+  ${MODULE_NAME}/transform_search.py
 )
 
 #-----------------------------------------------------------------------------
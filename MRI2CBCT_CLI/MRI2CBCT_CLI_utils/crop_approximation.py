@@ -6,7 +6,6 @@ import nibabel as nib
 import SimpleITK as sitk
 import torch.nn.functional as F
 from sklearn.model_selection import ParameterSampler
-from torchreg import AffineRegistration
 
 import sys
 import logging
@@ -23,7 +22,7 @@ formatter = logging.Formatter('%(name)s - %(levelname)s - (%(filename)s:%(lineno
 console_handler.setFormatter(formatter)
 logger.addHandler(console_handler)
 
-from MRI2CBCT_CLI_utils.nmi import NMI
+from MRI2CBCT_CLI_utils.transform_search import TransformSearch, load_normalized, pad_to_shape
 
 def save_as_nifti(moving_tensor, static_path, output_path):
     """
@@ -210,83 +209,46 @@ def get_transformation(cbct_folder, mean_folder, output_folder):
     
     # Check if GPU is available
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    
+
+    # The candidates are screened at coarse levels, only the survivors run the full registration
+    search = TransformSearch(list(param_sampler), device=device)
+    mean_path = os.path.join(mean_folder, 'mean_image.nii.gz')
+    static_nii, static_np = None, None
+
     for root, _, files in os.walk(cbct_folder):
         for cbct_file in files:
             if "_CBCT_" in cbct_file and (cbct_file.endswith(".nii") or cbct_file.endswith(".nii.gz")):
                 patient_id = cbct_file.split("_CBCT_")[0]
                 cbct_path = os.path.join(root, cbct_file)
-                mean_path = os.path.join(mean_folder, 'mean_image.nii.gz')
-
-                if mean_path:
-                    best_loss = float('inf')  # Initialize to track the best loss
-                    best_params = None        # Initialize to store the best parameter combination
-                    for params in param_sampler:
-                        # Load images using nibabel
-                        moving_nii = nib.load(cbct_path)
-                        static_nii = nib.load(mean_path)
-
-                        # Get the NumPy data from nibabel images
-                        moving_np = moving_nii.get_fdata()
-                        static_np = static_nii.get_fdata()
-
-                        # Normalize the images
-                        epsilon = 1e-8
-                        moving_np_normalized = (moving_np - moving_np.min()) / (moving_np.max() - moving_np.min() + epsilon)
-                        static_np_normalized = (static_np - static_np.min()) / (static_np.max() - static_np.min() + epsilon)
-
-                        # Pad the moving image (CBCT) to match the dimensions of the mean image
-                        static_shape = static_np_normalized.shape
-                        moving_padded_np = np.pad(
-                            moving_np_normalized,
-                            [(max(0, (s - ms) // 2), max(0, (s - ms + 1) // 2)) for s, ms in zip(static_shape, moving_np_normalized.shape)],
-                            mode='constant',
-                            constant_values=0
-                        )
-
-                        logger.info(f"\nUsing {device.upper()} -- Registering CBCT: {cbct_path} with mean: {mean_path}")
-
-                        # Convert NumPy arrays to torch tensors
-                        moving_normed = torch.from_numpy(moving_padded_np).float().to(device)
-                        static_normed = torch.from_numpy(static_np_normalized).float().to(device)
-
-                        logger.info(f"Testing parameters: {params}")
-
-                        # Initialize NMI loss function for rigid registration
-                        nmi_loss_function_rigid = NMI(intensity_range=None, nbins=64, sigma=params['sigma_rigid'], use_mask=False)
-
-                        # Initialize AffineRegistration for Rigid registration
-                        reg_rigid = AffineRegistration(scales=(4, 2), iterations=(100, 30), is_3d=True, 
-                                                       learning_rate=params['learning_rate_rigid'], verbose=True, 
-                                                       dissimilarity_function=nmi_loss_function_rigid.metric, optimizer=torch.optim.Adam, 
-                                                       with_translation=True, with_rotation=True, with_zoom=False, with_shear=False, 
-                                                       align_corners=True, interp_mode="trilinear", padding_mode='zeros')
-
-                        # Perform rigid registration
-                        moved_image = reg_rigid(moving_normed[None, None], static_normed[None, None])
-                        moved_image = moved_image[0, 0]
-
-                        # Compute the final loss
-                        final_loss = -nmi_loss_function_rigid.metric(moved_image[None, None], static_normed[None, None])
-                        logger.info(f"Final Loss (NMI): {final_loss}")
-
-                        # Check if this is the best loss so far
-                        if final_loss < best_loss and final_loss > 1e-5:
-                            best_loss = final_loss
-                            best_params = params
-                            logger.info(f"New best parameters found with loss: {best_loss}")
-
-                            # Save the registered image using your save_as_nifti function
-                            output_path = os.path.join(output_folder, f'{patient_id}_CBCT_transform.nii.gz')
-                            save_as_nifti(moved_image, mean_path, output_path)
-
-                            transform_matrix = compute_transform_matrix(static_nii.affine, moving_nii.affine)
-                            logger.info("Transformation Matrix from Volume A to Volume B:")
-                            logger.info(transform_matrix)
-
-                    logger.info(f"Best parameters: {best_params}")
-                    logger.info(f"Best NMI loss: {best_loss}")
-                    
+
+                # Load and normalize the mean once, and each CBCT once
+                if static_nii is None:
+                    static_nii, static_np = load_normalized(mean_path)
+                moving_nii, moving_np = load_normalized(cbct_path)
+
+                # Pad the moving image (CBCT) to match the dimensions of the mean image
+                moving_padded_np = pad_to_shape(moving_np, static_np.shape)
+
+                logger.info(f"\nUsing {device.upper()} -- Registering CBCT: {cbct_path} with mean: {mean_path}")
+                best = search.Run(moving_padded_np, static_np)
+                if best is None:
+                    logger.warning(f"No valid registration found for {cbct_path}")
+                    continue
+
+                # Save only the registered image of the best parameters
+                output_path = os.path.join(output_folder, f'{patient_id}_CBCT_transform.nii.gz')
+                save_as_nifti(best['moved'], mean_path, output_path)
+
+                try:
+                    transform_matrix = compute_transform_matrix(static_nii.affine, moving_nii.affine)
+                    logger.info("Transformation Matrix from Volume A to Volume B:")
+                    logger.info(transform_matrix)
+                except Exception as e:
+                    logger.error(f"Could not compute the transformation matrix for {patient_id}: {e}")
+
+                logger.info(f"Best parameters: {best['params']}")
+                logger.info(f"Best NMI: {best['nmi']}")
+
 def crop_volume(ROI_file, transformation_folder, first_approximation_folder, cbct_folder, cropped_cbct_folder):
     """
     Crops the CBCT volumes and first approximated MRIs based on the ROI and saves the results.
@@ -0,0 +1,224 @@
+import os
+import math
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+import numpy as np
+import nibabel as nib
+import torch.nn.functional as F
+from torchreg import AffineRegistration
+
+import sys
+import logging
+
+# ===== Logging Configuration =====
+logger = logging.getLogger("MRI2CBCT_CLI_utils_transform_search")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+if logger.handlers:
+    logger.handlers.clear()
+console_handler = logging.StreamHandler(sys.stdout)
+console_handler.setLevel(logging.INFO)
+formatter = logging.Formatter('%(name)s - %(levelname)s - (%(filename)s:%(lineno)d) - %(message)s')
+console_handler.setFormatter(formatter)
+logger.addHandler(console_handler)
+
+from MRI2CBCT_CLI_utils.nmi import NMI
+
+# (downsampling factor, iterations) of the screening rungs, coarse to fine
+SEARCH_RUNGS = ((8, 100), (4, 100))
+# (scales, iterations) of the full registration of the finalists
+FINAL_SCHEDULE = ((4, 2), (100, 30))
+# every trial is scored with the same NMI, whatever the sigma it was registered with
+SCORE_SIGMA = 0.1
+SCORE_KERNEL = "linear"
+
+# registered pair of the current process, set once per pair by InitPair
+_PAIR = {}
+
+
+def SearchWorkers(device):
+    """
+    Number of worker processes of the search, MRI2CBCT_SEARCH_WORKERS env var.
+
+    Default to one process on GPU (the trials share the device) and up to 4 on CPU.
+    """
+    default_workers = 1 if device == 'cuda' else min(os.cpu_count() or 1, 4)
+    return max(int(os.environ.get("MRI2CBCT_SEARCH_WORKERS", default_workers)), 1)
+
+
+def load_normalized(path):
+    """
+    Load a NIfTI file and min-max normalize it to [0, 1].
+
+    Returns:
+        (nibabel image, float32 numpy array)
+    """
+    nii = nib.load(path)
+    data = nii.get_fdata()
+    epsilon = 1e-8
+    data = (data - data.min()) / (data.max() - data.min() + epsilon)
+    return nii, data.astype(np.float32)
+
+
+def pad_to_shape(moving_np, static_shape):
+    """Pad the moving image symmetrically with zeros up to the shape of the static image."""
+    return np.pad(
+        moving_np,
+        [(max(0, (s - ms) // 2), max(0, (s - ms + 1) // 2)) for s, ms in zip(static_shape, moving_np.shape)],
+        mode='constant',
+        constant_values=0
+    )
+
+
+def build_pyramid(moving_np, static_np, factors):
+    """
+    Downsample the pair once for every screening rung.
+
+    The moving image is first resampled on the grid of the static image, as AffineRegistration does.
+
+    Returns:
+        {level: (moving, static)} numpy arrays, level 'full' for the original pair
+    """
+    pyramid = {'full': (moving_np, static_np)}
+    moving = torch.from_numpy(moving_np).float()[None, None]
+    static = torch.from_numpy(static_np).float()[None, None]
+    moving = F.interpolate(moving, static.shape[2:], mode='trilinear', align_corners=True)
+    for factor in factors:
+        size = [max(d // factor, 1) for d in static.shape[2:]]
+        pyramid[factor] = tuple(
+            F.interpolate(image, size=size, mode='trilinear', align_corners=True)[0, 0].numpy()
+            for image in (moving, static)
+        )
+    return pyramid
+
+
+def InitPair(pyramid, device, n_threads=None):
+    """Move the pyramid of the pair on the device of this process, once per pair."""
+    _PAIR.clear()
+    if n_threads:
+        torch.set_num_threads(n_threads)
+    for level, images in pyramid.items():
+        _PAIR[level] = tuple(torch.from_numpy(np.ascontiguousarray(image)).float().to(device)[None, None] for image in images)
+
+
+def RunTrial(params, level, scales, iterations, return_moved=False):
+    """
+    Rigid registration of the pair at a level of the pyramid with one parameter combination.
+
+    Returns:
+        (score, NMI, moved image or None), score is -NMI (lower is better), inf for a degenerate result
+    """
+    moving, static = _PAIR[level]
+
+    # Initialize NMI loss function for rigid registration
+    nmi_loss_function_rigid = NMI(intensity_range=None, nbins=64, sigma=params['sigma_rigid'], use_mask=False)
+
+    # Initialize AffineRegistration for Rigid registration
+    reg_rigid = AffineRegistration(scales=scales, iterations=iterations, is_3d=True,
+                                   learning_rate=params['learning_rate_rigid'], verbose=False,
+                                   dissimilarity_function=nmi_loss_function_rigid.metric, optimizer=torch.optim.Adam,
+                                   with_translation=True, with_rotation=True, with_zoom=False, with_shear=False,
+                                   align_corners=True, interp_mode="trilinear", padding_mode='zeros')
+
+    moved_image = reg_rigid(moving, static)
+    # the score is evaluated at the resolution of the level, with a scorer shared by all the trials
+    nmi_score_function = NMI(intensity_range=None, nbins=64, sigma=SCORE_SIGMA, use_mask=False, kernel=SCORE_KERNEL)
+    with torch.no_grad():
+        nmi_value = float(-nmi_score_function.metric(moved_image, static))
+
+    score = -nmi_value if nmi_value > 1e-5 else math.inf
+    moved = moved_image[0, 0].cpu().numpy() if return_moved else None
+    return score, nmi_value, moved
+
+
+def _RunTrial(args):
+    return RunTrial(*args)
+
+
+class TransformSearch:
+    """
+    Successive halving search of the rigid registration parameters of a CBCT/mean pair.
+
+    The pair is normalised and downsampled once. Every candidate is first registered
+    at the coarsest rung, only the best 1/eta go on to the next rung, and the survivors
+    of the last rung run the full registration (FINAL_SCHEDULE) at full resolution.
+    All the trials are scored with the same NMI (SCORE_SIGMA, SCORE_KERNEL) so that the
+    candidates are ranked on one scale. Trials run in worker processes that each receive
+    the pair once and use the device of the search; by default on GPU they run in this
+    process one after the other.
+    """
+
+    def __init__(self, candidates, rungs=SEARCH_RUNGS, final_schedule=FINAL_SCHEDULE, eta=4, device=None, workers=None) -> None:
+        """
+        Args:
+            candidates : list of {'learning_rate_rigid', 'sigma_rigid'}
+            rungs : (downsampling factor, iterations) of each screening rung
+            eta : 1/eta of the candidates survive each rung
+        """
+        self.candidates = list(candidates)
+        self.rungs = rungs
+        self.final_schedule = final_schedule
+        self.eta = eta
+        self.device = device if device is not None else ('cuda' if torch.cuda.is_available() else 'cpu')
+        self.workers = workers if workers is not None else SearchWorkers(self.device)
+
+    def _Survivors(self, candidates, scores):
+        keep = max(int(math.ceil(len(candidates) / self.eta)), 1)
+        order = np.argsort(scores, kind='stable')[:keep]
+        return [candidates[i] for i in order if np.isfinite(scores[i])]
+
+    def Run(self, moving_np, static_np):
+        """
+        Args:
+            moving_np : normalised moving image, padded to the shape of static_np
+            static_np : normalised static image
+
+        Returns:
+            {'params', 'nmi', 'moved'} of the best finalist, None if every trial failed
+        """
+        pyramid = build_pyramid(moving_np, static_np, [factor for factor, _ in self.rungs])
+
+        executor = None
+        if self.workers > 1:
+            n_threads = max((os.cpu_count() or 1) // self.workers, 1)
+            executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                initializer=InitPair, initargs=(pyramid, self.device, n_threads)
+            )
+            run = lambda tasks: list(executor.map(_RunTrial, tasks))
+        else:
+            InitPair(pyramid, self.device)
+            run = lambda tasks: [RunTrial(*task) for task in tasks]
+
+        try:
+            candidates = self.candidates
+            for factor, iterations in self.rungs:
+                tic = time.time()
+                results = run([(params, factor, (1,), (iterations,)) for params in candidates])
+                scores = [score for score, _, _ in results]
+                survivors = self._Survivors(candidates, scores)
+                logger.info(
+                    f"Rung 1/{factor}: {len(candidates)} candidate(s) in {time.time() - tic:.1f}s, "
+                    f"{len(survivors)} kept, best NMI {-min(scores):.4f}"
+                )
+                candidates = survivors
+                if not candidates:
+                    return None
+
+            tic = time.time()
+            scales, iterations = self.final_schedule
+            results = run([(params, 'full', scales, iterations, True) for params in candidates])
+            logger.info(f"Full registration of {len(candidates)} finalist(s) in {time.time() - tic:.1f}s")
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            _PAIR.clear()
+
+        best = min(range(len(results)), key=lambda i: results[i][0])
+        score, nmi_value, moved = results[best]
+        if not np.isfinite(score):
+            return None
+        return {'params': candidates[best], 'nmi': nmi_value, 'moved': moved}